@@ -0,0 +1,454 @@
+"""
+VaultApp benchmarks
+Builds synthetic vaults (mixed images, videos and documents) and times the hot paths, results as JSON so runs can be compared.
+
+    python benchmark.py --files 1000 10000 100000 -o results.json
+    python benchmark.py --files 1000 --compare results.json
+
+Each vault size runs in its own process (clean peak RSS), the window is driven offscreen (QT_QPA_PLATFORM=offscreen).
+"""
+
+import sys, os, io, json, time, random, shutil, argparse, platform, tempfile, statistics, subprocess, datetime
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+import vault as engine
+from vault import Vault, SyS_Record, SyS_ThumbPack, SyS_VaultReader, encrypt_stream, decrypt_chunks, derive_key, make_thumbnail
+
+try:import resource
+except ImportError:resource = None
+
+PASSWORD = "benchmark"
+WORDS = ("holiday", "report", "family", "scan", "invoice", "trip", "draft", "notes", "birthday", "contract")
+KINDS = (("image", "jpg", "IMG"), ("video", "mp4", "VID"), ("document", "pdf", "DOC"))
+
+
+def peak_rss():
+    # Peak resident set size of this process in MB, None where unsupported (worker figures are left out, Linux carries them over from the fork)
+    if resource is None: return None
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024*1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def timed(call, repeat=1):
+    # Median wall time of call() over repeat runs, and the result of the last run
+    times = []
+    for _ in range(max(1, repeat)):
+        start = time.perf_counter()
+        result = call()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times), result
+
+
+def f_log(message):
+    sys.stderr.write("  " + message + "\n")
+    sys.stderr.flush()
+
+
+# Synthetic data
+
+def make_samples(directory, seed, image_size=(320, 240)):
+    # A few distinct payloads per kind, reused across the synthetic files : {kind: [(data, thumbnail JPEG or None), ...]}
+    import cv2
+    import numpy as np
+    rng = np.random.default_rng(seed)
+    samples = {"image": [], "video": [], "document": []}
+    for i in range(4):
+        # Gradient plus noise, compresses like a photo rather than like pure noise
+        w, h = image_size
+        frame = np.clip(np.linspace(0, 255, w)[None, :, None] * rng.random(3) + rng.normal(0, 24, (h, w, 3)), 0, 255).astype(np.uint8)
+        data = cv2.imencode('.jpg', frame)[1].tobytes()
+        samples["image"].append((data, make_thumbnail(None, "image", data)))
+
+        path = os.path.join(directory, "sample" + str(i) + ".mp4")
+        writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'mp4v'), 10, (160, 120))
+        for _ in range(20): writer.write(rng.integers(0, 255, (120, 160, 3), dtype=np.uint8))
+        writer.release()
+        with open(path, 'rb') as f:
+            data = f.read()
+        try:thumbnail = make_thumbnail(path, "video")
+        except Exception:thumbnail = None
+        samples["video"].append((data, thumbnail))
+
+        words = rng.choice(WORDS, 400 * (i + 1))
+        samples["document"].append((" ".join(words).encode('utf-8'), None))
+    return samples
+
+
+def build_vault(directory, count, samples, mix, seed):
+    # Module : Vault of count files written straight through the engine (no worker pool, thumbnails precomputed)
+    rng = random.Random(seed)
+    vault = Vault(directory).open(PASSWORD)
+    weights = [mix[kind] for kind, ext, prefix in KINDS]
+    pending, packed = [], []
+    for i in range(count):
+        kind, ext, prefix = rng.choices(KINDS, weights)[0]
+        data, thumbnail = samples[kind][i % len(samples[kind])]
+        name, file = vault.unique_name(prefix + "_" + rng.choice(WORDS) + "_" + str(i).zfill(6) + "." + ext, ext)
+        record = SyS_Record(file, name, ext, kind, len(data), int(time.time()))
+        # Same layout as an import : small files packed into segments, large ones as blobs
+        if len(data) > engine.PACK_OBJECT_LIMIT:
+            os.makedirs(os.path.dirname(vault.blob_path(file)), exist_ok=True)
+            encrypt_stream(io.BytesIO(data), vault.blob_path(file), vault.keyring)
+            record.location = 1
+        else:
+            sealed = io.BytesIO()
+            encrypt_stream(io.BytesIO(data), sealed, vault.keyring)
+            packed.append((record, sealed.getvalue()))
+        vault.index.add(record)
+        if thumbnail is not None: pending.append((record, SyS_ThumbPack.seal(vault.thumbnails.key, file, thumbnail)))
+        if len(pending) >= 1000 or i == count - 1 and pending:
+            for (record, sealed), location in zip(pending, vault.thumbnails.append([sealed for record, sealed in pending])):
+                record.thumbnail = location
+            pending = []
+        if len(packed) >= 1000 or i == count - 1 and packed:
+            for (record, sealed), location in zip(packed, vault.segments.append([sealed for record, sealed in packed])):
+                record.location = location
+            packed = []
+    vault.segments.sync()
+    vault.save()
+    vault.close()
+
+
+def make_sources(directory, samples, count, big_mb):
+    # Plain files to import : count small mixed files and one large one
+    os.makedirs(directory, exist_ok=True)
+    small = []
+    for i in range(count):
+        kind, ext, prefix = KINDS[i % len(KINDS)]
+        path = os.path.join(directory, "source_" + str(i).zfill(5) + "." + ext)
+        with open(path, 'wb') as f:
+            f.write(samples[kind][i % len(samples[kind])][0])
+        small.append(path)
+    big = os.path.join(directory, "source_large.bin")
+    with open(big, 'wb') as f:
+        for _ in range(big_mb):
+            f.write(os.urandom(1024*1024))
+    return small, big
+
+
+# Benchmarks
+
+def bench_crypto(directory, keyring, payload_mb, repeat):
+    # Encrypt / decrypt throughput of one file held in the page cache
+    data = os.urandom(payload_mb*1024*1024)
+    path = os.path.join(directory, "payload.enc")
+    encrypt_s, _ = timed(lambda: encrypt_stream(io.BytesIO(data), path, keyring), repeat)
+    def f_read_all():
+        with SyS_VaultReader(path, keyring) as reader:
+            return reader.read_all()
+    decrypt_s, _ = timed(f_read_all, repeat)
+    stream_s, _ = timed(lambda: sum(len(chunk) for chunk in decrypt_chunks(path, keyring)), repeat)
+    range_s, _ = timed(lambda: [SyS_VaultReader(path, keyring).read(offset, 4096) for offset in range(0, len(data), len(data)//64)], repeat)
+    # The same for a log-like document, compressed before encryption (random data above skips the compressor)
+    rng = random.Random(0)
+    block = "".join(str(i) + " " + rng.choice(WORDS) + " " + str(rng.random()) + "\n" for i in range(40000)).encode('utf-8')
+    text = (block * -(-len(data) // len(block)))[:len(data)]
+    document_s, _ = timed(lambda: encrypt_stream(io.BytesIO(text), path, keyring), repeat)
+    stored = os.path.getsize(path)
+    document_read_s, _ = timed(f_read_all, repeat)
+    os.remove(path)
+    return {"payload_mb": payload_mb,
+            "encrypt_mb_s": round(payload_mb / encrypt_s, 1),
+            "decrypt_mb_s": round(payload_mb / decrypt_s, 1),
+            "decrypt_stream_mb_s": round(payload_mb / stream_s, 1),
+            "range_read_ms": round(range_s * 1000 / 64, 3),
+            "document_encrypt_mb_s": round(payload_mb / document_s, 1),
+            "document_decrypt_mb_s": round(payload_mb / document_read_s, 1),
+            "document_stored_ratio": round(stored / len(text), 3)}
+
+
+def bench_bulk(vault, directory, small, big, workers):
+    # Import and export per file (small mixed files) and per GB (one large file), then delete them again
+    result = {}
+    big_gb = os.path.getsize(big) / (1024**3)
+    import_s, (imported, failed, no_thumbnail) = timed(lambda: vault.import_files(small, workers=workers))
+    import_big_s, (imported_big, failed_big, _) = timed(lambda: vault.import_files([big], workers=workers))
+    result["import"] = {"files": len(small), "failed": len(failed) + len(failed_big), "no_thumbnail": len(no_thumbnail),
+                        "s_per_file": round(import_s / len(small), 5), "files_per_s": round(len(small) / import_s, 1),
+                        "s_per_gb": round(import_big_s / big_gb, 3)}
+    # The same files again are recognised by their digest : a hash pass, no new data
+    data = lambda: sum(os.path.getsize(os.path.join(root, f)) for root, dirs, names in os.walk(vault.data) for f in names)
+    before = data()
+    reimport_s, (reimported, _, _) = timed(lambda: vault.import_files(small, workers=workers))
+    result["reimport"] = {"files": len(reimported), "s_per_file": round(reimport_s / len(small), 5),
+                          "new_mb": round((data() - before) / (1024**2), 3)}
+
+    out = os.path.join(directory, "export")
+    os.makedirs(out, exist_ok=True)
+    files = [record.file for record in imported]
+    export_s, (exported, errors) = timed(lambda: vault.export_files(files, out, workers=workers))
+    export_big_s, _ = timed(lambda: vault.export_files([record.file for record in imported_big], out, workers=workers))
+    result["export"] = {"files": len(files), "failed": len(files) - len(exported),
+                        "s_per_file": round(export_s / max(1, len(files)), 5), "files_per_s": round(len(files) / export_s, 1),
+                        "s_per_gb": round(export_big_s / big_gb, 3)}
+    shutil.rmtree(out)
+
+    # Unthrottled full scrub of the vault (shared content read once)
+    stored_gb = sum(job[4] for job in vault.prepare_scrub()[0]) / (1024**3)
+    scrub_s, report = timed(lambda: vault.scrub(workers=workers))
+    result["scrub"] = {"problems": len(report or []), "s_per_gb": round(scrub_s / max(stored_gb, 1e-9), 3)}
+
+    delete_s, deleted = timed(lambda: vault.delete(files + [record.file for record in imported_big] + [record.file for record in reimported]))
+    result["delete"] = {"files": len(deleted), "s_per_file": round(delete_s / max(1, len(deleted)), 5)}
+    return result
+
+
+def bench_search(search, count, repeat):
+    # Latency of typical queries, and of typing one keystroke at a time (each query narrows the previous one)
+    queries = {"common": "img", "word": "invoice", "rare": str(count // 2).zfill(6), "none": "zzzz"}
+    result = {}
+    for label, keyword in queries.items():
+        seconds, _ = timed(lambda: search(keyword, False), repeat)
+        result[label + "_ms"] = round(seconds * 1000, 3)
+    def f_typing():
+        for n in range(1, len("birthday") + 1): search("birthday"[:n], True)
+    seconds, _ = timed(f_typing, repeat)
+    result["typing_8_keys_ms"] = round(seconds * 1000, 3)
+    return result
+
+
+STARTUP = """
+import sys, os
+sys.path.insert(0, %r)
+from PyQt5.QtWidgets import QApplication
+app = QApplication(sys.argv)
+import main
+main.App_version = "benchmark"
+main.vault = main.Vault(%r)
+def f_prompt(dialog):
+    sys.stdout.write("cv2" in sys.modules and "1" or "0")
+    sys.stdout.flush()
+    os._exit(0)
+main.SyS_InputDialog.exec_ = f_prompt
+main.VaultApp()
+"""
+
+
+def bench_startup(directory, repeat):
+    # Module : Fresh interpreter until the password prompt is up (the window is shown first), offscreen
+    code = STARTUP % (os.path.dirname(os.path.abspath(__file__)), directory)
+    def f_start():
+        return subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, timeout=120).stdout
+    seconds, output = timed(f_start, repeat)
+    return {"prompt_s": round(seconds, 4), "media_loaded": output == "1"}
+
+
+def bench_window(directory, count, repeat):
+    # Module : Unlock, grid population, refresh and search through the window, offscreen
+    global app
+    from PyQt5.QtWidgets import QApplication, QDialog
+    app = QApplication.instance() or QApplication(sys.argv)
+    import main
+
+    class SyS_AutoDialog:
+        # Dialogs answer themselves : password in, everything accepted
+        def __init__(self, *args, **kwargs):
+            self.input = type("input", (), {"text": staticmethod(lambda: PASSWORD)})
+        def setup(self, **kwargs):
+            pass
+        def isVisible(self):
+            return False
+        def exec_(self):
+            return QDialog.Accepted
+        def close(self):
+            pass
+    main.SyS_InputDialog = main.SyS_MsgBoxDialog = main.SyS_InfoDialog = main.SyS_AboutDialog = SyS_AutoDialog
+    main.App_version = "benchmark"
+    main.vault = Vault(directory)
+
+    def f_pump():
+        # Until the visible thumbnails are in (jobs are queued by a zero timer after the grid is set)
+        app.processEvents()
+        while window._thumbnail_jobs:
+            time.sleep(0.001)
+            app.processEvents()
+
+    result = {}
+    start = time.perf_counter()
+    window = main.VaultApp()
+    result["open_s"] = round(time.perf_counter() - start, 4)
+    f_pump()
+    result["open_to_thumbnails_s"] = round(time.perf_counter() - start, 4)
+
+    seconds, _ = timed(lambda: window.f_GUI_grid_manager(main._files, "all"), repeat)
+    result["grid_populate_s"] = round(seconds, 4)
+    # First screen of thumbnails : decrypted and decoded, then from the decoded cache (the model keeps its own across refreshes)
+    seconds, _ = timed(lambda: (window.grid_model.set_rows([]), window.thumbnail_cache.clear(), window.f_GUI_grid_manager(main._files, "all"), f_pump()), repeat)
+    result["grid_thumbnails_cold_s"] = round(seconds, 4)
+    seconds, _ = timed(lambda: (window.grid_model.set_rows([]), window.f_GUI_grid_manager(main._files, "all"), f_pump()), repeat)
+    result["grid_thumbnails_cached_s"] = round(seconds, 4)
+    seconds, _ = timed(lambda: (window.SyS_refresh(ask_password=False), f_pump()), repeat)
+    result["refresh_s"] = round(seconds, 4)
+    seconds, _ = timed(lambda: (window.f_show_category("image"), f_pump()), repeat)
+    result["tab_switch_s"] = round(seconds, 4)
+    window.SyS_refresh(ask_password=False)
+
+    # One imported or deleted file : only its tile is added or removed
+    source = os.path.join(directory, "one.txt")
+    with open(source, 'w') as f:
+        f.write("one " * 1000)
+    file = main.vault.import_files([source], workers=1)[0][0].file
+    os.remove(source)
+    added, removed = [], []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        window.f_files_added([file])
+        app.processEvents()
+        added.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        window.f_files_removed([file])
+        app.processEvents()
+        removed.append(time.perf_counter() - start)
+    main.vault.delete([file])
+    result["grid_add_one_ms"] = round(statistics.median(added) * 1000, 3)
+    result["grid_remove_one_ms"] = round(statistics.median(removed) * 1000, 3)
+
+    def f_search(keyword, narrowing):
+        if not narrowing: window._search_last = ("", None)
+        window.f_search(keyword)
+    search = bench_search(f_search, count, repeat)
+    window.f_search("")
+    window.close()
+    app.processEvents()
+    return result, search
+
+
+def run_size(args, count):
+    # Module : All benchmarks on one synthetic vault of count files, returns the result dict
+    workdir = tempfile.mkdtemp(prefix="vault_bench_", dir=args.workdir)
+    directory = os.path.join(workdir, "vault")
+    result = {"files": count}
+    try:
+        mix = {"image": args.images, "video": args.videos, "document": max(0.0, 1 - args.images - args.videos)}
+        f_log(str(count) + " files : samples")
+        samples = make_samples(workdir, args.seed)
+        f_log(str(count) + " files : build")
+        result["build_s"], _ = timed(lambda: build_vault(directory, count, samples, mix, args.seed))
+        result["build_s"] = round(result["build_s"], 3)
+        result["vault_mb"] = round(sum(os.path.getsize(os.path.join(directory, "data", f)) for f in os.listdir(os.path.join(directory, "data"))) / (1024*1024), 1)
+        result["peak_rss_mb"] = {"build": peak_rss()}
+
+        f_log(str(count) + " files : unlock")
+        seconds, _ = timed(lambda: derive_key(PASSWORD.encode('utf-8'), os.urandom(16)), args.repeat)
+        result["unlock"] = {"kdf_s": round(seconds, 4)}
+        seconds, vault = timed(lambda: Vault(directory).open(PASSWORD), args.repeat)
+        result["unlock"]["open_s"] = round(seconds, 4)
+        seconds, _ = timed(vault.load, args.repeat)
+        result["unlock"]["load_index_s"] = round(seconds, 4)
+        result["peak_rss_mb"]["unlock"] = peak_rss()
+
+        f_log(str(count) + " files : crypto")
+        result["crypto"] = bench_crypto(workdir, vault.keyring, args.payload_mb, args.repeat)
+        result["peak_rss_mb"]["crypto"] = peak_rss()
+
+        f_log(str(count) + " files : import / export")
+        small, big = make_sources(os.path.join(workdir, "sources"), samples, args.sample, args.payload_mb)
+        result.update(bench_bulk(vault, workdir, small, big, args.workers))
+        result["peak_rss_mb"]["bulk"] = peak_rss()
+
+        f_log(str(count) + " files : search")
+        result["search_index"] = bench_search(lambda keyword, narrowing: vault.search(keyword), count, args.repeat)
+        vault.close()
+
+        if not args.no_window:
+            f_log(str(count) + " files : startup")
+            result["startup"] = bench_startup(directory, args.repeat)
+            f_log(str(count) + " files : window")
+            result["window"], result["search_window"] = bench_window(directory, count, args.repeat)
+            result["peak_rss_mb"]["window"] = peak_rss()
+    finally:
+        if not args.keep: shutil.rmtree(workdir, ignore_errors=True)
+        else: f_log("kept " + workdir)
+    return result
+
+
+# Reports
+
+def flatten(result, prefix=""):
+    # {"a": {"b": 1}} -> {"a.b": 1}, numbers only
+    values = {}
+    for key, value in result.items():
+        if isinstance(value, dict): values.update(flatten(value, prefix + key + "."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool): values[prefix + key] = value
+    return values
+
+
+def compare(results, base):
+    # Side by side with an earlier run, per vault size
+    base = {entry["files"]: flatten(entry) for entry in base.get("results", [])}
+    for entry in results:
+        old = base.get(entry["files"])
+        if old is None: continue
+        print("\n" + str(entry["files"]) + " files")
+        for key, value in flatten(entry).items():
+            if key not in old or key == "files": continue
+            change = (value - old[key]) * 100 / old[key] if old[key] else 0.0
+            print("  %-40s %14s %14s %+8.1f%%" % (key, old[key], value, change))
+
+
+def environment():
+    versions = {"python": platform.python_version()}
+    for module in ("cryptography", "numpy", "cv2", "PyQt5.QtCore"):
+        try:
+            imported = __import__(module, fromlist=["_"])
+            versions[module] = getattr(imported, "__version__", None) or getattr(imported, "PYQT_VERSION_STR", None)
+        except ImportError:
+            versions[module] = None
+    return {"platform": platform.platform(), "machine": platform.machine(), "cpus": os.cpu_count(), "workers": engine.WORKERS, "versions": versions}
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="benchmark.py", description="VaultApp benchmarks on synthetic vaults")
+    parser.add_argument("--files", type=int, nargs="+", default=[1000], help="vault sizes to run (default : 1000)")
+    parser.add_argument("--images", type=float, default=0.6, help="share of images (default : 0.6)")
+    parser.add_argument("--videos", type=float, default=0.1, help="share of videos, the rest are documents (default : 0.1)")
+    parser.add_argument("--payload-mb", type=int, default=256, help="size of the throughput / per GB file (default : 256)")
+    parser.add_argument("--sample", type=int, default=100, help="small files imported and exported (default : 100)")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per timing, the median is kept (default : 3)")
+    parser.add_argument("--workers", type=int, default=engine.WORKERS, help="worker processes for import / export")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--workdir", default=None, help="where the synthetic vaults are built (default : temp folder)")
+    parser.add_argument("--keep", action="store_true", help="keep the synthetic vaults")
+    parser.add_argument("--no-window", action="store_true", help="skip the window benchmarks (no PyQt5 needed)")
+    parser.add_argument("-o", "--output", default="benchmark.json", help="JSON results (default : benchmark.json)")
+    parser.add_argument("--compare", help="earlier JSON results to compare with")
+    parser.add_argument("--child", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        # One vault size, run by the parent in a fresh process
+        result = run_size(args, args.child)
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(result, f)
+        return 0
+
+    results = []
+    for count in args.files:
+        f_log("vault of " + str(count) + " files")
+        fd, path = tempfile.mkstemp(suffix=".json")
+        os.close(fd)
+        command = [sys.executable, os.path.abspath(__file__), "--child", str(count), "--output", path,
+                   "--images", str(args.images), "--videos", str(args.videos), "--payload-mb", str(args.payload_mb), "--sample", str(args.sample),
+                   "--repeat", str(args.repeat), "--workers", str(args.workers), "--seed", str(args.seed)]
+        if args.workdir: command += ["--workdir", args.workdir]
+        if args.keep: command.append("--keep")
+        if args.no_window: command.append("--no-window")
+        try:
+            if subprocess.run(command).returncode != 0: raise SystemExit("Benchmark of " + str(count) + " files failed")
+            with open(path, 'r', encoding='utf-8') as f:
+                results.append(json.load(f))
+        finally:
+            os.remove(path)
+
+    report = {"version": 1, "created": datetime.datetime.now().isoformat(timespec="seconds"), "environment": environment(),
+              "settings": {key: value for key, value in vars(args).items() if key not in ("child", "output", "compare", "workdir", "keep")},
+              "results": results}
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=1)
+    print(json.dumps(results, indent=1))
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            compare(results, json.load(f))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
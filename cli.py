@@ -0,0 +1,203 @@
+"""
+VaultApp command line
+Bulk operations on a vault folder without the window, runs on a headless box (no PyQt5, OpenCV only for thumbnails).
+
+    python cli.py [-C FOLDER] list [CATEGORY]
+    python cli.py [-C FOLDER] search KEYWORD
+    python cli.py [-C FOLDER] import FILE [FILE ...]
+    python cli.py [-C FOLDER] export [--to FOLDER | --archive FILE.zip|FILE.tar] [NAME ...]
+    python cli.py [-C FOLDER] delete NAME [NAME ...]
+    python cli.py [-C FOLDER] cat NAME [--offset N] [--length N]
+    python cli.py [-C FOLDER] upgrade
+    python cli.py [-C FOLDER] scrub [--rate MB_S | --report]
+    python cli.py [-C FOLDER] passwd
+
+NAME is an original or an encrypted file name. The password is read from VAULT_PASSWORD or asked for,
+the new one for passwd from VAULT_NEW_PASSWORD.
+--trace FILE writes stage timings and counters as a Chrome trace (no file names or contents).
+"""
+
+import sys, os, argparse, getpass, datetime, signal, threading, multiprocessing
+from vault import Vault, WORKERS, TRACE, TRACE_FILE
+
+
+def f_progress(done, total):
+    # Progress on stderr, stdout stays clean for listings and cat
+    sys.stderr.write("\r  %3d%%  (%d / %d MB)" % (done*100//max(1, total), done//(1024*1024), total//(1024*1024)))
+    sys.stderr.flush()
+
+
+def f_done(message):
+    sys.stderr.write("\r" + message + " "*16 + "\n")
+
+
+def open_vault(directory, create=False):
+    vault = Vault(directory)
+    if not vault.exists() and not create:
+        raise SystemExit("No vault at " + os.path.abspath(directory))
+    password = os.environ.get("VAULT_PASSWORD")
+    if password is None:
+        password = getpass.getpass("Password : ")
+        if not vault.exists():
+            if len(password) < 6: raise SystemExit("Password must have at least 6 characters")
+            if getpass.getpass("Confirm password : ") != password: raise SystemExit("Passwords do not match")
+    try:vault.open(password)
+    except ValueError as e:raise SystemExit(str(e))
+    return vault
+
+
+def resolve(vault, names):
+    try:return vault.resolve(names)
+    except KeyError as e:raise SystemExit("Not in vault : " + e.args[0])
+
+
+def command_list(vault, args):
+    files = vault.search(args.keyword) if args.command == "search" else vault.list(args.category)
+    for _file in files:
+        record = vault.index.get(_file)
+        if record is None:
+            print("%s\t%s\t%s\t%s\t%s" % (_file, "other", "-", "-", "Database Error"))
+            continue
+        imported = datetime.datetime.fromtimestamp(record.imported).strftime("%Y-%m-%d") if record.imported else "-"
+        print("%s\t%s\t%d\t%s\t%s" % (_file, record.category, record.size, imported, record.name))
+
+
+def command_import(vault, args):
+    missing = [path for path in args.files if not os.path.isfile(path)]
+    if missing: raise SystemExit("Not a file : " + missing[0])
+    imported, failed, no_thumbnail = vault.import_files(args.files, f_progress, args.cancel, args.workers)
+    f_done("Imported " + str(len(imported)) + " of " + str(len(args.files)) + " file(s)")
+    for name, error in failed: print("Failed : " + name + " (" + error + ")", file=sys.stderr)
+    for name in no_thumbnail: print("No thumbnail : " + name, file=sys.stderr)
+    return 1 if failed else 0
+
+
+def command_export(vault, args):
+    files = resolve(vault, args.names) if args.names else vault.files()
+    if args.archive:
+        exported, errors = vault.export_archive(files, args.archive, f_progress, args.cancel)
+    else:
+        if not os.path.isdir(args.to): os.makedirs(args.to)
+        exported, errors = vault.export_files(files, args.to, f_progress, args.cancel, args.workers)
+    f_done("Exported " + str(len(exported)) + " of " + str(len(files)) + " file(s)")
+    for error in errors: print("Failed : " + error, file=sys.stderr)
+    if len(exported) != len(files):
+        print("Run the same export again to resume", file=sys.stderr)
+        return 1
+    if args.delete: vault.delete(exported)
+    return 0
+
+
+def command_delete(vault, args):
+    files = resolve(vault, args.names)
+    deleted = vault.delete(files)
+    # Reclaim segment space of the deleted files
+    vault.compact()
+    f_done("Deleted " + str(len(deleted)) + " of " + str(len(files)) + " file(s)")
+    return 0 if len(deleted) == len(files) else 1
+
+
+def command_cat(vault, args):
+    # Plaintext to stdout, decrypted chunk by chunk
+    _file = resolve(vault, [args.name])[0]
+    with vault.stream(_file) as stream:
+        stream.seek(args.offset)
+        left = args.length
+        while left is None or left > 0:
+            data = stream.read(1024*1024 if left is None else min(left, 1024*1024))
+            if not data: break
+            sys.stdout.buffer.write(data)
+            if left is not None: left -= len(data)
+    sys.stdout.buffer.flush()
+    return 0
+
+
+def command_upgrade(vault, args):
+    # Re-encrypt files under an older key or format, resumable
+    if not vault.needs_migration():
+        f_done("Nothing to upgrade")
+        return 0
+    errors = vault.migrate(f_progress, args.cancel, args.workers)
+    for error in errors: print("Failed : " + error, file=sys.stderr)
+    if vault.needs_migration():
+        f_done("Upgrade incomplete, run it again to resume")
+        return 1
+    f_done("Upgraded")
+    return 0
+
+
+def command_scrub(vault, args):
+    # Read back and authenticate every stored file, resumable, --report prints the last complete pass
+    if args.report:
+        report = vault.scrub_report()
+    else:
+        report = vault.scrub(f_progress, args.cancel, args.workers, args.rate*1024*1024)
+        if report is None:
+            f_done("Scrub incomplete, run it again to resume")
+            return 1
+        f_done("Scrub complete, " + str(len(report)) + " problem(s)")
+    for _file, problem in report:
+        print("%s\t%s" % (vault.name(_file) if _file in vault.index else _file, problem))
+    return 1 if report else 0
+
+
+def command_passwd(vault, args):
+    # Only the key file is rewritten
+    password = os.environ.get("VAULT_NEW_PASSWORD")
+    if password is None:
+        password = getpass.getpass("New password : ")
+        if getpass.getpass("Confirm password : ") != password: raise SystemExit("Passwords do not match")
+    if len(password) < 6: raise SystemExit("Password must have at least 6 characters")
+    try:vault.change_password(vault.password, password)
+    except ValueError as e:raise SystemExit(str(e))
+    f_done("Password changed")
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="cli.py", description="VaultApp command line")
+    parser.add_argument("-C", "--directory", default=os.getcwd(), help="folder holding the vault's data folder (default : current folder)")
+    parser.add_argument("-j", "--workers", type=int, default=WORKERS, help="worker processes for import / export")
+    parser.add_argument("--trace", metavar="FILE", default=TRACE_FILE or None, help="write stage timings and counters to FILE (Chrome trace format)")
+    commands = parser.add_subparsers(dest="command", required=True)
+    command = commands.add_parser("list", help="list files")
+    command.add_argument("category", nargs="?", default="all", choices=("all", "image", "video", "document", "other", "audio", "application", "compressed", "webpage"))
+    command = commands.add_parser("search", help="list files whose name contains KEYWORD")
+    command.add_argument("keyword")
+    command = commands.add_parser("import", help="encrypt files into the vault (creates the vault if needed)")
+    command.add_argument("files", nargs="+")
+    command = commands.add_parser("export", help="decrypt files (all by default), resumable")
+    target = command.add_mutually_exclusive_group()
+    target.add_argument("--to", default=os.getcwd(), help="folder to decrypt into (default : current folder)")
+    target.add_argument("--archive", help="single ZIP or TAR archive to write instead")
+    command.add_argument("--delete", action="store_true", help="remove the files from the vault once exported")
+    command.add_argument("names", nargs="*")
+    command = commands.add_parser("delete", help="remove files from the vault")
+    command.add_argument("names", nargs="+")
+    command = commands.add_parser("cat", help="write the plaintext of one file to stdout")
+    command.add_argument("name")
+    command.add_argument("--offset", type=int, default=0)
+    command.add_argument("--length", type=int, default=None)
+    commands.add_parser("upgrade", help="re-encrypt files written by older versions or under an older key")
+    command = commands.add_parser("scrub", help="verify every stored file against its authentication tags, resumable")
+    command.add_argument("--rate", type=float, default=0, metavar="MB_S", help="read at most MB_S megabytes per second (default : unthrottled)")
+    command.add_argument("--report", action="store_true", help="print the problems found by the last complete scrub")
+    commands.add_parser("passwd", help="change the vault password")
+    args = parser.parse_args(argv)
+
+    if args.trace: TRACE.enabled = True
+    vault = open_vault(args.directory, create=args.command == "import")
+    # Ctrl-C cancels a bulk job, files already done are committed / recorded in the export manifest
+    args.cancel = threading.Event()
+    if args.command in ("import", "export", "upgrade", "scrub"): signal.signal(signal.SIGINT, lambda signum, frame: args.cancel.set())
+    handler = {"list": command_list, "search": command_list, "import": command_import, "export": command_export,
+               "delete": command_delete, "cat": command_cat, "upgrade": command_upgrade, "scrub": command_scrub, "passwd": command_passwd}[args.command]
+    try:return handler(vault, args) or 0
+    finally:
+        vault.close()
+        if args.trace: TRACE.dump(args.trace)
+
+
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
+    sys.exit(main())
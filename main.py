@@ -1,10 +1,26 @@
 """
 VaultApp
-Version 0.1.21
+Version 0.1.22
 
 Author: Malaka D.Gunawardana.
 
 Release Notes:
+- Version 0.1.22
+    - Master key derived once per session, per-file subkeys (HKDF)
+    - Upgrade path for vaults created by older versions
+    - Chunked, authenticated file format (VAULTv3) with range reads, older files stay readable
+    - Video playback in the preview window, decrypted on demand (no plaintext on disk)
+    - Thumbnails stored in a few encrypted pack files instead of one file per item
+    - Preview window with previous / next, neighbours decoded ahead
+    - Vault engine (vault.py) separated from the window, command line for bulk jobs (cli.py)
+    - Opt-in performance tracing with a live stats panel (Ctrl+Shift+S)
+    - Faster start : OpenCV / numpy / crypto load on first use, generated forms cached, dialogs reused
+    - Random data keys wrapped by the password : changing the password rewrites only the key file, old keys retired by a resumable background upgrade
+    - Small files packed into large segment files, large ones in sharded blob folders, deleted space reclaimed in the background
+    - Identical content stored once : importing a file already in the vault costs a hash pass and no disk space
+    - Documents and other compressible files compressed before encryption, photos and videos stored as they are
+    - Grid updated in place : imports, deletes and tab changes touch only the affected tiles, changes made by cli.py show up live
+    - Background integrity check : every stored file re-read and authenticated about once a week at a low rate, resumed after a restart, damaged, missing and stray files reported
 - Version 0.1.21 (2023/12/10)
     - UI fix and improvements
     - Bug fix
@@ -16,17 +32,12 @@ For Updates and Contributions:
 Report issues or contribute to the development. :)
 """
 
-import sys, os, io, secrets, datetime
-import cv2
-import numpy as np
-from PyQt5 import uic
-from PyQt5.QtWidgets import QApplication, QMainWindow, QLabel, QFileDialog, QLineEdit, QDialog, QCheckBox
-from PyQt5.QtGui import QPixmap, QImage, QIcon
-from PyQt5.QtCore import Qt, QByteArray
-from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
-from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+import sys, os, io, zlib, datetime, time, multiprocessing, threading
+from PyQt5 import QtWidgets
+from PyQt5.QtWidgets import QApplication, QMainWindow, QFileDialog, QLineEdit, QDialog, QStyledItemDelegate, QStyleOptionButton, QStyle, QShortcut
+from PyQt5.QtGui import QPixmap, QImage, QIcon, QPainter, QPainterPath, QColor, QLinearGradient, QKeySequence
+from PyQt5.QtCore import Qt, QByteArray, QObject, QRunnable, QThreadPool, QThread, QTimer, QFileSystemWatcher, pyqtSignal, QAbstractListModel, QModelIndex, QEvent, QRect, QRectF, QSize
+from vault import Vault, SyS_Index, SyS_VaultStream, decrypt_bytes, read_thumbnails, image_size, decode_flag, fit_frame, preload, TRACE, TRACE_FILE
 
 
 def resource_path(relative_path):
@@ -35,52 +46,221 @@ def resource_path(relative_path):
     return os.path.join(base_path, relative_path)
 
 
+# UI forms
+
+UI_CACHE = resource_path("ui/__uicache__")     # Generated form classes, rebuilt when their .ui file changes
+
+_ui_forms = {}
+
+
+def load_ui(name, widget=None):
+    """ Set up widget (or a new one of the form's base class) from ui/<name>.ui, like uic.loadUi without parsing XML on every start """
+    form = _ui_forms.get(name)
+    if form is None: form = _ui_forms[name] = _ui_form(name)
+    form_class, base = form
+    if widget is None: widget = getattr(QtWidgets, base)()
+    ui = form_class()
+    ui.setupUi(widget)
+    # Named children become attributes of the widget, as with uic.loadUi
+    for key, value in vars(ui).items(): setattr(widget, key, value)
+    return widget
+
+
+def _ui_form(name):
+    # Module : Generated class of one .ui file, from the cache or compiled once by uic (imported only then)
+    source = resource_path("ui/" + name + ".ui")
+    with open(source, 'rb') as f:
+        stamp = "# ui %08x\n" % zlib.crc32(f.read())
+    cached = os.path.join(UI_CACHE, name + ".py")
+    code = None
+    try:
+        with open(cached, 'r', encoding='utf-8') as f:
+            if f.readline() == stamp: code = f.read()
+    except OSError:pass
+    if code is None:
+        from PyQt5 import uic
+        from xml.etree import ElementTree
+        out = io.StringIO()
+        # Tab indented, pyuic turns tabs inside strings into spaces otherwise
+        uic.compileUi(source, out, indent=0)
+        code = out.getvalue() + "\nBASE = %r\n" % ElementTree.parse(source).getroot().find("widget").get("class")
+        # Kept for the next start, a read-only install just compiles again
+        try:
+            os.makedirs(UI_CACHE, exist_ok=True)
+            with open(cached + ".tmp", 'w', encoding='utf-8') as f:
+                f.write(stamp + code)
+            os.replace(cached + ".tmp", cached)
+        except OSError:pass
+    namespace = {}
+    exec(compile(code, cached, "exec"), namespace)
+    form_class = next(value for key, value in namespace.items() if key.startswith("Ui_"))
+    return form_class, namespace["BASE"]
+
+
+# Image cache
+
+THUMBNAIL_CACHE_BYTES = int(os.environ.get("VAULT_THUMBNAIL_CACHE_MB", "64")) * 1024*1024      # Decoded grid thumbnails kept for the session
+PREVIEW_CACHE_BYTES = int(os.environ.get("VAULT_PREVIEW_CACHE_MB", "256")) * 1024*1024         # Decoded previews kept for the session (also bounds prefetching)
+PREVIEW_PREFETCH = int(os.environ.get("VAULT_PREVIEW_PREFETCH", "2"))                           # Neighbours decoded ahead on each side of the shown preview
+SYNC_DELAY = 300                        # ms without further changes on disk before the vault is checked for changes of another process
+
+
+class SyS_ImageCache:
+    """ Decoded images keyed by encrypted file name, the least recently used go first once over budget """
+    def __init__(self, budget):
+        self.budget = budget
+        self.items = {}         # file -> (value, cost), in use order
+        self.used = 0
+
+    @staticmethod
+    def cost(pixmap):
+        return pixmap.width() * pixmap.height() * 4
+
+    def __contains__(self, file):
+        return file in self.items
+
+    def get(self, file):
+        item = self.items.pop(file, None)
+        if item is None: return None
+        self.items[file] = item
+        return item[0]
+
+    def put(self, file, value, cost):
+        self.discard(file)
+        if cost > self.budget: return
+        self.items[file] = (value, cost)
+        self.used += cost
+        while self.used > self.budget:
+            self.discard(next(iter(self.items)))
+
+    def discard(self, file):
+        item = self.items.pop(file, None)
+        if item is not None: self.used -= item[1]
+
+    def clear(self):
+        self.items, self.used = {}, 0
+
+
 # Main Window
 
 class VaultApp(QMainWindow):
     def __init__(self):
         super(VaultApp, self).__init__()
         # Setup UI
-        uic.loadUi(resource_path('ui/window_main.ui'), self)
+        load_ui('window_main', self)
         self.setWindowTitle("Vault " + App_version)
         self.setWindowIcon(QIcon(resource_path("./ui/icon.png")))
         self.btn_refresh.clicked.connect(lambda: self.SyS_refresh(ask_password=False))
         self.btn_import_files.clicked.connect(self.import_files)
         self.btn_about.clicked.connect(self.f_btn_about)
         self.btn_delete_files.clicked.connect(self.f_btn_delete_files)
-        self.input_search.textChanged.connect(lambda: self.f_search(self.input_search.text()))
-
-        self.tab_btn_all.clicked.connect(lambda: self.SyS_refresh(ask_password=False,category="all"))
-        self.tab_btn_images.clicked.connect(lambda: self.SyS_refresh(ask_password=False,category="image"))
-        self.tab_btn_videos.clicked.connect(lambda: self.SyS_refresh(ask_password=False,category="video"))
-        self.tab_btn_documents.clicked.connect(lambda: self.SyS_refresh(ask_password=False,category="document"))
-        self.tab_btn_other.clicked.connect(lambda: self.SyS_refresh(ask_password=False,category="other"))
+        self.btn_decrypt_files.clicked.connect(self.f_btn_export)
+        self.btn_password.clicked.connect(self.f_btn_password)
+
+        # Search, re-rendered once typing pauses
+        self.search_timer = QTimer(self)
+        self.search_timer.setSingleShot(True)
+        self.search_timer.setInterval(150)
+        self.search_timer.timeout.connect(lambda: self.f_search(self.input_search.text()))
+        self.input_search.textChanged.connect(self.search_timer.start)
+        self._search_last = ("", None)
+
+        self.tab_btn_all.clicked.connect(lambda: self.f_show_category("all"))
+        self.tab_btn_images.clicked.connect(lambda: self.f_show_category("image"))
+        self.tab_btn_videos.clicked.connect(lambda: self.f_show_category("video"))
+        self.tab_btn_documents.clicked.connect(lambda: self.f_show_category("document"))
+        self.tab_btn_other.clicked.connect(lambda: self.f_show_category("other"))
+
+        # File grid (model/view, only visible tiles are painted)
+        self.grid_model = SyS_FileGridModel(self)
+        self.grid_model.selection_changed.connect(lambda count: self.btn_delete_files.setEnabled(count != 0))
+        self.grid_delegate = SyS_FileGridDelegate(self.grid_view)
+        self.grid_delegate.preview_requested.connect(self.f_open_preview)
+        self.grid_view.setModel(self.grid_model)
+        self.grid_view.setItemDelegate(self.grid_delegate)
+        self.grid_view.setStyleSheet(self.grid_view.styleSheet() + """
+                                                QScrollBar {border: 1px solid #252525;background: #191919;border-radius: 5px;}
+                                                QScrollBar:horizontal {height: 15px;margin: 0px 0px 0px 32px;}
+                                                QScrollBar:vertical {width: 15px;margin: 32px 0px 0px 0px;}
+                                                QScrollBar::handle {background: #252525;border: 1px solid #252525;border-radius: 4px;}
+                                                QScrollBar::handle:horizontal {border-width: 0px 1px 0px 1px;}
+                                                QScrollBar::handle:vertical {border-width: 1px 0px 1px 0px;}
+                                                QScrollBar::handle:horizontal {min-width: 20px;}
+                                                QScrollBar::handle:vertical {min-height: 20px;}
+                                                QScrollBar::add-line, QScrollBar::sub-line {background:#252525;border: 1px solid #252525;subcontrol-origin: margin;border-radius: 4px;}
+                                                QScrollBar::add-line {position: absolute;}
+                                                QScrollBar::add-line:horizontal {width: 15px;subcontrol-position: left;left: 15px;}
+                                                QScrollBar::add-line:vertical {height: 15px;subcontrol-position: top;top: 15px;}
+                                                QScrollBar::sub-line:horizontal {width: 15px;subcontrol-position: top left;}
+                                                QScrollBar::sub-line:vertical {height: 15px;subcontrol-position: top;}
+                                                QScrollBar:left-arrow, QScrollBar::right-arrow, QScrollBar::up-arrow, QScrollBar::down-arrow {border: 1px solid #5A5A5A;width: 3px;height: 3px;}
+                                                QScrollBar::add-page, QScrollBar::sub-page {background: none;}""")
 
+        # Thumbnail workers
+        self.thumbnail_pool = QThreadPool()
+        self.thumbnail_signals = SyS_ThumbnailSignals()
+        self.thumbnail_signals.finished.connect(self.f_thumbnail_ready)
+        self.thumbnail_signals.migrated.connect(self.f_thumbnail_migrate)
+        self.grid_view.verticalScrollBar().valueChanged.connect(self.f_request_thumbnails)
+        self.grid_generation = 0
+        self._thumbnail_jobs = {}
+
+        # Decoded images, kept across refreshes until the vault locks
+        self.thumbnail_cache = SyS_ImageCache(THUMBNAIL_CACHE_BYTES)
+        self.preview_cache = SyS_ImageCache(PREVIEW_CACHE_BYTES)
+
+        # Bulk jobs
+        self.import_task = None
+        self.export_task = None
+        self.migrate_task = None
+        self.compact_task = None
+        self.scrub_task = None
+
+        # Changes on disk by another process (cli.py, files put into the data folder), checked once writes settle
+        self.watcher = None
+        self.sync_timer = QTimer(self)
+        self.sync_timer.setSingleShot(True)
+        self.sync_timer.setInterval(SYNC_DELAY)
+        self.sync_timer.timeout.connect(self.f_sync_vault)
+        self._sync_folder = False
+
+        # Preview window, created on first use and reused
+        self.preview_window = None
+        self._preview_row, self._preview_entry = 0, None
+        self.preview_pool = QThreadPool()
+        self.preview_pool.setMaxThreadCount(2)
+        self.preview_signals = SyS_PreviewSignals()
+        self.preview_signals.ready.connect(self.f_preview_ready)
+        self._preview_jobs = {}
+
+        # Video preview, streamed from the encrypted file
+        self.video_task = None
+
+        # Performance stats (Ctrl+Shift+S), tracing is off until started there or by VAULT_TRACE
+        self.stats_dialog = None
+        QShortcut(QKeySequence("Ctrl+Shift+S"), self).activated.connect(self.f_show_stats)
 
         self.show()
         self.load_files()
 
     def load_files(self, ask_password=True, refresh=False, category="all"):
-        global directory_path_data, directory_path, password, config_path, current_view
-        global _encfileNames, _orfileNames, _selected_items, _files
+        global current_view, _files
 
-        config_path = os.path.join(directory_path, "data", "config.bin")
-        _selected_items = []
         current_view = category
+        self._search_last = ("", None)
         self.btn_delete_files.setEnabled(False)
 
-        # Scan data folder and get a list of image files in the directory
-        _files = [f for f in os.listdir(directory_path_data) if f.lower().endswith(('.enc'))]
-
         # Input password
         if ask_password:
-            if os.path.exists(config_path): 
+            if vault.exists(): 
                 msg="Enter your password :"
                 password_confirm = False
             else: 
                 msg="Create a new password : (Min 6 characters)"
                 password_confirm = True
-            custom_input_dialog = SyS_InputDialog(title="Input Password", msg=msg, ispassword=True, password_confirm=password_confirm)
+            custom_input_dialog = SyS_dialog(SyS_InputDialog, title="Input Password", msg=msg, ispassword=True, password_confirm=password_confirm)
+            # The crypto backend loads while the password is typed
+            threading.Thread(target=preload, daemon=True).start()
 
             result = custom_input_dialog.exec_()
             if result == QDialog.Accepted:
@@ -88,158 +268,228 @@ class VaultApp(QMainWindow):
                     password = custom_input_dialog.input.text()
                 else:exit()
             else:exit()
-        
-
-        # Get orginal file names
-        _encfileNames, _orfileNames = self.SyS_load_config()
 
-        if first_run:
-            custom_input_dialog = SyS_InfoDialog(title="Welcome", msg="  To remove this vault, please proceed by deleting\n  the associated data folder.").exec_()
+            # Module : Derive the master key once for this session and read the index
+            self.f_clear_caches()
+            try:vault.open(password)
+            except ValueError as e:
+                # UI : the reason, unless it is the password
+                msg = "  Incorrect password.\n  The app will exit now." if str(e) == "Incorrect password" else "  " + str(e) + "."
+                dialog = SyS_dialog(SyS_InfoDialog, title="Error !", msg=msg)
+                _ = dialog.exec_()
+                exit()
+
+        # Offer to upgrade files written before the key hierarchy or under an older key
+        if ask_password and vault.needs_migration(): self.SyS_migrate_files()
+        # Space of files deleted in an earlier session
+        if ask_password: self.SyS_compact_segments()
+        # Verify stored files now and then, read at a low rate
+        if ask_password and self.migrate_task is None and vault.needs_scrub(): self.SyS_scrub_vault()
+
+        if ask_password and vault.created:
+            custom_input_dialog = SyS_dialog(SyS_InfoDialog, title="Welcome", msg="  To remove this vault, please proceed by deleting\n  the associated data folder.").exec_()
             self.f_btn_about()
 
+        if ask_password: self.f_watch_vault()
+        # Refresh : pick up what other processes changed, unless a task of this window uses the index
+        elif not self.f_busy():
+            try:vault.sync(folder=True)
+            except Exception:pass
 
-        if not refresh: self.btn_decrypt_files.clicked.connect(lambda: self.export_files(_files=[], ask_permission=True, all_files=True))
+        # Get a list of encrypted files from the index
+        with TRACE.span("refresh.list"):_files = vault.files()
 
         # Process files
         self.f_GUI_grid_manager(_files, category)
 
     def f_GUI_grid_manager(self, _files, category):
+        with TRACE.span("refresh.grid"):self.SyS_grid_rows(_files, category)
+        # Start thumbnail jobs once the view has its geometry
+        QTimer.singleShot(0, self.f_request_thumbnails)
+
+    def SyS_grid_rows(self, _files, category):
 
         self.progress_bar.setVisible(True)
 
-        # Clear existing widgets
-        for i in reversed(range(self.grid_layout.count())):
-            self.grid_layout.itemAt(i).widget().setParent(None)
+        # Drop thumbnail jobs of the previous grid
+        self.f_cancel_thumbnails()
 
         # Process files
-        row,col,progress = 1,0,0
-        if len(_files) != 0:
-            for _file in _files:
-                try: 
-                    # Get file type and id
-                    id = _encfileNames.index(_file)
-                    _file_ext = _orfileNames[id].split(".")[-1]
-                    _orfilename = _orfileNames[id]
-                except ValueError:
-                    # Exception : Encrypted file found at data folder but not present in the database
-                    _file_ext = "file"
-                    _orfilename = "Database Error"
-
-                # UI
-                self.progress_bar.setValue(progress)
-                progress += int(100/len(_files))
+        _rows = [row for row in map(self.f_grid_row, _files) if category == row.type or category == "all"]
 
-                # Get file path and type
-                file_path = os.path.join(directory_path_data, _file)
-                _file_type = self.SyS_filetype(_file_ext).lower()
+        # Tiles are created by the view on demand
+        self.grid_model.set_rows(_rows)
+        self.grid_view.scrollToTop()
 
-                if category == _file_type or category == "all":
-                    None
-                else:
-                    continue
-
-                # Create a QLabel for each file
-                image_label = QLabel(self)
-                image_label.setAlignment(Qt.AlignCenter)
-
-                if (_file_type == "image") or (_file_type == "video"):
-                    # Load and display the image in the QLabel
-                    try:
-                        data = self.decrypt_data(file_path+".dat", None, password, False)
-                        qimage = QImage.fromData(QByteArray(data))
-                        # Convert QImage to QPixmap
-                        pixmap = QPixmap.fromImage(qimage)
-                    except:
-                        # Exception : Encrypted image file found at database but cannot read data thumbnail
-                        pixmap = QPixmap(resource_path("./ui/error.png"))
-                else:
-                    # UI
-                    if _orfilename == "Database Error":pixmap = QPixmap(resource_path("./ui/error.png"))
-                    else:pixmap = QPixmap(resource_path("./ui/other.png"))
-
-                # Fix width and height
-                if pixmap.width() > pixmap.height():pixmap = pixmap.scaledToWidth(200, Qt.SmoothTransformation)
-                else:pixmap = pixmap.scaledToHeight(200, Qt.SmoothTransformation)
-
-                # Image label
-                image_label.setPixmap(pixmap)
-                image_label.setMinimumHeight(200)
-                image_label.setStyleSheet("QLabel{background-color: rgb(25, 25, 25);border-radius: 8px;}")
-
-                # File name
-                name_label = QLabel(self)
-                name_label.setAlignment(Qt.AlignmentFlag.AlignBottom)  # Align Bottom
-
-                # Prepare the name label text
-                if len(_orfilename) > 25: text_name_label = _orfilename[:15] + "...." + _orfilename.split(".")[0][-5:] + "." + _file_ext
-                else: text_name_label = _orfilename
-                name_label.setText("      " + text_name_label)
-                name_label.setStyleSheet("""QLabel{color: rgb(200, 200, 200);
-                                            background-color: qlineargradient(spread:pad, x1:1, y1:0, x2:1, y2:1, stop:0 rgba(255, 255, 255, 0), stop:0.823864 rgba(41, 41, 41, 0), stop:1 rgba(0, 0, 0, 255));}""")
-                name_label.setMinimumHeight(200)
-                name_label.setMinimumWidth(200)
-                name_label.setToolTip("Open : " + str(_orfilename))
-
-                # Checkbox
-                image_chkbox = QCheckBox()
-                image_chkbox.setStyleSheet("""background-color: rgba(0, 0, 0, 0);""")
-                image_chkbox.setText("")
-
-                # Connect the image label to the correct method
-                name_label.mousePressEvent = lambda event, path=file_path, file=_file, name=_orfilename, type=_file_type: self.SyS_preview_window(path, file, name, type)
-                image_chkbox.stateChanged.connect(lambda state, path=file_path, file=_file, name=_orfilename, :  self.f_checkbox_changed(path, file, name))
-
-                # Add elements to the grid layout
-                self.grid_layout.addWidget(image_label, row, col)
-                self.grid_layout.addWidget(name_label, row, col)
-                self.grid_layout.addWidget(image_chkbox, row, col, alignment=Qt.AlignmentFlag.AlignBottom)
-                col += 1
-                if col == 4:
-                    col = 0
-                    row += 1
-                    
-        # Fix grid errors for low content
-        if int(self.grid_layout.count()/3) <= 16:
-            for i in range(16-int(self.grid_layout.count()/3)):
-                dummy_label = QLabel(self)
-                dummy_label.setMinimumHeight(200)
-                dummy_label.setMinimumWidth(200)
-                dummy_label.setStyleSheet("""background-color: rgba(0, 0, 0, 0);""")
-                self.grid_layout.addWidget(dummy_label, row, col)
-                col += 1
-                if col == 4:
-                    col = 0
-                    row += 1
         # UI
         self.progress_bar.setVisible(False)
         self.f_update_tabs(category)
-        self.scroll_area_all.setStyleSheet("""  QScrollBar {border: 1px solid #252525;background: #191919;border-radius: 5px;}
-                                                QScrollBar:horizontal {height: 15px;margin: 0px 0px 0px 32px;}
-                                                QScrollBar:vertical {width: 15px;margin: 32px 0px 0px 0px;}
-                                                QScrollBar::handle {background: #252525;border: 1px solid #252525;border-radius: 4px;}
-                                                QScrollBar::handle:horizontal {border-width: 0px 1px 0px 1px;}
-                                                QScrollBar::handle:vertical {border-width: 1px 0px 1px 0px;}
-                                                QScrollBar::handle:horizontal {min-width: 20px;}
-                                                QScrollBar::handle:vertical {min-height: 20px;}
-                                                QScrollBar::add-line, QScrollBar::sub-line {background:#252525;border: 1px solid #252525;subcontrol-origin: margin;border-radius: 4px;}
-                                                QScrollBar::add-line {position: absolute;}
-                                                QScrollBar::add-line:horizontal {width: 15px;subcontrol-position: left;left: 15px;}
-                                                QScrollBar::add-line:vertical {height: 15px;subcontrol-position: top;top: 15px;}
-                                                QScrollBar::sub-line:horizontal {width: 15px;subcontrol-position: top left;}
-                                                QScrollBar::sub-line:vertical {height: 15px;subcontrol-position: top;}
-                                                QScrollBar:left-arrow, QScrollBar::right-arrow, QScrollBar::up-arrow, QScrollBar::down-arrow {border: 1px solid #5A5A5A;width: 3px;height: 3px;}
-                                                QScrollBar::add-page, QScrollBar::sub-page {background: none;}""")
+
+    def f_grid_row(self, _file):
+        record = vault.index.get(_file)
+        if record is not None:
+            return SyS_FileGridModel.Row(_file, record.name, record.ext, record.category)
+        # Exception : Encrypted file found at data folder but not present in the database
+        return SyS_FileGridModel.Row(_file, "Database Error", "file", "other")
+
+    def f_show_category(self, category):
+        # Tab change : filter the files already listed, nothing is read from disk
+        global current_view
+        current_view = category
+        self._search_last = ("", None)
+        self.f_GUI_grid_manager(_files, category)
+
+    def f_files_added(self, files):
+        # Tiles of new files go after the others (import order), the rest of the grid is left alone
+        global _files
+        _files += files
+        keyword, results = self._search_last
+        if keyword:
+            matches = vault.search(keyword, files)
+            results += matches
+            files = matches
+        self.grid_model.append_rows([row for row in map(self.f_grid_row, files) if current_view == row.type or current_view == "all"])
+        self.f_request_thumbnails()
+
+    def f_files_removed(self, files):
+        # Only the tiles of these files go, decoded images of the others stay
+        global _files
+        gone = set(files)
+        if not gone: return
+        _files = [f for f in _files if f not in gone]
+        keyword, results = self._search_last
+        if keyword: self._search_last = (keyword, [f for f in results if f not in gone])
+        self.grid_model.remove_files(gone)
+        if self.preview_window is not None and self._preview_entry is not None:
+            # The shown file went, or moved up
+            if self._preview_entry.file in gone: self.preview_window.close()
+            else: self._preview_row = self.grid_model.positions.get(self._preview_entry.file, 0)
+        self.f_request_thumbnails()
+
+    def f_busy(self):
+        # A task of this window has the index or the segments in use
+        return self.import_task is not None or self.migrate_task is not None or self.compact_task is not None
+
+    def f_watch_vault(self):
+        # Module : Watch the data folder and the journal, once per unlock
+        if self.watcher is None:
+            self.watcher = QFileSystemWatcher(self)
+            self.watcher.directoryChanged.connect(self.f_vault_changed)
+            self.watcher.fileChanged.connect(self.f_vault_changed)
+        if self.watcher.files() or self.watcher.directories(): self.watcher.removePaths(self.watcher.files() + self.watcher.directories())
+        self.watcher.addPaths([vault.data, vault.journal_path])
+
+    def f_vault_changed(self, path):
+        # Writes of this window come through here too, sync() finds nothing new in them
+        if path == vault.data: self._sync_folder = True
+        # A journal replaced by a new snapshot drops out of the watch
+        if vault.journal_path not in self.watcher.files() and os.path.exists(vault.journal_path): self.watcher.addPath(vault.journal_path)
+        self.sync_timer.start()
+
+    def f_sync_vault(self):
+        # Module : Apply changes of another process, only the tiles of added or removed files change
+        if vault.index is None: return
+        if self.f_busy():
+            # Checked again once the task is done with the index
+            self.sync_timer.start()
+            return
+        folder, self._sync_folder = self._sync_folder, False
+        try:
+            if not vault.sync(folder): return
+        except Exception:return
+        listed, files = set(_files), vault.files()
+        current = set(files)
+        removed = [f for f in _files if f not in current]
+        self.f_clear_caches(removed)
+        self.f_files_removed(removed)
+        self.f_files_added([f for f in files if f not in listed])
+
+    def f_visible_rows(self, margin=1):
+        # Rows on screen (plus margin screens above and below), from the fixed grid size
+        if self.grid_model.rowCount() == 0: return range(0)
+        grid = self.grid_view.gridSize()
+        viewport = self.grid_view.viewport()
+        columns = max(1, viewport.width() // grid.width())
+        lines = viewport.height() // grid.height() + 1
+        first_line = max(0, -self.grid_view.visualRect(self.grid_model.index(0)).top() // grid.height())
+        first = max(0, (first_line - margin*lines) * columns)
+        last = min(self.grid_model.rowCount(), (first_line + (margin+1)*lines + 1) * columns)
+        return range(first, last)
+
+    def f_request_thumbnails(self, *args):
+        # Queue jobs for tiles near the viewport, cancel queued jobs that scrolled away
+        if not self.isVisible(): return
+        visible = self.f_visible_rows()
+        for file in list(self._thumbnail_jobs):
+            job = self._thumbnail_jobs.get(file)
+            if job is not None and self.grid_model.positions.get(file) not in visible and self.thumbnail_pool.tryTake(job):
+                for taken in job.rows: self._thumbnail_jobs.pop(taken[0], None)
+        # Keep decoded thumbnails for a few screens only
+        self.grid_model.drop_thumbnails(self.f_visible_rows(margin=4))
+        # One job per page, its packed thumbnails are read in one batch
+        rows = []
+        for row in visible:
+            entry = self.grid_model.rows[row]
+            if entry.file in self._thumbnail_jobs or not self.grid_model.needs_thumbnail(row): continue
+            cached = self.thumbnail_cache.get(entry.file)
+            TRACE.count("cache.thumbnail.miss" if cached is None else "cache.thumbnail.hit")
+            if cached is not None:
+                self.grid_model.set_thumbnail(entry.file, cached)
+                continue
+            record = vault.index.get(entry.file)
+            rows.append((entry.file, vault.path(entry.file), record.thumbnail if record is not None else False))
+        if not rows: return
+        job = SyS_ThumbnailJob(self, rows, self.grid_generation)
+        for row in rows: self._thumbnail_jobs[row[0]] = job
+        self.thumbnail_pool.start(job)
+
+    def f_cancel_thumbnails(self):
+        # Stale jobs are dropped by generation, queued ones are removed from the pool
+        self.grid_generation += 1
+        for job in set(self._thumbnail_jobs.values()):
+            job.cancelled = True
+            self.thumbnail_pool.tryTake(job)
+        self._thumbnail_jobs = {}
+
+    def f_thumbnail_ready(self, generation, file, qimage):
+        if generation != self.grid_generation: return
+        self._thumbnail_jobs.pop(file, None)
+        if qimage.isNull():
+            # Exception : Encrypted image file found at database but cannot read data thumbnail
+            self.grid_model.set_thumbnail(file, self.grid_model.error)
+            return
+        pixmap = QPixmap.fromImage(qimage)
+        self.thumbnail_cache.put(file, pixmap, SyS_ImageCache.cost(pixmap))
+        self.grid_model.set_thumbnail(file, pixmap)
+
+    def f_clear_caches(self, files=None):
+        # Drop decoded images of some files (deleted, re-imported) or of all (vault locked)
+        if files is None:
+            self.thumbnail_cache.clear()
+            self.preview_cache.clear()
+            return
+        for file in files:
+            self.thumbnail_cache.discard(file)
+            self.preview_cache.discard(file)
+
+    def f_thumbnail_migrate(self, items):
+        # Module : Move legacy thumbnail files shown by a job into a pack, one journal record per page
+        vault.pack_thumbnails(items)
+
+    def f_open_preview(self, index):
+        self.SyS_preview_window(index.row())
 
     def f_search(self, keyword):
         if keyword == "":
+            self._search_last = ("", None)
             self.f_GUI_grid_manager(_files, category=current_view)
             return
 
-        _search_results = []
-        for _name in _orfileNames:
-            if keyword.lower() in _name.lower():
-                id = _orfileNames.index(_name)
-                _search_results.append(_encfileNames[id])
+        # A longer query only narrows the previous results
+        last_keyword, last_results = self._search_last
+        within = last_results if last_keyword and SyS_Index.normalize(last_keyword) in SyS_Index.normalize(keyword) else None
+        _search_results = vault.search(keyword, within)
+        self._search_last = (keyword, _search_results)
         self.f_GUI_grid_manager(_search_results, category=current_view)
 
     def f_update_tabs(self, category, search=False):
@@ -257,321 +507,351 @@ class VaultApp(QMainWindow):
 
     def f_btn_delete_files(self):
         # function of btn_delete_files
-        self.SyS_delete_files(_selected_items, ask_permission=True)
+        self.SyS_delete_files(self.grid_model.selected_files(), ask_permission=True)
+
+    def f_show_stats(self):
+        # Live stats panel, created on first use and reused
+        if self.stats_dialog is None: self.stats_dialog = SyS_StatsDialog(self)
+        self.stats_dialog.show()
+        self.stats_dialog.raise_()
 
     def f_btn_about(self):
         # function of btn_about
-        dialog = SyS_AboutDialog()
+        dialog = SyS_dialog(SyS_AboutDialog)
         _ = dialog.exec_()
         del dialog, _
 
-    def f_checkbox_changed(self, path, file, name):
-        # Handle selected files
-        if file not in _selected_items:_selected_items.append(file)
-        else:_selected_items.remove(file)
-        if len(_selected_items) != 0: self.btn_delete_files.setEnabled(True)
-        else: self.btn_delete_files.setEnabled(False)
-
-    def SyS_preview_window(self, path, file, name, type):
-        # Display the selected image in a new window
-        self.preview_window = uic.loadUi(resource_path('ui/window_preview.ui'))
-        self.preview_window.setWindowTitle("Vault " + App_version + " : " + name)
-        self.preview_window.setWindowIcon(QIcon(resource_path("./ui/icon.png")))
+    def SyS_preview_window(self, row):
+        # Display one grid row in the preview window (created once, then reused)
+        self.f_stop_video()
+        if row < 0 or row >= len(self.grid_model.rows): return
+        entry = self.grid_model.rows[row]
+        self._preview_row, self._preview_entry = row, entry
+        if self.preview_window is None:
+            self.preview_window = load_ui('window_preview')
+            self.preview_window.installEventFilter(self)
+            self.preview_window.setWindowIcon(QIcon(resource_path("./ui/icon.png")))
+            self.preview_window.btn_decrypt.clicked.connect(lambda: self.export_files([self._preview_entry.file]))
+            self.preview_window.btn_delete.clicked.connect(lambda: self.SyS_delete_files([self._preview_entry.file], ask_permission=True))
+            self.preview_window.btn_play.clicked.connect(self.f_video_toggle)
+            self.preview_window.video_slider.sliderReleased.connect(self.f_video_seek)
+            self.preview_window.btn_prev.clicked.connect(lambda: self.SyS_preview_window(self._preview_row - 1))
+            self.preview_window.btn_next.clicked.connect(lambda: self.SyS_preview_window(self._preview_row + 1))
+        self.preview_window.setWindowTitle("Vault " + App_version + " : " + entry.name)
 
         # Check the file catagory
-        if (type == "image"):
-            try:
-                # Decrypt image data
-                data = self.decrypt_data(path, None, password, False, progressbar=True)
-                nparr = np.frombuffer(data, np.uint8)
-                image = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-                image_rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-                h, w, ch = image_rgb.shape
-                bytes_per_line = ch * w
-                q_image = QImage(image_rgb.data, w, h, bytes_per_line, QImage.Format_RGB888)
-                # Convert QImage to QPixmap
-                pixmap = QPixmap.fromImage(q_image)
-                self.preview_window.lb_dimensions_2.setText(": " + str(pixmap.width()) + " X "+ str(pixmap.height()))
-                # Fix width and height
-                if pixmap.width() > pixmap.height():pixmap = pixmap.scaledToWidth(800, Qt.SmoothTransformation)
-                else:pixmap = pixmap.scaledToHeight(800, Qt.SmoothTransformation)
-            except:
-                # Exception : Encrypted image file found at data folder but cannot read
-                pixmap = QPixmap(resource_path("./ui/error.png"))
-        elif (type == "video"):
-            try:
-                # Decrypt image data
-                data = self.decrypt_data(path+".dat", None, password, False, progressbar=True)
-                nparr = np.frombuffer(data, np.uint8)
-                image = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-                image_rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-                h, w, ch = image_rgb.shape
-                bytes_per_line = ch * w
-                q_image = QImage(image_rgb.data, w, h, bytes_per_line, QImage.Format_RGB888)
-                # Convert QImage to QPixmap
-                pixmap = QPixmap.fromImage(q_image)
-                self.preview_window.lb_dimensions_2.setText(": " + str(pixmap.width()) + " X "+ str(pixmap.height()))
-                if pixmap.width() > pixmap.height():pixmap = pixmap.scaledToWidth(800, Qt.SmoothTransformation)
-                else:pixmap = pixmap.scaledToHeight(800, Qt.SmoothTransformation)
-            except:
-                # Exception : Encrypted image file found at data folder but cannot read thumbnail file
-                pixmap = QPixmap(resource_path("./ui/error.png"))
+        if entry.type in ("image", "video"):
+            cached = self.preview_cache.get(entry.file)
+            TRACE.count("cache.preview.miss" if cached is None else "cache.preview.hit")
+            if cached is not None:
+                # Decoded earlier or prefetched
+                pixmap, dimensions = cached
+            else:
+                # Decoded in the background, the grid thumbnail stands in meanwhile
+                self.f_preview_request(entry, current=True)
+                pixmap = self.thumbnail_cache.get(entry.file) or self.grid_model.placeholder
+                if pixmap.width() > pixmap.height():pixmap = pixmap.scaledToWidth(800)
+                else:pixmap = pixmap.scaledToHeight(800)
+                dimensions = ": Loading ..."
         else:
-            pixmap = QPixmap(resource_path("./ui/other.png"))
-            self.preview_window.lb_dimensions_2.setText(": Unavailable")
-        
+            pixmap, dimensions = QPixmap(resource_path("./ui/other.png")), ": Unavailable"
+        self.f_preview_show(pixmap, dimensions)
+        self.f_preview_prefetch(row)
+
+        self.preview_window.lb_name_2.setText(": " + entry.name)
+        self.preview_window.lb_type_2.setText(": " + entry.name.split(".")[-1] + " / " +  entry.type.title())
+        try:
+            # From the database, a packed file has no file of its own
+            record = vault.index.get(entry.file)
+            if record is not None: imported, size = record.imported, record.size
+            else: imported, size = os.path.getctime(vault.path(entry.file)), os.path.getsize(vault.path(entry.file))
+            self.preview_window.lb_date_2.setText(": " + str(datetime.datetime.fromtimestamp(imported).strftime("%Y-%m-%d")))
+            self.preview_window.lb_size_2.setText(": " + str(size/(1024*1024))[:6] + " MB")
+        except OSError:pass
+        self.preview_window.btn_prev.setEnabled(row > 0)
+        self.preview_window.btn_next.setEnabled(row + 1 < len(self.grid_model.rows))
+        self.preview_window.show()
+
+    def f_preview_show(self, pixmap, dimensions):
         # UI
-        self.preview_window.setGeometry(300, 100, pixmap.width()+60+230, (pixmap.height()+60))
+        entry = self._preview_entry
+        self.preview_window.lb_dimensions_2.setText(dimensions)
+        # Room for the seek bar under a video, and for the buttons
+        height = max(pixmap.height() + (90 if entry.type == "video" else 60), 290)
+        if not self.preview_window.isVisible(): self.preview_window.setGeometry(300, 100, pixmap.width()+60+230, height)
         self.preview_window.setMaximumWidth(pixmap.width()+60+230)
-        self.preview_window.setMaximumHeight(pixmap.height()+60)
+        self.preview_window.setMaximumHeight(height)
         self.preview_window.setMinimumWidth(pixmap.width()+60+230)
-        self.preview_window.setMinimumHeight(pixmap.height()+60)
-        
+        self.preview_window.setMinimumHeight(height)
+
         self.preview_window.image_label.setPixmap(pixmap)
         self.preview_window.image_label.setGeometry(30, 30, pixmap.width(), pixmap.height())
         self.preview_window.infoBox.setGeometry(pixmap.width()+60, 30, 200, 150)
         self.preview_window.btn_decrypt.setGeometry(pixmap.width()+90, 190, 70, 23)
         self.preview_window.btn_delete.setGeometry(pixmap.width()+170, 190, 60, 23)
-        # self.preview_window.btn_play.setGeometry(pixmap.width()+130, 220, 60, 23)
-        # if type == "video": self.preview_window.btn_play.setEnabled(True)
-        self.preview_window.lb_name_2.setText(": " + name)
-        self.preview_window.lb_type_2.setText(": " + name.split(".")[-1] + " / " +  type.title())
-        self.preview_window.lb_date_2.setText(": " + str(datetime.datetime.fromtimestamp(os.path.getctime(path)).strftime("%Y-%m-%d")))
-        self.preview_window.lb_size_2.setText(": " + str(os.path.getsize(path)/(1024*1024))[:6] + " MB")
-
-        self.preview_window.btn_decrypt.clicked.connect(lambda: self.export_files([file]))
-        self.preview_window.btn_delete.clicked.connect(lambda: self.SyS_delete_files([file], ask_permission=True))
-        self.preview_window.show()
+        self.preview_window.btn_play.setGeometry(pixmap.width()+130, 220, 60, 23)
+        self.preview_window.btn_prev.setGeometry(pixmap.width()+90, 250, 60, 23)
+        self.preview_window.btn_next.setGeometry(pixmap.width()+170, 250, 60, 23)
+        self.preview_window.video_slider.setGeometry(30, pixmap.height()+40, pixmap.width(), 20)
+        self.preview_window.video_slider.setVisible(entry.type == "video")
+        self.preview_window.video_slider.setValue(0)
+        self.preview_window.btn_play.setText("Play")
+        self.preview_window.btn_play.setEnabled(entry.type == "video")
+
+    def f_preview_request(self, entry, current=False):
+        # Module : Queue one preview decode, the shown item goes first
+        if entry.file in self._preview_jobs: return
+        record = vault.index.get(entry.file)
+        job = SyS_PreviewJob(self, entry.file, vault.path(entry.file), entry.type, record.thumbnail if record is not None else False)
+        self._preview_jobs[entry.file] = job
+        self.preview_pool.start(job, 1 if current else 0)
+
+    def f_preview_prefetch(self, row):
+        # Module : Decode the neighbours of the shown row, drop queued decodes that are no longer near
+        wanted = set()
+        for step in range(1, PREVIEW_PREFETCH + 1):
+            for neighbour in (row + step, row - step):
+                if 0 <= neighbour < len(self.grid_model.rows):
+                    entry = self.grid_model.rows[neighbour]
+                    if entry.type in ("image", "video") and entry.file not in self.preview_cache:
+                        wanted.add(entry.file)
+                        self.f_preview_request(entry)
+        wanted.add(self._preview_entry.file)
+        for file, job in list(self._preview_jobs.items()):
+            if file not in wanted and self.preview_pool.tryTake(job): del self._preview_jobs[file]
+
+    def f_preview_ready(self, file, qimage, dimensions):
+        self._preview_jobs.pop(file, None)
+        if qimage.isNull():
+            # Exception : Encrypted file found at data folder but cannot read
+            if self.preview_window is not None and self._preview_entry.file == file: self.f_preview_show(QPixmap(resource_path("./ui/error.png")), dimensions)
+            return
+        pixmap = QPixmap.fromImage(qimage)
+        self.preview_cache.put(file, (pixmap, dimensions), SyS_ImageCache.cost(pixmap))
+        if self.preview_window is not None and self._preview_entry.file == file and self.video_task is None: self.f_preview_show(pixmap, dimensions)
+
+    def f_video_toggle(self):
+        # First click starts streaming, later ones play / pause
+        if self.video_task is None:
+            size = self.preview_window.image_label.size()
+            self.video_task = SyS_VideoTask(vault.path(self._preview_entry.file), vault.keyring, size.width(), size.height())
+            self.video_task.opened.connect(self.f_video_opened)
+            self.video_task.frame.connect(self.f_video_frame)
+            self.video_task.ended.connect(self.f_video_ended)
+            self.video_task.failed.connect(self.f_video_failed)
+            self.video_task.start()
+        elif self.video_task.ended_at is not None:
+            # Replay from the start
+            self.video_task.seek_to = 0
+            self.video_task.playing = True
+        else:
+            self.video_task.playing = not self.video_task.playing
+        self.preview_window.btn_play.setText("Pause" if self.video_task.playing else "Play")
+
+    def f_video_seek(self):
+        if self.video_task is not None: self.video_task.seek_to = self.preview_window.video_slider.value()
+
+    def f_video_opened(self, frames, fps):
+        if self.sender() is not self.video_task: return
+        self.preview_window.video_slider.setRange(0, max(0, frames - 1))
+
+    def f_video_frame(self, position, qimage):
+        if self.sender() is not self.video_task: return
+        self.preview_window.image_label.setPixmap(QPixmap.fromImage(qimage))
+        if not self.preview_window.video_slider.isSliderDown(): self.preview_window.video_slider.setValue(position)
+
+    def f_video_ended(self):
+        if self.sender() is not self.video_task: return
+        self.preview_window.btn_play.setText("Play")
+
+    def f_video_failed(self):
+        if self.sender() is not self.video_task: return
+        self.preview_window.btn_play.setText("Play")
+        self.preview_window.btn_play.setEnabled(False)
+        self.preview_window.lb_dimensions_2.setText(": Unable to play")
+
+    def f_stop_video(self):
+        task, self.video_task = self.video_task, None
+        if task is not None: task.stop()
+
+    def closeEvent(self, event):
+        # The vault locks with the main window, decoded images do not outlive it
+        if self.preview_window is not None: self.preview_window.close()
+        self.f_stop_video()
+        # Background decoders finish before their signal objects go
+        self.f_cancel_thumbnails()
+        self.thumbnail_pool.waitForDone()
+        self.preview_pool.waitForDone()
+        # An upgrade stops at the next file and keeps what is done, the next unlock resumes it
+        if self.migrate_task is not None:
+            self.migrate_task.cancel()
+            self.migrate_task.wait()
+            self.f_migrate_finished()
+        if self.compact_task is not None:
+            self.compact_task.cancel()
+            self.compact_task.wait()
+            self.f_compact_finished()
+        # A scrub keeps what it verified, the next unlock resumes it
+        if self.scrub_task is not None:
+            self.scrub_task.cancel()
+            self.scrub_task.wait()
+            self.f_scrub_finished()
+        self.f_clear_caches()
+        if self.stats_dialog is not None: self.stats_dialog.close()
+        if TRACE_FILE and TRACE.enabled:
+            try:TRACE.dump(TRACE_FILE)
+            except OSError:pass
+        super(VaultApp, self).closeEvent(event)
+
+    def eventFilter(self, obj, event):
+        if obj is self.preview_window and self.preview_window is not None:
+            # Stop streaming once the preview window closes
+            if event.type() == QEvent.Close: self.f_stop_video()
+            # Left / Right step through the grid
+            elif event.type() == QEvent.KeyPress and event.key() in (Qt.Key_Left, Qt.Key_Right):
+                self.SyS_preview_window(self._preview_row + (1 if event.key() == Qt.Key_Right else -1))
+                return True
+        return super(VaultApp, self).eventFilter(obj, event)
 
     def import_files(self):
-        global config_data
+        # A second click cancels a running import
+        if self.import_task is not None:
+            self.import_task.cancel()
+            return
+        if self.migrate_task is not None: return
         options = QFileDialog.Options()
         files, _ = QFileDialog.getOpenFileNames(self, "Select file(s)", "", "All Files (*);;Image Files (*.png *.jpg *.jpeg *.bmp);;Video Files (*.mp4 *.mkv *.webm *.mov)", options=options)
         if not files:pass
         else:
+            # Reserve the names in the index, committed once the files are done
+            jobs = vault.prepare_import(files)
+
+            # Module : Encrypt files and thumbnails across the worker pool
+            self._import_jobs = jobs
+            self.import_task = SyS_EngineTask(lambda progress, cancel: vault.run_import(jobs, progress, cancel))
+            self.import_task.progress.connect(self.f_task_progress)
+            self.import_task.finished.connect(self.f_import_finished)
+            # UI
+            self.progress_bar.setValue(0)
             self.progress_bar.setVisible(True)
-            progress = 0
-            for file in files:
-                # Prepare configuration data
-                orginal_file_name = os.path.basename(file)
-                file_ext = file.split(".")[-1]
-                file_type = self.SyS_filetype(file.split(".")[-1])
-                
-                # Generate secure file names
-                orginal_file_name, encrypted_file_name = self.SyS_chkfilename(orginal_file_name, file_ext)
-
-                # Update config
-                config_data.append(encrypted_file_name + "<?/?>" + orginal_file_name)
+            self.btn_import_files.setText("Cancel")
+            self.import_task.start()
 
-                # UI
-                self.progress_bar.setValue(progress)
-                progress += int(100/len(files))
-
-                # Module : Encrypt file
-                try:
-                    self.encrypt_data(file, (os.path.join(os.getcwd(), "data", encrypted_file_name)), password, progressbar=False)
-                except:
-                    dialog = SyS_InfoDialog(title="Error !!!", msg="  Encryption failed.\n")
-                    _ = dialog.exec_()
-                
-                # Try to generate a thumbnail for images and videos
-                try:
-                    if file_type == "image":
-                        frame = cv2.imread(file)
-                        h, w, ch = frame.shape
-                        ratio = w/h
-                        if w > h:
-                            w = 400
-                            h = int(w/ratio)
-                        else:
-                            h = 400
-                            w = int(h*ratio)
-                        resized_image = cv2.resize(frame, (w, h))
-                        thumbnail_bytes = cv2.imencode('.jpg', resized_image)[1].tobytes()
-                        png_bytesio = io.BytesIO(bytes(thumbnail_bytes))
-                        png_bytesio.seek(0)
-                        self.encrypt_data(None, (os.path.join(os.getcwd(), "data", (encrypted_file_name + ".dat"))), password, file=False, data=png_bytesio)
-
-                    elif file_type == "video":
-                        cap = cv2.VideoCapture(file)
-                        cap.set(cv2.CAP_PROP_POS_FRAMES, int(cap.get(cv2.CAP_PROP_FRAME_COUNT)/4))
-                        ret, frame = cap.read()
-                        if ret:
-                            thumbnail_bytes = cv2.imencode('.jpg', frame)[1].tobytes()
-                            png_bytesio = io.BytesIO(bytes(thumbnail_bytes))
-                        cap.release()
-                        png_bytesio.seek(0)
-                        self.encrypt_data(None, (os.path.join(os.getcwd(), "data", (encrypted_file_name + ".dat"))), password, file=False, data=png_bytesio)
-                        del png_bytesio
-                except:
-                    dialog = SyS_InfoDialog(title="Warning !!!", msg="  Encryption complete.\n  " + orginal_file_name + " is a " + file_type + ".\n  But unable to generate a thumbnail.")
-                    _ = dialog.exec_()
+    def f_task_progress(self, done, total):
+        # UI : progress in bytes
+        self.progress_bar.setValue(int(done*100/max(1, total)))
+        self.progress_bar.setFormat("%p%  (" + str(done//(1024*1024)) + " / " + str(total//(1024*1024)) + " MB)")
 
-            # UI
-            self.progress_bar.setVisible(False)
+    def f_import_finished(self):
+        task, self.import_task = self.import_task, None
 
-            # Save configuration file
-            data = str(password) + "<?n?>" + "<?n?>".join(config_data)
-            config_file = io.BytesIO(bytes(data, 'utf-8'))
-            self.encrypt_data(None, config_path, password, file=False, data=config_file)
-            del data, config_file
+        # Module : Commit the completed files as one journal record
+        imported, failed, no_thumbnail = vault.finish_import(self._import_jobs, task.result or {})
+        self.f_clear_caches([record.file for record in imported])
 
-            # UI
-            self.SyS_refresh(ask_password=False)
+        # UI
+        self.btn_import_files.setText("Import files")
+        self.progress_bar.setFormat("%p%")
+        self.progress_bar.setVisible(False)
+        if failed:
+            dialog = SyS_dialog(SyS_InfoDialog, title="Error !!!", msg="  Encryption failed.\n  " + ", ".join(name for name, error in failed[:5]) + (" ..." if len(failed) > 5 else ""))
+            _ = dialog.exec_()
+        if no_thumbnail:
+            dialog = SyS_dialog(SyS_InfoDialog, title="Warning !!!", msg="  Encryption complete.\n  But unable to generate a thumbnail for\n  " + ", ".join(no_thumbnail[:5]) + (" ..." if len(no_thumbnail) > 5 else ""))
+            _ = dialog.exec_()
+        # UI : tiles of the new files only
+        self.f_files_added([record.file for record in imported])
+
+    def f_btn_export(self):
+        # function of btn_decrypt_files, a second click cancels a running export
+        if self.export_task is not None:
+            self.export_task.cancel()
+            return
+        self.export_files(_files=[], ask_permission=True, all_files=True)
 
-    def export_files(self, _files, directory_path_export="", ask_permission=True, all_files=False):
-        global _encfileNames, _orfileNames
+    def export_files(self, _files, directory_path_export="", ask_permission=True, all_files=False, archive=False):
+        if self.export_task is not None: return
 
         # Export checked files
         if all_files:
-            _files = [f for f in os.listdir(directory_path_data) if f.lower().endswith(('.enc'))]
+            _files = vault.files()
 
         # Export all files
         if len(_files) != 0:
             # UI
             if ask_permission:
-                dialog = SyS_MsgBoxDialog(title="Warning !!!", msg="You're going to decrypt " + str(len(_files)) + " file(s) from this vault.\nAre you sure?")
+                dialog = SyS_dialog(SyS_MsgBoxDialog, title="Warning !!!", msg="You're going to decrypt " + str(len(_files)) + " file(s) from this vault.\nAre you sure?")
                 result = dialog.exec_()
                 if result == QDialog.Accepted:
                     options = QFileDialog.Options()
-                    directory_path_export = QFileDialog.getExistingDirectory(self, options=options)
-                    if not directory_path_export:pass
+                    dialog = SyS_dialog(SyS_MsgBoxDialog, title="Export", msg="Export into a single ZIP / TAR archive?\nNo plaintext copies are written to disk.")
+                    if dialog.exec_() == QDialog.Accepted:
+                        archive_path, _ = QFileDialog.getSaveFileName(self, "Export to archive", "vault_export.zip", "ZIP archive (*.zip);;TAR archive (*.tar)", options=options)
+                        if archive_path: self.export_files(_files, archive_path, ask_permission=False, archive=True)
                     else:
-                        self.export_files(_files, directory_path_export, ask_permission=False)
+                        directory_path_export = QFileDialog.getExistingDirectory(self, options=options)
+                        if not directory_path_export:pass
+                        else:
+                            self.export_files(_files, directory_path_export, ask_permission=False)
                 else: pass
             else:
-                progress = 0
-                self.progress_bar.setVisible(True)
-                for _file in _files:    
-                    # get file type and id
-                    try: 
-                        _orfilename = _orfileNames[_encfileNames.index(_file)]
-                    except ValueError:
-                        # Exception : Export files that doesn't in database
-                        _orfilename = "file.extension"
-
-                    # UI
-                    self.progress_bar.setValue(progress)
-                    progress += int(100/len(_files))
-
-                    # Path
-                    file_path = os.path.join(directory_path_data, _file)
-                    outfile_path = os.path.join(directory_path_export, _orfilename)
-
-                    # Module : Decrypt file
-                    data = self.decrypt_data(file_path, outfile_path, password, True)
-                    del data
-                
-                # UI
-                self.progress_bar.setVisible(False)
-                dialog = SyS_MsgBoxDialog(title="Success", msg="Decryption complete.\nDo you want to remove this file(s) from Vault?", clr_btn_yes=True)
-                result = dialog.exec_()
-                if result == QDialog.Accepted:
-                    self.SyS_delete_files(_files, ask_permission=False)
+                # Module : Decrypt files, skipping the ones a previous run finished
+                if archive:
+                    self.export_task = SyS_EngineTask(lambda progress, cancel: vault.export_archive(_files, directory_path_export, progress, cancel))
                 else:
-                    pass
+                    self.export_task = SyS_EngineTask(lambda progress, cancel: vault.export_files(_files, directory_path_export, progress, cancel))
+                self._export_files = _files
+                self.export_task.progress.connect(self.f_task_progress)
+                self.export_task.finished.connect(self.f_export_finished)
+
+                # UI
+                self.progress_bar.setValue(0)
+                self.progress_bar.setVisible(True)
+                self.btn_decrypt_files.setText("Cancel")
+                self.export_task.start()
         return
 
+    def f_export_finished(self):
+        task, self.export_task = self.export_task, None
+        exported, failed = task.result or ([], [task.error] if task.error else [])
 
-    # System
+        # UI
+        self.btn_decrypt_files.setText("Decrypt vault")
+        self.progress_bar.setFormat("%p%")
+        self.progress_bar.setVisible(False)
+        if len(exported) != len(self._export_files):
+            # The manifest is kept, the next export to the same place resumes
+            dialog = SyS_dialog(SyS_InfoDialog, title="Warning !!!", msg="  Export stopped, " + str(len(exported)) + " of " + str(len(self._export_files)) + " file(s) exported." + ("\n  " + failed[0] if failed else "") + "\n  Export again to the same location to resume.")
+            _ = dialog.exec_()
+            return
+        dialog = SyS_dialog(SyS_MsgBoxDialog, title="Success", msg="Decryption complete.\nDo you want to remove this file(s) from Vault?", clr_btn_yes=True)
+        result = dialog.exec_()
+        if result == QDialog.Accepted:
+            self.SyS_delete_files(exported, ask_permission=False)
+        else:
+            pass
 
-    def SyS_filetype(self, ext=""):
-        # Common file types
-        if ext.lower() in ("jpg,png,bmp,jpeg"): return "image"
-        elif ext.lower() in ("mp4,avi,mkv"): return "video"
-        elif ext.lower() in ("exe,dll,py"): return "application"
-        elif ext.lower() in ("rar,zip,7zip"): return "compressed"
-        elif ext.lower() in ("mp3,ogg,wav"): return "audio"
-        elif ext.lower() in ("doc,docx,pdf,txt,ppt,xls,ppt,csv"): return "document"
-        elif ext.lower() in ("html,mhtml,css"): return "webpage"
-        else: return "other"
-
-    def SyS_chkfilename(self, orginal_file_name, file_ext):
-        # Generate secure file names
-        while True:
-            # Fix same name
-            encrypted_file_name = secrets.token_urlsafe(16) + ".enc"
-            if encrypted_file_name not in _encfileNames:break
-        i = 0
-        tmp = "".join(orginal_file_name.split(".")[:-1])
-        while True:
-            if orginal_file_name in _orfileNames:
-                i += 1
-                orginal_file_name = tmp + "_" + str(i) + "." + file_ext
-            else: break
-        del i, tmp
-        return orginal_file_name, encrypted_file_name
-
-    def SyS_chkdirs(self, *paths):
-        # Check dirs
-        for path in paths:
-            if not os.path.exists(path): os.mkdir(str(path))
-            else: return
 
-    def SyS_load_config(self):
-        global config_data, first_run
-        
-        first_run = False
-        # Generate config for the first time
-        if not os.path.exists(config_path):
-            config_data = str(password)
-            config_file = io.BytesIO(bytes(config_data, 'utf-8'))
-            # Module : Encrypt data to config file
-            self.encrypt_data(None, config_path, password, file=False, data=config_file)
-            first_run = True
-
-        # Module : Decrypt config file and process data
-        try:
-            config_data = self.decrypt_data(config_path, None, password, save=False)
-            config_data = config_data.decode()
-            config_data = config_data.split("<?n?>")
-
-            config_data.pop(0)
-            _encfilenames = []
-            _orfileNames = []
-            for entry in config_data:
-                try:
-                    tmp = entry.split("<?/?>")
-                    _encfilenames.append(tmp[0])
-                    _orfileNames.append(tmp[1])
-                    del tmp
-                except:pass
-            return _encfilenames, _orfileNames
-        except:
-            # Exception : Unable to read config file
-            # UI
-            dialog = SyS_InfoDialog(title="Error !", msg="  Incorrect password.\n  The app will exit now.")
-            result = dialog.exec_()
-            if result == QDialog.Accepted:exit()
+    # System
 
     def SyS_delete_files(self, _files=[], ask_permission=True):
-        global config_data
         if ask_permission:
             # UI
-            dialog = SyS_MsgBoxDialog(title="Warning !!!", msg="You're going to delete " + str(len(_files)) + " file(s) from this vault.\nAre you sure?", clr_btn_yes=True)
+            dialog = SyS_dialog(SyS_MsgBoxDialog, title="Warning !!!", msg="You're going to delete " + str(len(_files)) + " file(s) from this vault.\nAre you sure?", clr_btn_yes=True)
             result = dialog.exec_()
             if result == QDialog.Accepted:
                 self.SyS_delete_files(_files, ask_permission=False)
             else: return
         else:
-            for _file in _files:
-                try:
-                    os.remove(os.path.join(directory_path_data, _file))
-                    try:os.remove(os.path.join(directory_path_data, _file+".dat"))
-                    except:pass
-                    for id, entry in enumerate(config_data):
-                        if _file in entry:
-                            # Remove file from database and save
-                            config_data.pop(id)
-                            if len(config_data) !=0 : data = str(password) + "<?n?>" + "<?n?>".join(config_data)
-                            else: data = str(password)
-                            config_file = io.BytesIO(bytes(data, 'utf-8'))
-                            # Module : Encrypt config file
-                            self.encrypt_data(None, config_path, password, file=False, data=config_file)
-                            del data, config_file
-                except:return
-            # UI
-            self.SyS_refresh(ask_password=False)
+            # Module : Delete as one journal record, pack space is reclaimed unless an import, an upgrade or an integrity check is running
+            deleted = vault.delete(_files, compact=self.import_task is None and self.migrate_task is None and self.scrub_task is None)
+            self.f_clear_caches(deleted)
+            self.SyS_compact_segments()
+            # UI : tiles of the deleted files only
+            self.f_files_removed(deleted)
+            if len(deleted) < len(_files):
+                dialog = SyS_dialog(SyS_InfoDialog, title="Warning !!!", msg="  " + str(len(_files) - len(deleted)) + " file(s) could not be deleted.\n  They may be in use, try again later.")
+                _ = dialog.exec_()
 
     def SyS_refresh(self, ask_password=True, category="all"):
         # UI
@@ -583,173 +863,476 @@ class VaultApp(QMainWindow):
         # Reload files
         self.load_files(ask_password, refresh=True, category=category)
 
+    def SyS_migrate_files(self):
+        # Re-encrypt files not under the current key, in the background while the vault stays usable
+        dialog = SyS_dialog(SyS_MsgBoxDialog, title="Upgrade", msg="Some files use an older format or key.\nUpgrade them now in the background?", btn_no_default=False, btn_yes_default=True)
+        if dialog.exec_() != QDialog.Accepted: return
 
-    # Cryptography
-
-    def derive_key(self, password, salt, length=32):
-        # Module
-        kdf = PBKDF2HMAC(
-            algorithm=hashes.SHA256(),
-            iterations=100000,
-            salt=salt,
-            length=length,
-            backend=default_backend()
-        )
-        return kdf.derive(password)
-
-    def encrypt_data(self, input_file, output_file, password, file=True, progressbar=False, data=""):
-        # Module
-        if file:
-            if not os.path.exists(input_file): return
-        
-        # Generate a random key using random salt
-        salt = os.urandom(16)
-        key = self.derive_key(password.encode('utf-8'), salt)
-        # Generate a random (IV)
-        content_iv = os.urandom(16)
-
-        # Create an AES cipher object
-        content_cipher = Cipher(algorithms.AES(key), modes.CFB(content_iv), backend=default_backend())
-        content_encryptor = content_cipher.encryptor()
-
-        if file:
-            # If input is a file
-            # Calc.s for progress
-            file_size = os.stat(input_file).st_size
-            val = 4096*100/file_size
-            progress = 0
-            # UI
-            if progressbar:self.progress_bar.setVisible(True)
-
-            with open(input_file, 'rb') as infile:
-                # Write the salt and IV
-                with open(output_file, 'wb') as outfile:
-                    outfile.write(salt)
-                    outfile.write(content_iv)
-                    # Encrypt the file content and write
-                    for chunk in iter(lambda: infile.read(4096), b''):
-                        encrypted_chunk = content_encryptor.update(chunk)
-                        outfile.write(encrypted_chunk)
-                        # UI
-                        if progressbar:
-                            progress += val
-                            self.progress_bar.setValue(int(progress))
-                    # Finalize
-                    outfile.write(content_encryptor.finalize())
-                    if progressbar:self.progress_bar.setVisible(False)
-        else:
-            # If input is data
-            with open(output_file, 'wb') as outfile:
-                outfile.write(salt)
-                outfile.write(content_iv)
-                # Encrypt the file content and write
-                for chunk in iter(lambda: data.read(4096), b''):
-                    encrypted_chunk = content_encryptor.update(chunk)
-                    outfile.write(encrypted_chunk)
-                # Finalize
-                outfile.write(content_encryptor.finalize())
-
-    def decrypt_data(self, input_file, output_file, password, save, progressbar=False):
-        if not os.path.exists(input_file):
+        jobs = vault.prepare_migration()
+        self.migrate_task = SyS_EngineTask(lambda progress, cancel: vault.run_migration(jobs, progress, cancel))
+        self.migrate_task.progress.connect(self.f_task_progress)
+        self.migrate_task.finished.connect(self.f_migrate_finished)
+        # UI
+        self.progress_bar.setValue(0)
+        self.progress_bar.setVisible(True)
+        self.btn_import_files.setEnabled(False)
+        self.migrate_task.start()
+
+    def f_migrate_finished(self):
+        task, self.migrate_task = self.migrate_task, None
+        if task is None: return
+
+        # Module : Commit resealed thumbnails, drop the old key once nothing uses it
+        errors = vault.finish_migration(task.result or ({}, [task.error] if task.error else [], False))
+
+        # UI
+        self.btn_import_files.setEnabled(True)
+        self.progress_bar.setFormat("%p%")
+        self.progress_bar.setVisible(False)
+        if errors and self.isVisible():
+            dialog = SyS_dialog(SyS_InfoDialog, title="Warning !!!", msg="  Upgrade incomplete, " + str(len(errors)) + " file(s) failed.\n  It resumes on next unlock.")
+            _ = dialog.exec_()
+
+    def SyS_compact_segments(self):
+        # Module : Copy live files out of segments that are mostly deleted ones, in the background (not while an import appends)
+        if self.import_task is not None or self.migrate_task is not None or self.compact_task is not None: return
+        jobs = vault.prepare_compaction()
+        if not jobs[1]: return
+        self.compact_task = SyS_EngineTask(lambda progress, cancel: vault.run_compaction(jobs, progress, cancel))
+        self.compact_task.finished.connect(self.f_compact_finished)
+        self.compact_task.start()
+
+    def f_compact_finished(self):
+        task, self.compact_task = self.compact_task, None
+        if task is None: return
+        # Module : Commit the new locations, drop the emptied segments
+        vault.finish_compaction(task.result or ({}, []))
+
+    def SyS_scrub_vault(self):
+        # Module : Read back and authenticate every stored file and thumbnail in the background, nothing is written
+        jobs = vault.prepare_scrub()
+        self.scrub_task = SyS_EngineTask(lambda progress, cancel: vault.run_scrub(jobs, progress, cancel))
+        self.scrub_task.jobs = jobs
+        self.scrub_task.finished.connect(self.f_scrub_finished)
+        self.scrub_task.start()
+
+    def f_scrub_finished(self):
+        task, self.scrub_task = self.scrub_task, None
+        if task is None: return
+        # Module : Record what was verified, report once the pass is complete
+        try:report = vault.finish_scrub(task.jobs, task.result or ({}, {}))
+        except OSError:return
+
+        # UI
+        if report and self.isVisible():
+            dialog = SyS_dialog(SyS_InfoDialog, title="Warning !!!", msg="  Integrity check : " + str(len(report)) + " damaged or stray file(s).\n  Run 'python cli.py scrub --report' for the list.")
+            _ = dialog.exec_()
+
+    def f_btn_password(self):
+        # function of btn_password : only the key file is rewritten, files stay as they are
+        dialog = SyS_dialog(SyS_InputDialog, title="Change Password", msg="Enter your current password :", ispassword=True)
+        if dialog.exec_() != QDialog.Accepted: return
+        password = dialog.input.text()
+        dialog = SyS_dialog(SyS_InputDialog, title="Change Password", msg="Create a new password : (Min 6 characters)", ispassword=True, password_confirm=True)
+        if dialog.exec_() != QDialog.Accepted: return
+        new_password = dialog.input.text()
+        try:
+            if self.migrate_task is not None: raise ValueError("Wait for the upgrade to finish")
+            vault.change_password(password, new_password)
+        except ValueError as e:
+            dialog = SyS_dialog(SyS_InfoDialog, title="Error !", msg="  " + str(e) + ".")
+            _ = dialog.exec_()
             return
-        
-        with open(input_file, 'rb') as infile:
-            # Read the salt and IV
-            salt = infile.read(16)
-            content_iv = infile.read(16)
-
-            # Derive the key
-            key = self.derive_key(password.encode('utf-8'), salt)
-
-            # Create an AES cipher
-            content_cipher = Cipher(algorithms.AES(key), modes.CFB(content_iv), backend=default_backend())
-            content_decryptor = content_cipher.decryptor()
-
-            # Calc.s for progress
-            file_size = os.stat(input_file).st_size
-            val = 4096*100/file_size
-            progress = 0
-            if progressbar:self.progress_bar.setVisible(True)
-            
-            if save:
-                # If output is a file
-                with open(output_file, 'wb') as outfile:
-                # Decrypt the file content and write
-                    for chunk in iter(lambda: infile.read(4096), b''):
-                        decrypted_chunk = content_decryptor.update(chunk)
-                        outfile.write(decrypted_chunk)
-                        # UI
-                        if progressbar:
-                            progress += val
-                            self.progress_bar.setValue(int(progress))
-                    # Finalize
-                    outfile.write(content_decryptor.finalize())
-                if progressbar:self.progress_bar.setVisible(False)
+        dialog = SyS_dialog(SyS_InfoDialog, title="Success", msg="  Password changed.")
+        _ = dialog.exec_()
+
+
+# File Grid
+
+class SyS_FileGridModel(QAbstractListModel):
+    """ Files shown in the grid, thumbnails and check states live here """
+    selection_changed = pyqtSignal(int)
+
+    class Row:
+        __slots__ = ("file", "name", "ext", "type")
+        def __init__(self, file, name, ext, type):
+            self.file, self.name, self.ext, self.type = file, name, ext, type
+
+    def __init__(self, parent=None):
+        super(SyS_FileGridModel, self).__init__(parent)
+        self.rows = []
+        self.positions = {}         # file : row
+        self.thumbnails = {}        # file : pixmap, for a few screens around the viewport
+        self.checked = set()
+        self.placeholder = self.fit_pixmap(QPixmap(resource_path("./ui/other.png")))
+        self.error = self.fit_pixmap(QPixmap(resource_path("./ui/error.png")))
+
+    @staticmethod
+    def fit_pixmap(pixmap):
+        # Fix width and height
+        if pixmap.width() > pixmap.height():return pixmap.scaledToWidth(200, Qt.SmoothTransformation)
+        else:return pixmap.scaledToHeight(200, Qt.SmoothTransformation)
+
+    def set_rows(self, rows):
+        # Reuse thumbnails of files that stay on screen
+        self.beginResetModel()
+        self.rows = rows
+        self.positions = {entry.file: row for row, entry in enumerate(rows)}
+        self.thumbnails = {file: pixmap for file, pixmap in self.thumbnails.items() if file in self.positions}
+        self.endResetModel()
+        # Keep checked files that are still listed
+        self.checked &= self.positions.keys()
+        self.selection_changed.emit(len(self.checked))
+
+    def append_rows(self, rows):
+        # New tiles at the end, the view lays out only these
+        rows = [entry for entry in rows if entry.file not in self.positions]
+        if not rows: return
+        self.beginInsertRows(QModelIndex(), len(self.rows), len(self.rows) + len(rows) - 1)
+        for entry in rows:
+            self.positions[entry.file] = len(self.rows)
+            self.rows.append(entry)
+        self.endInsertRows()
+
+    def remove_files(self, files):
+        # Remove the tiles of files, one removal per run of neighbouring rows (from the end, rows before a run keep their numbers)
+        doomed = sorted(self.positions[file] for file in files if file in self.positions)
+        if not doomed: return
+        runs, start = [], doomed[0]
+        for previous, row in zip(doomed, doomed[1:] + [None]):
+            if row != previous + 1:
+                runs.append((start, previous))
+                start = row
+        for first, last in reversed(runs):
+            self.beginRemoveRows(QModelIndex(), first, last)
+            del self.rows[first:last + 1]
+            self.endRemoveRows()
+        # Rows after the first removed one moved up
+        for file in files:
+            self.positions.pop(file, None)
+            self.thumbnails.pop(file, None)
+        for row in range(doomed[0], len(self.rows)): self.positions[self.rows[row].file] = row
+        if self.checked & set(files):
+            self.checked -= set(files)
+            self.selection_changed.emit(len(self.checked))
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid(): return None
+        entry = self.rows[index.row()]
+        if role == Qt.DisplayRole:
+            # Prepare the name label text
+            if len(entry.name) > 25: return entry.name[:15] + "...." + entry.name.split(".")[0][-5:] + "." + entry.ext
+            return entry.name
+        elif role == Qt.DecorationRole:
+            if entry.name == "Database Error": return self.error
+            return self.thumbnails.get(entry.file, self.placeholder)
+        elif role == Qt.CheckStateRole:
+            return Qt.Checked if entry.file in self.checked else Qt.Unchecked
+        elif role == Qt.ToolTipRole:
+            return "Open : " + str(entry.name)
+        return None
+
+    def setData(self, index, value, role=Qt.EditRole):
+        if role != Qt.CheckStateRole or not index.isValid(): return False
+        file = self.rows[index.row()].file
+        if value == Qt.Checked: self.checked.add(file)
+        else: self.checked.discard(file)
+        self.dataChanged.emit(index, index, [Qt.CheckStateRole])
+        self.selection_changed.emit(len(self.checked))
+        return True
+
+    def flags(self, index):
+        return Qt.ItemIsEnabled | Qt.ItemIsUserCheckable
+
+    def selected_files(self):
+        return [row.file for row in self.rows if row.file in self.checked]
+
+    def needs_thumbnail(self, row):
+        entry = self.rows[row]
+        return entry.type in ("image", "video") and entry.name != "Database Error" and entry.file not in self.thumbnails
+
+    def set_thumbnail(self, file, pixmap):
+        # Rows move as others are added or removed, a finished thumbnail finds its tile by file
+        row = self.positions.get(file)
+        if row is None: return
+        self.thumbnails[file] = pixmap
+        self.dataChanged.emit(self.index(row), self.index(row), [Qt.DecorationRole])
+
+    def drop_thumbnails(self, keep):
+        keep = {self.rows[row].file for row in keep}
+        for file in [file for file in self.thumbnails if file not in keep]:
+            del self.thumbnails[file]
+
+
+class SyS_FileGridDelegate(QStyledItemDelegate):
+    """ Paints one tile : thumbnail, name and checkbox """
+    preview_requested = pyqtSignal(QModelIndex)
+
+    def sizeHint(self, option, index):
+        return QSize(244, 200)
+
+    def checkbox_rect(self, rect):
+        return QRect(rect.left() + 8, rect.bottom() - 22, 16, 16)
+
+    def paint(self, painter, option, index):
+        painter.save()
+        painter.setRenderHint(QPainter.Antialiasing)
+        rect = QRect(option.rect.topLeft(), self.sizeHint(option, index))
+        tile = QPainterPath()
+        tile.addRoundedRect(QRectF(rect), 8, 8)
+        painter.setClipPath(tile)
+        painter.fillRect(rect, QColor(25, 25, 25))
+
+        # Thumbnail
+        pixmap = index.data(Qt.DecorationRole)
+        painter.drawPixmap(rect.left() + (rect.width() - pixmap.width())//2, rect.top() + (rect.height() - pixmap.height())//2, pixmap)
+
+        # File name
+        gradient = QLinearGradient(0, rect.top(), 0, rect.bottom())
+        gradient.setColorAt(0.823864, QColor(41, 41, 41, 0))
+        gradient.setColorAt(1, QColor(0, 0, 0, 255))
+        painter.fillRect(rect, gradient)
+        painter.setPen(QColor(200, 200, 200))
+        painter.drawText(rect.adjusted(32, 0, -8, -6), Qt.AlignBottom | Qt.AlignLeft, index.data(Qt.DisplayRole))
+
+        # Checkbox
+        checkbox = QStyleOptionButton()
+        checkbox.rect = self.checkbox_rect(rect)
+        checkbox.state = QStyle.State_Enabled | (QStyle.State_On if index.data(Qt.CheckStateRole) == Qt.Checked else QStyle.State_Off)
+        QApplication.style().drawPrimitive(QStyle.PE_IndicatorCheckBox, checkbox, painter)
+        painter.restore()
+
+    def editorEvent(self, event, model, option, index):
+        if event.type() != QEvent.MouseButtonRelease or event.button() != Qt.LeftButton: return False
+        if self.checkbox_rect(option.rect).adjusted(-4, -4, 4, 4).contains(event.pos()):
+            checked = index.data(Qt.CheckStateRole) == Qt.Checked
+            model.setData(index, Qt.Unchecked if checked else Qt.Checked, Qt.CheckStateRole)
+        else:
+            self.preview_requested.emit(index)
+        return True
+
+
+# Background Workers
+
+class SyS_ThumbnailSignals(QObject):
+    finished = pyqtSignal(int, str, QImage)     # generation, file, image
+    migrated = pyqtSignal(object)               # [(file, JPEG bytes)] read from legacy .dat files
+
+
+class SyS_ThumbnailJob(QRunnable):
+    """ Read, decrypt, decode and scale one page of thumbnails off the GUI thread """
+    def __init__(self, app, rows, generation):
+        super(SyS_ThumbnailJob, self).__init__()
+        self.setAutoDelete(False)
+        self.app = app
+        self.rows = rows            # [(file, path, location), ...]
+        self.generation = generation
+        self.cancelled = False
+
+    def run(self):
+        if self.cancelled or self.generation != self.app.grid_generation: return
+        try:thumbnails = read_thumbnails(vault.thumbnails, vault.keyring, self.rows)
+        except Exception:thumbnails = {}
+        for file, path, location in self.rows:
+            if self.cancelled: break
+            try:
+                with TRACE.span("thumbnail.decode"):qimage = QImage.fromData(QByteArray(thumbnails[file]))
+                # Fix width and height (QImage is safe to scale outside the GUI thread)
+                with TRACE.span("thumbnail.scale"):
+                    if qimage.width() > qimage.height():qimage = qimage.scaledToWidth(200, Qt.SmoothTransformation)
+                    else:qimage = qimage.scaledToHeight(200, Qt.SmoothTransformation)
+            except:
+                qimage = QImage()
+            self.app.thumbnail_signals.finished.emit(self.generation, file, qimage)
+        # Legacy thumbnail files are moved into a pack by the GUI thread
+        migrated = [(file, thumbnails[file]) for file, path, location in self.rows if location is True and thumbnails.get(file)]
+        if migrated: self.app.thumbnail_signals.migrated.emit(migrated)
+
+
+class SyS_PreviewSignals(QObject):
+    ready = pyqtSignal(str, QImage, str)        # file, image (800 px), dimensions text
+
+
+class SyS_PreviewJob(QRunnable):
+    """ Decrypt and decode one preview (800 px) off the GUI thread """
+    def __init__(self, app, file, path, type, thumbnail):
+        super(SyS_PreviewJob, self).__init__()
+        self.setAutoDelete(False)
+        self.app = app
+        self.file = file
+        self.path = path
+        self.type = type
+        self.thumbnail = thumbnail
+
+    def run(self):
+        # OpenCV / numpy load with the first preview
+        import cv2
+        import numpy as np
+        try:
+            if self.type == "image":
+                # Decrypt image data
+                with TRACE.span("preview.decrypt"):data = decrypt_bytes(self.path, vault.keyring)
+                # Decode at about the displayed size, then fit it (only 800 px ever reach cvtColor / QImage)
+                size = image_size(data)
+                with TRACE.span("preview.decode", len(data)):image = cv2.imdecode(np.frombuffer(data, np.uint8), decode_flag(size, 800))
+                if size is None: size = (image.shape[1], image.shape[0])
+                # EXIF orientation may turn the decoded image
+                if (image.shape[1] > image.shape[0]) != (size[0] > size[1]): size = (size[1], size[0])
             else:
-                # If output is data
-                chunks = []
-                for chunk in iter(lambda: infile.read(4096), b''):
-                    decrypted_chunk = content_decryptor.update(chunk)
-                    chunks.append(decrypted_chunk)
-                    # UI
-                    if progressbar:
-                        progress += val
-                        self.progress_bar.setValue(int(progress))
-                data = b''.join(chunks)
-                del chunks
-                # UI
-                if progressbar:self.progress_bar.setVisible(False)
-                return data
+                # Decrypt thumbnail data
+                data = read_thumbnails(vault.thumbnails, vault.keyring, [(self.file, self.path, self.thumbnail)])[self.file]
+                with TRACE.span("preview.decode", len(data)):image = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+                size = (image.shape[1], image.shape[0])
+            with TRACE.span("preview.scale"):image_rgb = cv2.cvtColor(fit_frame(image, 800), cv2.COLOR_BGR2RGB)
+            h, w, ch = image_rgb.shape
+            qimage = QImage(image_rgb.data, w, h, ch * w, QImage.Format_RGB888).copy()
+            dimensions = ": " + str(size[0]) + " X "+ str(size[1])
+        except:
+            qimage, dimensions = QImage(), ": Unavailable"
+        self.app.preview_signals.ready.emit(self.file, qimage, dimensions)
+
+
+class SyS_EngineTask(QThread):
+    """ Runs one engine call off the GUI thread, relaying its progress """
+    progress = pyqtSignal(object, object)      # bytes done, bytes total
+
+    def __init__(self, call):
+        super(SyS_EngineTask, self).__init__()
+        self.call = call            # call(progress, cancel) -> result
+        self.cancel_event = threading.Event()
+        self.result = None
+        self.error = ""
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def run(self):
+        try:self.result = self.call(self.progress.emit, self.cancel_event)
+        except Exception as e:self.error = str(e) or type(e).__name__
+
+
+class SyS_VideoTask(QThread):
+    """ Plays a video straight from its encrypted file, decrypted on demand as playback and seeking proceed """
+    opened = pyqtSignal(int, float)         # frame count, frames per second
+    frame = pyqtSignal(int, QImage)         # frame number, frame scaled to the preview
+    ended = pyqtSignal()
+    failed = pyqtSignal()
+
+    def __init__(self, path, keyring, width, height):
+        super(SyS_VideoTask, self).__init__()
+        self.path = path
+        self.keyring = keyring
+        self.size = (max(1, width), max(1, height))
+        self.playing = True
+        self.running = True
+        self.seek_to = None
+        self.ended_at = None
+
+    def stop(self):
+        self.running = False
+        self.wait()
+
+    def run(self):
+        import cv2
+        try:
+            stream = SyS_VaultStream(self.path, self.keyring)
+            # OpenCV pulls through read() / seek(), only the window around the play position is in RAM
+            capture = cv2.VideoCapture(stream, cv2.CAP_FFMPEG, [])
+        except Exception:
+            capture = None
+        if capture is None or not capture.isOpened():
+            self.failed.emit()
+            return
+        fps = capture.get(cv2.CAP_PROP_FPS) or 25.0
+        self.opened.emit(int(capture.get(cv2.CAP_PROP_FRAME_COUNT)), fps)
+        position, due = 0, time.monotonic()
+        while self.running:
+            if self.seek_to is not None:
+                # A seek shows its frame even when paused
+                position, self.seek_to, self.ended_at = self.seek_to, None, None
+                capture.set(cv2.CAP_PROP_POS_FRAMES, position)
+                due = time.monotonic()
+            elif not self.playing or self.ended_at is not None:
+                self.msleep(20)
+                continue
+            ok, image = capture.read()
+            if not ok:
+                self.playing, self.ended_at = False, position
+                self.ended.emit()
+                continue
+            image = cv2.cvtColor(cv2.resize(image, self.size, interpolation=cv2.INTER_AREA), cv2.COLOR_BGR2RGB)
+            self.frame.emit(position, QImage(image.data, self.size[0], self.size[1], 3*self.size[0], QImage.Format_RGB888).copy())
+            position += 1
+            # Pace to the frame rate, catch up after a stall
+            due += 1/fps
+            delay = due - time.monotonic()
+            if delay > 0: self.msleep(int(delay*1000))
+            elif delay < -0.5: due = time.monotonic()
+        capture.release()
+        stream.close()
 
 
 # System Dialogs
 
+_dialogs = {}
+
+
+def SyS_dialog(dialog_class, **kwargs):
+    """ Dialogs are built once per class and set up again for each message """
+    dialog = _dialogs.get(dialog_class)
+    if dialog is None: dialog = _dialogs[dialog_class] = dialog_class()
+    # A message over one of the same kind gets its own
+    elif dialog.isVisible(): dialog = dialog_class()
+    dialog.setup(**kwargs)
+    return dialog
+
 class SyS_InputDialog(QDialog):   
-    def __init__(self, parent=None, title="title", msg="msg", msg2="Confirm password :", ispassword=False, password_confirm=False):
+    def __init__(self, parent=None):
         super(SyS_InputDialog, self).__init__(parent)
-        # Display the password window
-        self = uic.loadUi(resource_path('ui/dlg_input.ui'), self)
+        load_ui('dlg_input', self)
         self.setWindowModality(Qt.ApplicationModal)
-        self.setWindowTitle(title)
         self.setWindowIcon(QIcon(resource_path("./ui/icon.png")))
-        self.text.setText(msg)
-        if ispassword:
-            self.input.setEchoMode(QLineEdit.Password)
-            if password_confirm:
-                self.btn_ok.setEnabled(False)
-                self.text_2.setText(msg2)
-                self.input_2.setEchoMode(QLineEdit.Password)
-
-                self.input.textChanged.connect(self.chk_password)
-                self.input_2.textChanged.connect(self.chk_password)
-            else:
-                self.input_2.setVisible(False)
-                self.text_2.setVisible(False)
-                self.setMinimumHeight(120)
-                self.setMaximumHeight(120)
-                self.btn_ok.setGeometry(130,80,75,23)
-                self.btn_cancel.setGeometry(210,80,75,23)
-
+        self.password_confirm = False
+        self.input.textChanged.connect(self.chk_password)
+        self.input_2.textChanged.connect(self.chk_password)
         self.btn_ok.clicked.connect(self.accept)
         self.btn_cancel.clicked.connect(self.reject)
         self.btn_ok.setDefault(True)
+
+    def setup(self, title="title", msg="msg", msg2="Confirm password :", ispassword=False, password_confirm=False):
+        # Display the password window
+        self.setWindowTitle(title)
+        self.text.setText(msg)
+        self.password_confirm = ispassword and password_confirm
+        self.input.clear()
+        self.input_2.clear()
+        self.input.setEchoMode(QLineEdit.Password if ispassword else QLineEdit.Normal)
+        self.input_2.setEchoMode(QLineEdit.Password if self.password_confirm else QLineEdit.Normal)
+        self.btn_ok.setEnabled(not self.password_confirm)
+        if self.password_confirm: self.text_2.setText(msg2)
+        # One field to unlock, two to create a password
+        compact = ispassword and not password_confirm
+        self.input_2.setVisible(not compact)
+        self.text_2.setVisible(not compact)
+        self.setMinimumHeight(120 if compact else 190)
+        self.setMaximumHeight(120 if compact else 190)
+        self.btn_ok.setGeometry(130, 80 if compact else 150, 75, 23)
+        self.btn_cancel.setGeometry(210, 80 if compact else 150, 75, 23)
+        self.input.setFocus()
         self.show()
 
     def chk_password(self):
+        if not self.password_confirm: return
         if self.input.text() == self.input_2.text() and self.input.text()!= "" and len(self.input.text())>=6:
             self.btn_ok.setEnabled(True)
         else:
             self.btn_ok.setEnabled(False)
 
 class SyS_MsgBoxDialog(QDialog):   
-    def __init__(self, parent=None, title="title", msg="msg", clr_btn_yes=False, clr_btn_no=False, btn_no_default=True, btn_yes_default=False):
-        super(SyS_MsgBoxDialog, self).__init__(parent)
-        # Display the msg window
-        self = uic.loadUi(resource_path('ui/dlg_msg.ui'), self)
-        self.setWindowModality(Qt.ApplicationModal)
-        self.setWindowTitle(title)
-        self.setWindowIcon(QIcon(resource_path("./ui/icon.png")))
-        style = """ QPushButton {
+    style = """ QPushButton {
                     background-color:rgb(40, 40, 40);
                     color: rgb(200, 0, 10);
                     border: 2px solid rgb(200, 0, 10);
@@ -766,35 +1349,101 @@ class SyS_MsgBoxDialog(QDialog):
                     color: rgb(200, 200, 200);
                     border: 1px solid rgb(170, 0, 10);
                     }"""
-        if clr_btn_yes: self.btn_yes.setStyleSheet(style)
-        if clr_btn_no: self.btn_no.setStyleSheet(style)
-        self.text.setText(msg)
+
+    def __init__(self, parent=None):
+        super(SyS_MsgBoxDialog, self).__init__(parent)
+        load_ui('dlg_msg', self)
+        self.setWindowModality(Qt.ApplicationModal)
+        self.setWindowIcon(QIcon(resource_path("./ui/icon.png")))
         self.btn_yes.clicked.connect(self.accept)
         self.btn_no.clicked.connect(self.reject)
+
+    def setup(self, title="title", msg="msg", clr_btn_yes=False, clr_btn_no=False, btn_no_default=True, btn_yes_default=False):
+        # Display the msg window
+        self.setWindowTitle(title)
+        self.btn_yes.setStyleSheet(self.style if clr_btn_yes else "")
+        self.btn_no.setStyleSheet(self.style if clr_btn_no else "")
+        self.text.setText(msg)
         self.btn_no.setDefault(btn_no_default)
         self.btn_yes.setDefault(btn_yes_default)
         self.show()
 
 class SyS_InfoDialog(QDialog):   
-    def __init__(self, parent=None, title="title", msg="msg", ispassword=False):
+    def __init__(self, parent=None):
         super(SyS_InfoDialog, self).__init__(parent)
-        # Display simple msg window
-        self = uic.loadUi(resource_path('ui/dlg_info.ui'), self)
+        load_ui('dlg_info', self)
+        # Longer messages (an error passed on as it is) wrap onto the second line
+        self.text.setWordWrap(True)
         self.setWindowModality(Qt.ApplicationModal)
-        self.setWindowTitle(title)
         self.setWindowIcon(QIcon(resource_path("./ui/icon.png")))
+        self.btn_ok.clicked.connect(self.accept)
+        self.btn_ok.setDefault(True)
+
+    def setup(self, title="title", msg="msg", ispassword=False):
+        # Display simple msg window
+        self.setWindowTitle(title)
         self.text.setText(msg)
         if ispassword:
             self.input.setEchoMode(QLineEdit.Password)
-        self.btn_ok.clicked.connect(self.accept)
-        self.btn_ok.setDefault(True)
         self.show()
 
+class SyS_StatsDialog(QDialog):
+    """ Live stage timings and counters, tracing can be started, reset and saved from here """
+    def __init__(self, parent=None):
+        super(SyS_StatsDialog, self).__init__(parent)
+        # Display the stats window (not modal, stays open while you work)
+        load_ui('dlg_stats', self)
+        self.setWindowTitle("Performance")
+        self.setWindowIcon(QIcon(resource_path("./ui/icon.png")))
+        self.btn_trace.clicked.connect(self.f_toggle)
+        self.btn_reset.clicked.connect(self.f_reset)
+        self.btn_save.clicked.connect(self.f_save)
+        self.btn_ok.clicked.connect(self.close)
+        self.timer = QTimer(self)
+        self.timer.setInterval(500)
+        self.timer.timeout.connect(self.f_update)
+        self.f_update()
+
+    def showEvent(self, event):
+        self.timer.start()
+        super(SyS_StatsDialog, self).showEvent(event)
+
+    def hideEvent(self, event):
+        self.timer.stop()
+        super(SyS_StatsDialog, self).hideEvent(event)
+
+    def f_toggle(self):
+        TRACE.enabled = not TRACE.enabled
+        self.f_update()
+
+    def f_reset(self):
+        TRACE.reset()
+        self.f_update()
+
+    def f_save(self):
+        # Chrome trace file (chrome://tracing, Perfetto), stage names and numbers only
+        path, _ = QFileDialog.getSaveFileName(self, "Save trace", "vault_trace.json", "Trace Files (*.json)")
+        if not path: return
+        try:TRACE.dump(path)
+        except OSError as e:SyS_dialog(SyS_InfoDialog, title="Error !", msg="  Unable to save the trace.\n  " + str(e)).exec_()
+
+    def f_update(self):
+        summary = TRACE.summary()
+        lines = ["Tracing : " + ("on" if TRACE.enabled else "off"), "",
+                 "%-22s %7s %9s %9s %9s %8s" % ("Stage", "Calls", "Total s", "Max ms", "MB", "MB/s")]
+        for stage, entry in summary["stages"].items():
+            mb = entry["bytes"] / (1024*1024)
+            lines.append("%-22s %7d %9.3f %9.1f %9.1f %8s" % (stage, entry["calls"], entry["seconds"], entry["max_ms"], mb,
+                                                            "%.1f" % (mb / entry["seconds"]) if entry["bytes"] and entry["seconds"] else "-"))
+        lines += ["", "%-22s %7s" % ("Counter", "Count")]
+        lines += ["%-22s %7d" % (counter, n) for counter, n in summary["counters"].items()]
+        self.text.setPlainText("\n".join(lines))
+        self.btn_trace.setText("Stop" if TRACE.enabled else "Start")
+
 class SyS_AboutDialog(QDialog):   
     def __init__(self, parent=None):
         super(SyS_AboutDialog, self).__init__(parent)
-        # Display the about window
-        self = uic.loadUi(resource_path('ui/dlg_about.ui'), self)
+        load_ui('dlg_about', self)
         self.setWindowModality(Qt.ApplicationModal)
         self.setWindowTitle("About")
         self.setWindowIcon(QIcon(resource_path("./ui/icon.png")))
@@ -805,23 +1454,23 @@ class SyS_AboutDialog(QDialog):
         self.icon.setPixmap(pixmap)
         self.btn_ok.clicked.connect(self.accept)
         self.btn_ok.setDefault(True)
+
+    def setup(self):
+        # Display the about window
         self.show()
 
 
 # Main
 
 if __name__ == '__main__':
+    multiprocessing.freeze_support()
     app = QApplication(sys.argv)
     QApplication
 
-    # Check for directories and fix
-    directory_path = os.getcwd()
-    directory_path_data = os.path.join(directory_path, "data")
-    VaultApp.SyS_chkdirs(None, directory_path_data)
-    if not os.path.exists(os.path.join(directory_path, "data", "! DO NOT modify or delete these files !")):
-        with open(os.path.join(directory_path, "data", "! DO NOT modify or delete these files !"), "+w") as f:f.write("! DO NOT modify or delete these files !\n")
+    # The vault lives in the current directory, its data folder is created on unlock
+    vault = Vault(os.getcwd())
 
     # INFO
-    App_version = "0.1.21"
+    App_version = "0.1.22"
     VaultApp()
     sys.exit(app.exec_())
\ No newline at end of file
@@ -0,0 +1,51 @@
+import os, sys
+
+# The engine is a plain module at the top of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+PASSWORD = "secret1"
+
+
+def write_files(folder, files):
+    # {name: content} -> paths, in name order
+    os.makedirs(folder, exist_ok=True)
+    paths = []
+    for name, content in sorted(files.items()):
+        path = os.path.join(folder, name)
+        with open(path, 'wb') as f:
+            f.write(content)
+        paths.append(path)
+    return paths
+
+
+def legacy_encrypt(data, password):
+    # Format of the first releases : salt | IV | AES-CFB under PBKDF2(password, salt)
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+    from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+    from cryptography.hazmat.primitives import hashes
+    salt, iv = os.urandom(16), os.urandom(16)
+    key = PBKDF2HMAC(algorithm=hashes.SHA256(), iterations=100000, salt=salt, length=32).derive(password.encode('utf-8'))
+    encryptor = Cipher(algorithms.AES(key), modes.CFB(iv)).encryptor()
+    return salt + iv + encryptor.update(data) + encryptor.finalize()
+
+
+def make_legacy_vault(folder, password, files):
+    # Vault as the first releases left it : no key file, config.bin = password<?n?>enc name<?/?>original name<?n?>...
+    data = os.path.join(folder, "data")
+    os.makedirs(data)
+    config = password
+    for i, (name, content) in enumerate(sorted(files.items())):
+        with open(os.path.join(data, "legacy%d.enc" % i), 'wb') as f:
+            f.write(legacy_encrypt(content, password))
+        config += "<?n?>legacy%d.enc<?/?>%s" % (i, name)
+    with open(os.path.join(data, "config.bin"), 'wb') as f:
+        f.write(legacy_encrypt(config.encode('utf-8'), password))
+
+
+@pytest.fixture
+def sample(tmp_path):
+    # Small incompressible, small compressible and large (blob) files
+    files = {"photo.bin": os.urandom(200*1024), "notes.txt": b"meeting notes, nothing new\n" * 20000, "movie.bin": os.urandom(3*1024*1024 + 17)}
+    return files, write_files(str(tmp_path / "src"), files)
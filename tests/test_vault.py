@@ -0,0 +1,398 @@
+import os, time, zipfile, multiprocessing
+
+import pytest
+
+from vault import Vault, SyS_KeyRing, SyS_ThumbPack, THUMB_SLOT
+from conftest import PASSWORD, write_files, make_legacy_vault
+
+
+def contents(vault):
+    # {original name: plaintext} of every listed file
+    return {vault.name(f): bytes(vault.read(f)) for f in vault.files()}
+
+
+def stored_bytes(vault):
+    return sum(os.path.getsize(os.path.join(root, f)) for root, dirs, names in os.walk(vault.data) for f in names if f.endswith((".pack", ".enc")))
+
+
+# Open, import, export, delete
+
+def test_round_trip(tmp_path, sample):
+    files, paths = sample
+    vault = Vault(str(tmp_path / "v")).open(PASSWORD)
+    assert vault.created
+    imported, failed, no_thumbnail = vault.import_files(paths, workers=2)
+    assert len(imported) == 3 and not failed
+    vault.close()
+
+    vault = Vault(str(tmp_path / "v")).open(PASSWORD)
+    assert not vault.created
+    assert contents(vault) == files
+    # Small files are packed into a segment, the large one is a blob
+    locations = {vault.name(f): vault.index.get(f).location for f in vault.files()}
+    assert isinstance(locations["photo.bin"], list) and isinstance(locations["movie.bin"], str)
+    # Range reads only cover the chunks asked for
+    movie = vault.resolve(["movie.bin"])[0]
+    assert bytes(vault.read(movie, 1000000, 70000)) == files["movie.bin"][1000000:1070000]
+    with vault.stream(movie) as stream:
+        stream.seek(len(files["movie.bin"]) - 5)
+        assert stream.read() == files["movie.bin"][-5:]
+
+    os.makedirs(tmp_path / "out")
+    exported, errors = vault.export_files(vault.files(), str(tmp_path / "out"), workers=2)
+    assert len(exported) == 3 and not errors
+    for name, content in files.items():
+        with open(tmp_path / "out" / name, 'rb') as f:
+            assert f.read() == content
+    exported, errors = vault.export_archive(vault.files(), str(tmp_path / "all.zip"))
+    with zipfile.ZipFile(tmp_path / "all.zip") as archive:
+        assert {name: archive.read(name) for name in archive.namelist()} == files
+
+    assert sorted(vault.delete(vault.files())) == sorted(f.file for f in imported)
+    vault.compact()
+    assert vault.files() == []
+    vault.close()
+    assert Vault(str(tmp_path / "v")).open(PASSWORD).files() == []
+
+
+def test_compressible_files_shrink(tmp_path, sample):
+    files, paths = sample
+    vault = Vault(str(tmp_path / "v")).open(PASSWORD)
+    vault.import_files(paths[1:2], workers=1)
+    notes = vault.files()[0]
+    assert vault.index.get(notes).location[2] < len(files["notes.txt"]) // 4
+    assert bytes(vault.read(notes, 12345, 1000)) == files["notes.txt"][12345:13345]
+
+
+def test_wrong_password(tmp_path, sample):
+    files, paths = sample
+    Vault(str(tmp_path / "v")).open(PASSWORD).import_files(paths[:1], workers=1)
+    with pytest.raises(ValueError, match="Incorrect password"):
+        Vault(str(tmp_path / "v")).open("wrong password")
+    assert len(Vault(str(tmp_path / "v")).open(PASSWORD).files()) == 1
+
+
+def test_change_password(tmp_path, sample):
+    files, paths = sample
+    vault = Vault(str(tmp_path / "v")).open(PASSWORD)
+    vault.import_files(paths, workers=1)
+    with pytest.raises(ValueError):
+        vault.change_password("wrong password", "another1")
+    vault.change_password(PASSWORD, "another1")
+    vault.close()
+    with pytest.raises(ValueError):
+        Vault(str(tmp_path / "v")).open(PASSWORD)
+    assert contents(Vault(str(tmp_path / "v")).open("another1")) == files
+
+
+def test_delete_with_missing_blob(tmp_path, sample):
+    files, paths = sample
+    vault = Vault(str(tmp_path / "v")).open(PASSWORD)
+    vault.import_files(paths, workers=1)
+    movie = vault.resolve(["movie.bin"])[0]
+    os.remove(vault.path(movie))
+    # The entry goes, and the files after it too
+    assert len(vault.delete(sorted(vault.files(), key=lambda f: f != movie))) == 3
+    assert vault.files() == []
+
+
+# Deduplication
+
+def test_search_skips_imports_in_progress(tmp_path, sample):
+    files, paths = sample
+    vault = Vault(str(tmp_path / "v")).open(PASSWORD)
+    vault.import_files(paths[:1], workers=1)
+    jobs = vault.prepare_import(paths[1:])
+    assert [vault.name(f) for f in vault.search("")] == ["movie.bin"]
+    assert vault.search("notes") == []
+    vault.finish_import(jobs, vault.run_import(jobs, workers=1))
+    assert [vault.name(f) for f in vault.search("notes")] == ["notes.txt"]
+    assert vault.search("o", vault.search("")) == vault.search("o")
+
+
+def test_reimport_stores_nothing_new(tmp_path, sample):
+    files, paths = sample
+    vault = Vault(str(tmp_path / "v")).open(PASSWORD)
+    first, failed, _ = vault.import_files(paths, workers=1)
+    before = stored_bytes(vault)
+    again, failed, _ = vault.import_files(paths, workers=1)
+    assert len(again) == 3 and not failed
+    assert stored_bytes(vault) == before
+    assert not [folder for folder in os.listdir(os.path.join(vault.data, "blobs")) if not os.listdir(os.path.join(vault.data, "blobs", folder))]
+    # Shared content stays until the last copy goes
+    vault.delete([record.file for record in first])
+    vault.compact()
+    assert sorted(vault.name(f) for f in vault.files()) == sorted(record.name for record in again)
+    assert all(bytes(vault.read(record.file)) == files[os.path.basename(path)] for record, path in zip(again, paths))
+
+
+# Journal
+
+def test_journal_replay(tmp_path, sample):
+    files, paths = sample
+    vault = Vault(str(tmp_path / "v")).open(PASSWORD)
+    vault.import_files(paths, workers=1)
+    vault.delete(vault.resolve(["notes.txt"]), compact=False)
+    # Nothing snapshotted since the import, the journal holds both batches
+    assert vault.journal.count == 2
+    vault.close()
+    assert set(contents(Vault(str(tmp_path / "v")).open(PASSWORD))) == {"photo.bin", "movie.bin"}
+
+
+def test_journal_torn_record_is_cut_off(tmp_path, sample):
+    files, paths = sample
+    vault = Vault(str(tmp_path / "v")).open(PASSWORD)
+    vault.import_files(paths, workers=1)
+    size = os.path.getsize(vault.journal_path)
+    # A crash in the middle of an append
+    with open(vault.journal_path, 'ab') as f:
+        f.write((500).to_bytes(4, "big") + os.urandom(100))
+    vault.close()
+    vault = Vault(str(tmp_path / "v")).open(PASSWORD)
+    assert contents(vault) == files
+    assert os.path.getsize(vault.journal_path) == size
+    vault.delete(vault.resolve(["photo.bin"]), compact=False)
+    vault.close()
+    assert set(contents(Vault(str(tmp_path / "v")).open(PASSWORD))) == {"notes.txt", "movie.bin"}
+
+
+def test_journal_damaged_record_keeps_earlier_ones(tmp_path, sample):
+    files, paths = sample
+    vault = Vault(str(tmp_path / "v")).open(PASSWORD)
+    vault.import_files(paths, workers=1)
+    vault.delete(vault.resolve(["notes.txt"]), compact=False)
+    vault.close()
+    with open(os.path.join(str(tmp_path / "v"), "data", "journal.bin"), 'r+b') as f:
+        f.seek(-1, 2)
+        last = f.read(1)
+        f.seek(-1, 2)
+        f.write(bytes([last[0] ^ 1]))
+    # The import survives, the damaged delete is dropped and a new snapshot is written
+    vault = Vault(str(tmp_path / "v")).open(PASSWORD)
+    assert contents(vault) == files
+    assert vault.journal.count == 0
+
+
+# Older vaults
+
+def test_legacy_vault_upgrade(tmp_path):
+    files = {"a.txt": b"first file", "b.bin": os.urandom(5000)}
+    folder = str(tmp_path / "old")
+    make_legacy_vault(folder, PASSWORD, files)
+    for attempt in range(2):
+        with pytest.raises(ValueError, match="Incorrect password"):
+            Vault(folder).open("wrong password")
+    # A wrong password leaves the vault as it was
+    assert not os.path.exists(os.path.join(folder, "data", "vault.key"))
+
+    vault = Vault(folder).open(PASSWORD)
+    assert not vault.created and vault.needs_migration()
+    assert contents(vault) == files
+    # Nothing to authenticate in the older format, not reported as damaged
+    assert vault.scrub(workers=1) == []
+    assert not vault.migrate(workers=1)
+    assert not vault.needs_migration() and not vault.stale_files()
+    vault.close()
+
+    vault = Vault(folder).open(PASSWORD)
+    assert not vault.needs_migration()
+    assert contents(vault) == files
+    assert vault.scrub(workers=1) == []
+
+
+def test_key_file_round_trip(tmp_path):
+    path = str(tmp_path / "vault.key")
+    keyring = SyS_KeyRing.open(PASSWORD, path)
+    assert not os.path.exists(path)
+    keyring.save(path)
+    again = SyS_KeyRing.open(PASSWORD, path)
+    assert again.current == keyring.current and again.data_key() == keyring.data_key()
+    with pytest.raises(ValueError):
+        SyS_KeyRing.open("wrong password", path)
+
+
+# Integrity
+
+def test_scrub_reports_damage_and_orphans(tmp_path, sample):
+    files, paths = sample
+    vault = Vault(str(tmp_path / "v")).open(PASSWORD)
+    vault.import_files(paths, workers=1)
+    assert vault.scrub(workers=1) == []
+    photo, movie = vault.resolve(["photo.bin"])[0], vault.resolve(["movie.bin"])[0]
+    extent = vault.path(photo)
+    with open(extent.path, 'r+b') as f:
+        f.seek(extent.offset + 100)
+        byte = f.read(1)
+        f.seek(extent.offset + 100)
+        f.write(bytes([byte[0] ^ 1]))
+    os.remove(vault.path(movie))
+    with open(os.path.join(vault.data, "stray.enc"), 'wb') as f:
+        f.write(b"x")
+    report = dict(vault.scrub(workers=1))
+    assert report[photo].startswith("damaged")
+    assert report[movie].startswith("missing")
+    assert report["stray.enc"].startswith("orphan")
+    assert len(report) == 3
+
+
+def test_scrub_resumes(tmp_path, sample):
+    files, paths = sample
+    vault = Vault(str(tmp_path / "v")).open(PASSWORD)
+    vault.import_files(paths, workers=1)
+    jobs = vault.prepare_scrub()
+    # Only the first object is checked before the pass is cut short
+    first = {jobs[0][0][0]: (True, "")}
+    assert vault.finish_scrub(jobs, (first, {})) is None
+    assert vault.needs_scrub()
+    vault.close()
+    vault = Vault(str(tmp_path / "v")).open(PASSWORD)
+    assert len(vault.prepare_scrub()[0]) == len(jobs[0]) - 1
+    assert vault.scrub(workers=1) == []
+    assert not vault.needs_scrub()
+
+
+def add_thumbnails(vault, files):
+    # Seal a made-up thumbnail for each file and commit it
+    locations = vault.thumbnails.append(SyS_ThumbPack.seal(vault.thumbnails.key, file, file.encode('utf-8')) for file in files)
+    vault.commit([["thumb", file, location] for file, location in zip(files, locations)])
+
+
+def test_scrub_thumbnails(tmp_path, sample):
+    files, paths = sample
+    vault = Vault(str(tmp_path / "v")).open(PASSWORD)
+    vault.import_files(paths, workers=1)
+    add_thumbnails(vault, vault.files())
+    jobs = vault.prepare_scrub()
+    # Thumbnails are read at the scrub rate too
+    start = time.perf_counter()
+    vault.run_scrub(([], jobs[1]), rate=sum(location[2] for file, location in jobs[1]) / 0.5)
+    assert time.perf_counter() - start >= 0.5
+    # One moved meanwhile, its old record overwritten : not reported as damaged
+    moved = jobs[1][0][0]
+    add_thumbnails(vault, [moved])
+    location = jobs[1][0][1]
+    with open(vault.thumbnails.path(location[0]), 'r+b') as f:
+        f.seek(location[1]*THUMB_SLOT)
+        f.write(bytes(location[2]))
+    assert vault.finish_scrub(jobs, vault.run_scrub(jobs, workers=1)) == []
+
+
+# Several processes on one vault (the window and cli.py)
+
+def test_two_instances_share_the_journal(tmp_path, sample):
+    files, paths = sample
+    folder = str(tmp_path / "v")
+    a = Vault(folder).open(PASSWORD)
+    a.import_files(paths[:2], workers=1)
+    b = Vault(folder).open(PASSWORD)
+    # b snapshots, a commits on top of that, b commits again
+    b.save()
+    a.delete(a.resolve(["notes.txt"]), compact=False)
+    b.import_files(paths[2:], workers=1)
+    # Each sees the other's changes
+    assert b.sync() and a.sync()
+    assert set(contents(a)) == set(contents(b)) == {"photo.bin", "movie.bin"}
+    a.close()
+    b.close()
+    assert set(contents(Vault(folder).open(PASSWORD))) == {"photo.bin", "movie.bin"}
+
+
+def f_import_batches(folder, paths):
+    # Process body : import a few files at a time, snapshot half way
+    vault = Vault(folder).open(PASSWORD)
+    for i in range(0, len(paths), 2):
+        imported, failed, no_thumbnail = vault.import_files(paths[i:i + 2], workers=1)
+        assert not failed
+        if i == 2: vault.save()
+    vault.close()
+
+
+def test_two_processes_import_at_once(tmp_path):
+    np, cv2 = pytest.importorskip("numpy"), pytest.importorskip("cv2")
+    folder = str(tmp_path / "v")
+    Vault(folder).open(PASSWORD).close()
+    batches, files = [], {}
+    for process in "ab":
+        batch = {}
+        for i in range(6):
+            # Images get a thumbnail each, so both the segments and the thumbnail packs are shared
+            ok, png = cv2.imencode(".png", (np.random.rand(40, 60, 3) * 255).astype(np.uint8))
+            batch["%s%d.png" % (process, i)] = png.tobytes()
+        files.update(batch)
+        batches.append(write_files(str(tmp_path / process), batch))
+    context = multiprocessing.get_context("spawn")
+    processes = [context.Process(target=f_import_batches, args=(folder, paths)) for paths in batches]
+    for process in processes: process.start()
+    for process in processes: process.join(120)
+    assert [process.exitcode for process in processes] == [0, 0]
+
+    vault = Vault(folder).open(PASSWORD)
+    assert contents(vault) == files
+    assert all(vault.thumbnail(f) is not None for f in vault.files())
+    assert vault.scrub(workers=1) == []
+
+
+def f_import_held(folder, paths, ready, go):
+    # Process body : import small files one segment each, commit only once told to
+    import vault as engine
+    engine.SEGMENT_SIZE = 1
+    vault = Vault(folder).open(PASSWORD)
+    jobs = vault.prepare_import(paths)
+    results = vault.run_import(jobs, workers=1)
+    ready.set()
+    go.wait(120)
+    imported, failed, no_thumbnail = vault.finish_import(jobs, results)
+    assert len(imported) == len(paths)
+    vault.close()
+
+
+def test_compaction_keeps_objects_of_another_import(tmp_path, monkeypatch):
+    import vault as engine
+    monkeypatch.setattr(engine, "SEGMENT_SIZE", 1)
+    folder = str(tmp_path / "v")
+    old = {"old%d.bin" % i: os.urandom(1000) for i in range(3)}
+    Vault(folder).open(PASSWORD).import_files(write_files(str(tmp_path / "old"), old), workers=1)
+    # Older segments than this session, and an import started after it
+    time.sleep(engine.MTIME_SLACK + 0.5)
+    vault = Vault(folder).open(PASSWORD)
+    new = {"new%d.bin" % i: os.urandom(1000) for i in range(3)}
+    context = multiprocessing.get_context("spawn")
+    ready, go = context.Event(), context.Event()
+    process = context.Process(target=f_import_held, args=(folder, write_files(str(tmp_path / "new"), new), ready, go))
+    process.start()
+    assert ready.wait(120)
+    # The segments of the other import hold no object this process knows of
+    vault.delete(vault.files(), compact=False)
+    vault.compact()
+    go.set()
+    process.join(120)
+    assert process.exitcode == 0
+
+    assert 0 not in vault.segments.segments()
+    assert vault.sync()
+    assert contents(vault) == new
+    assert vault.scrub(workers=1) == []
+
+
+def test_thumbnail_compaction_keeps_the_tail_pack(tmp_path, monkeypatch):
+    import vault as engine
+    monkeypatch.setattr(engine, "THUMB_PACK_SLOTS", 2)
+    monkeypatch.setattr(engine, "THUMB_COMPACT_BYTES", 0)
+    folder = str(tmp_path / "v")
+    vault = Vault(folder).open(PASSWORD)
+    vault.import_files(write_files(str(tmp_path / "old"), {"old%d.bin" % i: os.urandom(100) for i in range(3)}), workers=1)
+    add_thumbnails(vault, vault.files())
+    vault.close()
+    time.sleep(engine.MTIME_SLACK + 0.5)
+    a, b = Vault(folder).open(PASSWORD), Vault(folder).open(PASSWORD)
+    # b seals a thumbnail into the tail pack and commits it only after a has compacted
+    imported, failed, no_thumbnail = b.import_files(write_files(str(tmp_path / "new"), {"new.bin": b"new"}), workers=1)
+    new = imported[0].file
+    location = b.thumbnails.append([SyS_ThumbPack.seal(b.thumbnails.key, new, new.encode('utf-8'))])[0]
+    a.sync()
+    a.delete(a.resolve(["old0.bin", "old1.bin"]))
+    assert 0 not in a.thumbnails.packs()
+    b.commit([["thumb", new, location]])
+
+    vault = Vault(folder).open(PASSWORD)
+    assert {vault.name(f): vault.thumbnail(f) for f in vault.files()} == {"old2.bin": vault.resolve(["old2.bin"])[0].encode('utf-8'), "new.bin": new.encode('utf-8')}
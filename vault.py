@@ -0,0 +1,2280 @@
+"""
+VaultApp engine
+Keys, metadata index, encrypted files (segments and blobs) and bulk jobs of one vault folder, without any UI.
+Used by the window (main.py) and by the command line (cli.py), imports neither PyQt5 nor OpenCV up front.
+The crypto backend, the process pool and the archive modules are imported where first used (preload() warms them up).
+"""
+
+import os, io, json, time, math, unicodedata, bisect, threading, contextlib, collections
+
+
+# Instrumentation
+
+TRACE_EVENTS = 200000                   # Timeline events kept for a trace file, stage totals and counters are always complete
+
+
+class SyS_Span:
+    """ One timed stage, recorded on exit (bytes may be set inside the block) """
+    __slots__ = ("trace", "stage", "bytes", "start")
+    def __init__(self, trace, stage, nbytes):
+        self.trace, self.stage, self.bytes = trace, stage, nbytes
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.trace.record(self.stage, self.start, time.perf_counter() - self.start, self.bytes)
+
+
+class SyS_NoSpan:
+    """ Shared stand-in while tracing is off """
+    bytes = property(lambda self: 0, lambda self, n: None)
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+class SyS_Trace:
+    """ Opt-in stage timings, byte counts and counters, holds stage and counter names only (no file names, no data) """
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.no_span = SyS_NoSpan()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.stages = {}        # stage -> [calls, seconds, max seconds, bytes]
+            self.counters = {}
+            self.events = []        # Chrome trace complete events
+            self.origin = time.perf_counter()
+
+    def span(self, stage, nbytes=0):
+        # with TRACE.span("stage"): ... (one attribute test while off)
+        return SyS_Span(self, stage, nbytes) if self.enabled else self.no_span
+
+    def count(self, counter, n=1):
+        if not self.enabled: return
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + n
+
+    def record(self, stage, start, seconds, nbytes=0):
+        with self.lock:
+            entry = self.stages.get(stage)
+            if entry is None: entry = self.stages[stage] = [0, 0.0, 0.0, 0]
+            entry[0] += 1
+            entry[1] += seconds
+            entry[2] = max(entry[2], seconds)
+            entry[3] += nbytes
+            if len(self.events) < TRACE_EVENTS:
+                self.events.append({"name": stage, "ph": "X", "ts": round((start - self.origin) * 1e6, 1), "dur": round(seconds * 1e6, 1),
+                                    "pid": os.getpid(), "tid": threading.get_ident() % 100000, "args": {"bytes": nbytes} if nbytes else {}})
+
+    def take(self):
+        # Worker : hand over what was recorded since the last call, merged by the parent
+        with self.lock:
+            snapshot = (self.stages, self.counters, self.events)
+            self.stages, self.counters, self.events = {}, {}, []
+        return snapshot
+
+    def merge(self, snapshot):
+        stages, counters, events = snapshot
+        with self.lock:
+            for stage, (calls, seconds, longest, nbytes) in stages.items():
+                entry = self.stages.setdefault(stage, [0, 0.0, 0.0, 0])
+                entry[0] += calls
+                entry[1] += seconds
+                entry[2] = max(entry[2], longest)
+                entry[3] += nbytes
+            for counter, n in counters.items():
+                self.counters[counter] = self.counters.get(counter, 0) + n
+            self.events += events[:max(0, TRACE_EVENTS - len(self.events))]
+
+    def summary(self):
+        with self.lock:
+            stages = {stage: {"calls": calls, "seconds": round(seconds, 6), "max_ms": round(longest * 1000, 3), "bytes": nbytes}
+                      for stage, (calls, seconds, longest, nbytes) in sorted(self.stages.items())}
+            return {"stages": stages, "counters": dict(sorted(self.counters.items()))}
+
+    def dump(self, path):
+        # Chrome trace (chrome://tracing, Perfetto) with the totals alongside, replaced atomically
+        report = self.summary()
+        with self.lock:
+            report["traceEvents"] = list(self.events)
+        report["displayTimeUnit"] = "ms"
+        with open(path + ".tmp", 'w', encoding='utf-8') as f:
+            json.dump(report, f)
+        os.replace(path + ".tmp", path)
+
+
+TRACE_FILE = os.environ.get("VAULT_TRACE_FILE", "")     # Trace written here on exit (turns tracing on)
+TRACE = SyS_Trace(os.environ.get("VAULT_TRACE", "0") not in ("", "0") or bool(TRACE_FILE))
+
+
+# Key management
+
+VAULT_FILE_MAGIC = b"VAULTv3\x00"     # Header of chunked AES-GCM files : magic | salt | chunk size | key number | codec | reserved
+VAULT_V2_MAGIC = b"VAULTv2\x00"       # Header of CFB files encrypted with a per-file subkey (read only)
+VAULT_HEADER_SIZE = 40
+VAULT_KEY_MAGIC = b"VAULTKEY"
+KDF_ITERATIONS = 100000
+
+
+def preload():
+    # Import the crypto backend ahead of the first unlock, e.g. on a thread while the password is typed
+    import importlib
+    for module in ("cryptography.hazmat.backends", "cryptography.hazmat.primitives.kdf.pbkdf2", "cryptography.hazmat.primitives.kdf.hkdf",
+                   "cryptography.hazmat.primitives.ciphers", "cryptography.hazmat.primitives.ciphers.aead"):
+        importlib.import_module(module)
+
+
+def derive_key(password, salt, length=32, iterations=KDF_ITERATIONS):
+    # PBKDF2 (slow by design, run once per unlock)
+    from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.backends import default_backend
+    TRACE.count("kdf")
+    kdf = PBKDF2HMAC(
+        algorithm=hashes.SHA256(),
+        iterations=iterations,
+        salt=salt,
+        length=length,
+        backend=default_backend()
+    )
+    with TRACE.span("kdf"):
+        return kdf.derive(password)
+
+
+class SyS_KeyRing:
+    """ Session keys : random data keys wrapped by a key derived from the password at unlock, cheap HKDF subkeys per file """
+    def __init__(self, password, salt, iterations=KDF_ITERATIONS, legacy_files=False):
+        self.password = password.encode('utf-8')
+        self.salt = salt
+        self.iterations = iterations
+        self.legacy_files = legacy_files
+        self.wrapping_key = derive_key(self.password, salt, iterations=iterations)
+        self.keys = {}              # key number -> data key, files name theirs in the header
+        self.current = 0
+        self.version = 2
+
+    def file_key(self, salt, slot=None):
+        # Per-file subkey
+        from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+        from cryptography.hazmat.primitives import hashes
+        from cryptography.hazmat.backends import default_backend
+        TRACE.count("subkeys")
+        hkdf = HKDF(algorithm=hashes.SHA256(), length=32, salt=salt, info=b"vaultapp file key", backend=default_backend())
+        return hkdf.derive(self.data_key(slot))
+
+    def subkey(self, info, slot=None):
+        # Fixed-purpose subkey (journal, ...)
+        from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+        from cryptography.hazmat.primitives import hashes
+        from cryptography.hazmat.backends import default_backend
+        hkdf = HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=info, backend=default_backend())
+        return hkdf.derive(self.data_key(slot))
+
+    def data_key(self, slot=None):
+        if slot is None: slot = self.current
+        if slot not in self.keys: raise ValueError("Unknown vault key " + str(slot))
+        return self.keys[slot]
+
+    def retired(self):
+        # Older keys some files may still be encrypted under (see Vault.migrate)
+        return sorted(slot for slot in self.keys if slot != self.current)
+
+    def legacy_key(self, salt):
+        # Files written before the key hierarchy, one PBKDF2 run per file
+        return derive_key(self.password, salt)
+
+    def add_key(self):
+        # New random data key, files written from now on use it
+        self.current = max(self.keys, default=0) + 1
+        self.keys[self.current] = os.urandom(32)
+
+    def retire(self):
+        self.keys = {self.current: self.keys[self.current]}
+
+    def rewrap(self, password, iterations=KDF_ITERATIONS):
+        # New password or KDF parameters : only the wrapping key changes, the data keys stay
+        self.password = password.encode('utf-8')
+        self.salt, self.iterations = os.urandom(16), iterations
+        self.wrapping_key = derive_key(self.password, self.salt, iterations=iterations)
+        self.version = 2
+
+    def check(self, password):
+        import hmac
+        return hmac.compare_digest(derive_key(password.encode('utf-8'), self.salt, iterations=self.iterations), self.wrapping_key)
+
+    @classmethod
+    def open(cls, password, path, legacy_files=False):
+        # Read the vault key file, ValueError on a wrong password
+        # Without one a new keyring is made in memory, the caller saves it once the password is known to be right
+        if not os.path.exists(path):
+            keyring = cls(password, os.urandom(16), legacy_files=legacy_files)
+            keyring.add_key()
+            return keyring
+        with open(path, 'rb') as f:
+            header = f.read()
+        if header[:8] != VAULT_KEY_MAGIC or header[8] not in (1, 2): raise ValueError("Invalid key file")
+        keyring = cls(password, header[14:30], int.from_bytes(header[10:14], "big"), bool(header[9]))
+        if header[8] == 1:
+            # Version 1 : files were encrypted under the derived key itself (key 0), the password is checked by the index
+            keyring.version, keyring.keys = 1, {0: keyring.wrapping_key}
+            return keyring
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+        aead = AESGCM(keyring.wrapping_key)
+        for pos in range(31, 31 + 61*header[30], 61):
+            slot = header[pos]
+            try:keyring.keys[slot] = aead.decrypt(header[pos+1:pos+13], header[pos+13:pos+61], header[:30] + bytes([slot]))
+            except Exception:raise ValueError("Incorrect password")
+        if not keyring.keys: raise ValueError("Invalid key file")
+        keyring.current = max(keyring.keys)
+        if keyring.iterations < KDF_ITERATIONS:
+            # Stronger KDF settings since the key file was written
+            keyring.rewrap(password)
+            keyring.save(path)
+        return keyring
+
+    def save(self, path):
+        # Layout : magic(8) | version(1) | legacy flag(1) | iterations(4) | salt(16) | keys(1) | per key : number(1) | nonce(12) | wrapped key + tag(48)
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+        head = VAULT_KEY_MAGIC + bytes([2, int(self.legacy_files)]) + self.iterations.to_bytes(4, "big") + self.salt
+        aead = AESGCM(self.wrapping_key)
+        data = head + bytes([len(self.keys)])
+        for slot, key in sorted(self.keys.items()):
+            nonce = os.urandom(12)
+            data += bytes([slot]) + nonce + aead.encrypt(nonce, key, head + bytes([slot]))
+        # The only copy of the data keys, on disk before the old file goes
+        with open(path + ".tmp", 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+
+
+# File locks
+
+LOCK_OFFSET = 1 << 40                   # Byte locked on Windows, where locks are mandatory : past any data, so readers are not held up
+
+
+def lock_file(f):
+    # Module : Exclusive lock between processes on an open file, waits until it is free
+    if os.name == "nt":
+        import msvcrt
+        f.seek(LOCK_OFFSET)
+        while True:
+            # LK_LOCK gives up after 10 tries a second apart
+            try:
+                msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                return
+            except OSError:pass
+    else:
+        import fcntl
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+
+
+def unlock_file(f):
+    # Written data reaches the file before another process may append
+    f.flush()
+    if os.name == "nt":
+        import msvcrt
+        f.seek(LOCK_OFFSET)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+    else:
+        import fcntl
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+class SyS_FileLock:
+    """ Exclusive lock between processes held on a lock file, reentrant within this process """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.RLock()
+        self.file = None
+        self.depth = 0
+
+    def __enter__(self):
+        self.lock.acquire()
+        try:
+            if not self.depth:
+                self.file = open(self.path, 'ab')
+                lock_file(self.file)
+        except:
+            if self.file: self.file.close()
+            self.file = None
+            self.lock.release()
+            raise
+        self.depth += 1
+        return self
+
+    def __exit__(self, *args):
+        self.depth -= 1
+        if not self.depth:
+            unlock_file(self.file)
+            self.file.close()
+            self.file = None
+        self.lock.release()
+
+
+# Metadata index
+
+INDEX_MAGIC = b"VAULTIDX"
+JOURNAL_MAGIC = b"VAULTJNL"
+JOURNAL_COMPACT_BYTES = 1024*1024      # Fold the journal into a new snapshot past this size (or the snapshot size)
+
+
+class SyS_Record:
+    """ Metadata of one vaulted file """
+    __slots__ = ("file", "name", "ext", "category", "size", "imported", "thumbnail", "location", "digest")
+    def __init__(self, file, name, ext, category, size=0, imported=0, thumbnail=False, location=0, digest=""):
+        self.file, self.name, self.ext, self.category = file, name, ext, category
+        self.size, self.imported, self.thumbnail, self.location, self.digest = size, imported, thumbnail, location, digest
+
+    def to_list(self):
+        # thumbnail : [pack, slot, length] in a thumbnail pack, 1 for a legacy .dat file, 0 for none
+        # location : [segment, offset, length] in a segment, blob name (1 : the file's own name), 0 for a file in the data folder (older versions), None while importing
+        # digest : keyed content hash, files with the same one share the stored object ("" for files imported before)
+        return [self.file, self.name, self.ext, self.category, self.size, self.imported, self.thumbnail if isinstance(self.thumbnail, list) else int(self.thumbnail), self.location, self.digest]
+
+    @classmethod
+    def from_list(cls, values):
+        file, name, ext, category, size, imported, thumbnail = values[:7]
+        return cls(file, name, ext, category, size, imported, thumbnail if isinstance(thumbnail, list) else bool(thumbnail), values[7] if len(values) > 7 else 0, values[8] if len(values) > 8 else "")
+
+    def blob(self):
+        # Name of the blob holding the content, None if it is not a blob
+        if self.location == 1: return self.file
+        return self.location if isinstance(self.location, str) else None
+
+    def object_key(self):
+        # Identity of the stored object, equal for files sharing one
+        if isinstance(self.location, list): return tuple(self.location[:2])
+        return self.blob() or self.file
+
+
+class SyS_Index:
+    """ Records keyed by encrypted name, with secondary indexes by category, original name, content digest and normalized name """
+    def __init__(self, records=(), journal_id=""):
+        self.records = {}
+        self.by_category = {}
+        self.by_name = {}
+        self.by_digest = {}
+        self.names = {}
+        self.journal_id = journal_id
+        self._haystack = None
+        for record in records: self.add(record)
+
+    @staticmethod
+    def normalize(name):
+        return unicodedata.normalize("NFKC", name).casefold()
+
+    def __len__(self):
+        return len(self.records)
+
+    def __contains__(self, file):
+        return file in self.records
+
+    def get(self, file):
+        return self.records.get(file)
+
+    def add(self, record):
+        if record.file in self.records: self.remove(record.file)
+        self.records[record.file] = record
+        self.by_category.setdefault(record.category, {})[record.file] = None
+        self.by_name.setdefault(record.name, {})[record.file] = None
+        if record.digest: self.by_digest.setdefault(record.digest, {})[record.file] = None
+        # Search index
+        self.names[record.file] = self.normalize(record.name)
+        self._haystack = None
+
+    def remove(self, file):
+        record = self.records.pop(file, None)
+        if record is None: return None
+        self.by_category[record.category].pop(file, None)
+        self.by_name[record.name].pop(file, None)
+        if not self.by_name[record.name]: del self.by_name[record.name]
+        # An importing record gets its digest before it is added again
+        if record.digest in self.by_digest:
+            self.by_digest[record.digest].pop(file, None)
+            if not self.by_digest[record.digest]: del self.by_digest[record.digest]
+        del self.names[file]
+        self._haystack = None
+        return record
+
+    def rename(self, file, name):
+        record = self.remove(file)
+        if record is None: return
+        record.name = name
+        self.add(record)
+
+    def apply(self, ops):
+        # Journal operations : ["add", record list] | ["delete", file] | ["rename", file, name] | ["thumb", file, location] | ["place", file, location]
+        for op in ops:
+            if op[0] == "add": self.add(SyS_Record.from_list(op[1]))
+            elif op[0] == "delete": self.remove(op[1])
+            elif op[0] == "rename": self.rename(op[1], op[2])
+            elif op[0] == "thumb" and op[1] in self.records: self.records[op[1]].thumbnail = op[2]
+            elif op[0] == "place" and op[1] in self.records: self.records[op[1]].location = op[2]
+
+    def has_name(self, name):
+        return name in self.by_name
+
+    def sharing(self, record, exclude=()):
+        # Other files stored as the same object as record (same content, deduplicated at import)
+        if not record.digest: return []
+        key = record.object_key()
+        return [file for file in self.by_digest.get(record.digest, ()) if file != record.file and file not in exclude and self.records[file].object_key() == key]
+
+    def category(self, category):
+        # Encrypted names of one category, in import order
+        if category == "all": return list(self.records)
+        return list(self.by_category.get(category, ()))
+
+    def search(self, keyword, within=None):
+        # Substring search over normalized names, within : results of a shorter query contained in this one
+        keyword = self.normalize(keyword)
+        if not keyword: return list(self.records)
+        if "\0" in keyword: return []
+        if within is not None:
+            return [file for file in within if keyword in self.names.get(file, "")]
+
+        # All names in one NUL separated string, str.find skips non-matching names in C
+        if self._haystack is None:
+            files = list(self.names)
+            offsets, pos = [], 0
+            for file in files:
+                offsets.append(pos)
+                pos += len(self.names[file]) + 1
+            self._haystack = ("\0".join(self.names[file] for file in files), files, offsets)
+        haystack, files, offsets = self._haystack
+
+        results = []
+        pos = haystack.find(keyword)
+        while pos != -1:
+            i = bisect.bisect_right(offsets, pos) - 1
+            results.append(files[i])
+            if i + 1 == len(offsets): break
+            pos = haystack.find(keyword, offsets[i + 1])
+        return results
+
+    def dumps(self):
+        # Layout : magic | JSON {version, journal, records: [[file, name, ext, category, size, imported, thumbnail, location, digest], ...]}
+        records = [r.to_list() for r in self.records.values()]
+        return INDEX_MAGIC + json.dumps({"version": 1, "journal": self.journal_id, "records": records}, separators=(',', ':')).encode('utf-8')
+
+    @classmethod
+    def loads(cls, data):
+        if not data.startswith(INDEX_MAGIC): raise ValueError("Not an index")
+        content = json.loads(data[len(INDEX_MAGIC):].decode('utf-8'))
+        return cls((SyS_Record.from_list(r) for r in content["records"]), content.get("journal", ""))
+
+
+class SyS_Journal:
+    """ Append-only log of index changes since the last snapshot, one AES-GCM sealed record per batch """
+    def __init__(self, path, key, journal_id):
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+        self.path = path
+        self.aead = AESGCM(key)
+        self.journal_id = journal_id
+        self.count = 0
+        self.size = 0
+        self.damaged = False
+
+    def aad(self, seq):
+        # Bind each record to this journal and its position
+        return JOURNAL_MAGIC + self.journal_id.encode('utf-8') + seq.to_bytes(8, "big")
+
+    def replay(self, index):
+        # Apply records written after the snapshot, a torn last record is cut off
+        if not os.path.exists(self.path): return self.reset(self.journal_id)
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        header = JOURNAL_MAGIC + self.journal_id.encode('utf-8')
+        if not data.startswith(header):
+            # Journal of an older snapshot, already folded in
+            return self.reset(self.journal_id)
+        pos = len(header)
+        while pos + 4 <= len(data):
+            length = int.from_bytes(data[pos:pos+4], "big")
+            if pos + 4 + length > len(data): break
+            try:
+                ops = json.loads(self.aead.decrypt(data[pos+4:pos+16], data[pos+16:pos+4+length], self.aad(self.count)))
+            except Exception:
+                # Exception : Damaged record, keep what was read so far and compact
+                self.damaged = True
+                break
+            index.apply(ops)
+            self.count += 1
+            pos += 4 + length
+        if pos != len(data) and not self.damaged:
+            with open(self.path, 'r+b') as f:
+                f.truncate(pos)
+        self.size = pos
+
+    def follow(self, index):
+        # Apply records appended by another process since the last read, a record still being written waits for the next call
+        # Returns the number of records applied, None once the journal belongs to a newer snapshot
+        try:
+            with open(self.path, 'rb') as f:
+                header = JOURNAL_MAGIC + self.journal_id.encode('utf-8')
+                if f.read(len(header)) != header: return None
+                if os.fstat(f.fileno()).st_size == self.size: return 0
+                f.seek(self.size)
+                data = f.read()
+        except OSError:
+            return None
+        pos, count = 0, 0
+        while pos + 4 <= len(data):
+            length = int.from_bytes(data[pos:pos+4], "big")
+            if pos + 4 + length > len(data): break
+            try:ops = json.loads(self.aead.decrypt(data[pos+4:pos+16], data[pos+16:pos+4+length], self.aad(self.count)))
+            except Exception:return None
+            index.apply(ops)
+            self.count, count = self.count + 1, count + 1
+            pos += 4 + length
+        self.size += pos
+        return count
+
+    def append(self, ops):
+        # One record per batch, cost depends on the batch only
+        nonce = os.urandom(12)
+        sealed = nonce + self.aead.encrypt(nonce, json.dumps(ops, separators=(',', ':')).encode('utf-8'), self.aad(self.count))
+        with open(self.path, 'ab') as f:
+            f.write(len(sealed).to_bytes(4, "big") + sealed)
+            f.flush()
+            os.fsync(f.fileno())
+        self.count += 1
+        self.size += 4 + len(sealed)
+
+    def reset(self, journal_id):
+        # Start an empty journal for a new snapshot
+        self.journal_id = journal_id
+        header = JOURNAL_MAGIC + journal_id.encode('utf-8')
+        with open(self.path + ".tmp", 'wb') as f:
+            f.write(header)
+        os.replace(self.path + ".tmp", self.path)
+        self.count, self.size, self.damaged = 0, len(header), False
+
+
+# Thumbnail packs
+
+THUMB_KEY_INFO = b"vaultapp thumbnails"
+THUMB_SLOT = 16*1024                    # Record granularity, a thumbnail takes whole slots
+THUMB_PACK_SLOTS = 4096                 # Slots per pack file (64 MiB)
+THUMB_READ_GAP = 8                      # Unwanted slots read through rather than seeking past them
+THUMB_COMPACT_BYTES = 16*1024*1024      # Dead pack space tolerated before compaction (or the live size)
+THUMB_RESEAL_BATCH = 1024               # Thumbnails sealed again per batch after a key change
+
+
+class SyS_ThumbPack:
+    """ Encrypted thumbnails in a few pack files, a record is located by [pack, first slot, length(, file it was sealed for)] """
+    def __init__(self, directory, key, retired=()):
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+        self.directory = directory
+        self.key = key
+        self.aead = AESGCM(key)
+        # Keys of records sealed before a key change, tried after the current one until reseal() has moved them
+        self.retired = [AESGCM(old) for old in retired]
+        self.lock = threading.Lock()
+        packs = self.packs()
+        self.tail = packs[-1] if packs else 0
+
+    def path(self, pack):
+        return os.path.join(self.directory, "thumbs" + str(pack) + ".pack")
+
+    def packs(self):
+        # Pack numbers on disk, numbers are never reused
+        return sorted(int(f[6:-5]) for f in os.listdir(self.directory) if f.startswith("thumbs") and f.endswith(".pack") and f[6:-5].isdigit())
+
+    def size(self):
+        return sum(os.path.getsize(self.path(pack)) for pack in self.packs())
+
+    @staticmethod
+    def seal(key, file, data):
+        # Module : One record, bound to the encrypted name of its file (workers seal, the pack owner appends)
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+        nonce = os.urandom(12)
+        return nonce + AESGCM(key).encrypt(nonce, data, file.encode('utf-8'))
+
+    def append(self, records):
+        # Module : Write sealed records at the tail, returns their locations
+        # Slots are counted from the end of the locked file, another process (cli.py, a second window) may append too
+        locations = []
+        with self.lock:
+            f = None
+            try:
+                for sealed in records:
+                    if f is None: f = self.open_tail()
+                    end = f.seek(0, 2)
+                    slot, slots = -(-end // THUMB_SLOT), -(-len(sealed) // THUMB_SLOT)
+                    if slot and slot + slots > THUMB_PACK_SLOTS:
+                        self.close_tail(f)
+                        f = None
+                        self.tail += 1
+                        f = self.open_tail()
+                        end = f.seek(0, 2)
+                        slot = -(-end // THUMB_SLOT)
+                    # Pad the previous record to its last slot
+                    f.write(bytes(slot*THUMB_SLOT - end))
+                    f.write(sealed)
+                    locations.append([self.tail, slot, len(sealed)])
+            finally:
+                if f: self.close_tail(f)
+        return locations
+
+    def open_tail(self):
+        # Tail pack opened for appending and locked, a newer one started by another process takes over
+        while True:
+            while os.path.exists(self.path(self.tail + 1)): self.tail += 1
+            f = open(self.path(self.tail), 'ab')
+            lock_file(f)
+            if not os.path.exists(self.path(self.tail + 1)): return f
+            self.close_tail(f)
+
+    @staticmethod
+    def close_tail(f):
+        unlock_file(f)
+        f.close()
+
+    def read_sealed(self, items):
+        # Module : (file, sealed record) for [(file, location)], one read per run of nearby records
+        by_pack = {}
+        for file, location in items: by_pack.setdefault(location[0], []).append((location[1], location[2], file))
+        for pack, records in by_pack.items():
+            records.sort()
+            TRACE.count("files_opened")
+            try:f = open(self.path(pack), 'rb')
+            except OSError:
+                # Exception : Pack missing
+                for slot, length, file in records: yield file, None
+                continue
+            with f:
+                i = 0
+                while i < len(records):
+                    j = i + 1
+                    while j < len(records) and records[j][0] - records[j-1][0] - -(-records[j-1][1] // THUMB_SLOT) <= THUMB_READ_GAP: j += 1
+                    start = records[i][0]*THUMB_SLOT
+                    f.seek(start)
+                    span = memoryview(f.read(records[j-1][0]*THUMB_SLOT + records[j-1][1] - start))
+                    for slot, length, file in records[i:j]:
+                        offset = slot*THUMB_SLOT - start
+                        yield file, span[offset:offset + length] if offset + length <= len(span) else None
+                    i = j
+
+    def read(self, items):
+        # Module : {file: thumbnail or None} for [(file, location)], decrypted in one batch
+        result, sealed_for = {}, self.sealed_for(items)
+        with TRACE.span("thumbnail.read") as span:
+            for file, sealed in self.read_sealed(items):
+                result[file] = self.unseal(sealed_for.get(file, file), sealed)
+                if sealed is not None: span.bytes += len(sealed)
+        return result
+
+    @staticmethod
+    def sealed_for(items):
+        # {file: name its record is sealed for} of the files sharing another file's record (identical content)
+        return {file: location[3] for file, location in items if len(location) > 3}
+
+    def unseal(self, file, sealed, keys=None):
+        # Plaintext of one record or None, under the current key or a retired one
+        if sealed is None: return None
+        for aead in keys or [self.aead] + self.retired:
+            try:return aead.decrypt(sealed[:12], sealed[12:], file.encode('utf-8'))
+            except Exception:pass
+        return None
+
+    def reseal(self, items):
+        # Module : Records of [(file, location)] still sealed under a retired key, sealed again at the tail -> {file: new location}
+        # The caller commits the locations, the old records are dead space for compaction
+        files, records, sealed_for = [], [], self.sealed_for(items)
+        for file, sealed in self.read_sealed(items):
+            if sealed is None or not self.retired or self.unseal(sealed_for.get(file, file), sealed, [self.aead]) is not None: continue
+            data = self.unseal(sealed_for.get(file, file), sealed, self.retired)
+            if data is None: continue
+            files.append(file)
+            records.append(self.seal(self.key, file, data))
+        return dict(zip(files, self.append(records)))
+
+    def compact(self, items):
+        # Module : Copy live records [(file, location)] (still sealed) to the tail, returns {file: new location}
+        # The caller picks closed packs only and saves the index before removing them
+        # A record shared by several files is copied once
+        first, shared = {}, []
+        for file, location in items:
+            if tuple(location[:2]) in first: shared.append((file, location))
+            else: first[tuple(location[:2])] = (file, location)
+        files = []
+        def f_records():
+            for file, sealed in self.read_sealed(list(first.values())):
+                if sealed is None: continue
+                files.append(file)
+                yield sealed
+        moved = dict(zip(files, self.append(f_records())))
+        for file, location in list(first.values()) + shared:
+            owner = first[tuple(location[:2])][0]
+            if owner in moved: moved[file] = moved[owner][:3] + location[3:]
+        return moved
+
+    def remove(self, packs):
+        for pack in packs:
+            try:os.remove(self.path(pack))
+            except:pass
+
+
+# Segments
+
+SEGMENT_SIZE = 256*1024*1024            # A segment is closed once the next object would take it past this
+PACK_OBJECT_LIMIT = 1024*1024           # Files up to this size are packed into segments, larger ones get a blob of their own
+SEGMENT_COMPACT_RATIO = 0.5             # Dead share of a closed segment that has its live objects copied out
+BLOB_DIRECTORY = "blobs"                # Blobs sit in subfolders by the first two letters of their name
+MTIME_SLACK = 2                         # Seconds, file times are coarser than the clock (2 s on FAT)
+
+
+class SyS_Extent:
+    """ Where a packed file is : segment path, offset and length of its VAULTv3 object """
+    __slots__ = ("path", "offset", "length")
+    def __init__(self, path, offset, length):
+        self.path, self.offset, self.length = path, offset, length
+
+
+class SyS_Segments:
+    """ Small files as whole VAULTv3 objects in large append-only segment files, an object is located by [segment, offset, length] """
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.dirty = set()
+        segments = self.segments()
+        self.tail = segments[-1] if segments else 0
+
+    def path(self, segment):
+        return os.path.join(self.directory, "segment" + str(segment) + ".pack")
+
+    def segments(self):
+        # Segment numbers on disk, numbers are never reused
+        return sorted(int(f[7:-5]) for f in os.listdir(self.directory) if f.startswith("segment") and f.endswith(".pack") and f[7:-5].isdigit())
+
+    def extent(self, location):
+        return SyS_Extent(self.path(location[0]), location[1], location[2])
+
+    def append(self, objects):
+        # Module : Write objects at the tail, returns their locations (on disk after sync())
+        # Offsets are taken at the end of the locked file, another process (cli.py, a second window) may append too
+        locations = []
+        with self.lock:
+            f = None
+            try:
+                for data in objects:
+                    if f is None: f = self.open_tail()
+                    offset = f.seek(0, 2)
+                    if offset and offset + len(data) > SEGMENT_SIZE:
+                        self.close_tail(f)
+                        f = None
+                        self.tail += 1
+                        f = self.open_tail()
+                        offset = f.seek(0, 2)
+                    f.write(data)
+                    locations.append([self.tail, offset, len(data)])
+            finally:
+                if f: self.close_tail(f)
+        return locations
+
+    def open_tail(self):
+        # Tail segment opened for appending and locked, a newer one started by another process takes over
+        while True:
+            while os.path.exists(self.path(self.tail + 1)): self.tail += 1
+            f = open(self.path(self.tail), 'ab')
+            lock_file(f)
+            if not os.path.exists(self.path(self.tail + 1)):
+                self.dirty.add(self.tail)
+                return f
+            self.close_tail(f)
+
+    @staticmethod
+    def close_tail(f):
+        unlock_file(f)
+        f.close()
+
+    def sync(self):
+        # Flush appended objects before the index points at them
+        with self.lock:
+            dirty, self.dirty = self.dirty, set()
+        for segment in dirty:
+            try:
+                with open(self.path(segment), 'rb+') as f:
+                    os.fsync(f.fileno())
+            except OSError:pass
+
+    def compact(self, items, progress=None, cancel=None):
+        # Module : Copy live objects [(file, location)] out of closed segments to the tail (still sealed), returns {file: new location}
+        # An object shared by several files is copied once, the caller commits the locations before removing the old segments
+        moved, copied = {}, {}
+        by_segment = {}
+        for file, location in items: by_segment.setdefault(location[0], []).append((location[1], location[2], file))
+        try:
+            for segment, objects in sorted(by_segment.items()):
+                TRACE.count("files_opened")
+                try:f = open(self.path(segment), 'rb')
+                except OSError:continue
+                with f:
+                    for offset, length, file in sorted(objects):
+                        if offset in copied:
+                            moved[file] = copied[offset]
+                            continue
+                        if cancel is not None and cancel.is_set(): return moved
+                        f.seek(offset)
+                        data = f.read(length)
+                        if len(data) != length: continue
+                        moved[file] = copied[offset] = self.append([data])[0]
+                        if progress: progress(length)
+                copied = {}
+        finally:
+            self.sync()
+        return moved
+
+    def remove(self, segments):
+        for segment in segments:
+            try:os.remove(self.path(segment))
+            except:pass
+
+
+# File pipeline
+
+WORKERS = int(os.environ.get("VAULT_WORKERS", "0")) or os.cpu_count() or 2     # Worker processes for bulk jobs
+IO_BUFFER_SIZE = int(os.environ.get("VAULT_IO_BUFFER_MB", "4")) * 1024*1024     # Read / cipher buffer, reused for a whole file
+IMPORT_READ_LIMIT = 256*1024*1024       # Images up to this size are read once for encryption and thumbnail
+CHUNK_SIZE = 1024*1024                  # Plaintext per authenticated chunk of a VAULTv3 file
+SPLIT_SIZE = 64*1024*1024               # Files above this are decrypted by several workers, one range each
+STREAM_WINDOW = 4*1024*1024             # Read-ahead of a streaming reader, the most plaintext it keeps in RAM
+DIGEST_KEY_INFO = b"vaultapp content digest"
+COMPRESSION = os.environ.get("VAULT_COMPRESSION", "zlib")      # zlib, zstd (needs the optional zstandard package wherever the vault is opened) or off
+COMPRESS_SAMPLE = 4096                  # Bytes from the middle of a chunk whose entropy decides if it is worth compressing
+COMPRESS_ENTROPY = 7.5                  # Bits per byte above which a chunk is stored as is (JPEG, MP4, archives)
+COMPRESS_GAIN = 0.9                     # A compressed chunk is kept below this share of its size, else stored as is
+CODEC_ZLIB, CODEC_ZSTD = 1, 2           # Header codec of a compressed file, 0 : not compressed
+CHUNK_PREFIX = 8                        # Chunk of a compressed file : stored length (top bit : compressed) | plaintext length | sealed data
+SCRUB_RATE = float(os.environ.get("VAULT_SCRUB_MB_S", "32")) * 1024*1024       # Read rate of an integrity scrub over all its workers, 0 : unthrottled
+SCRUB_INTERVAL = 7*24*3600              # A new scrub pass starts this long after the last one completed
+
+
+class SyS_Cancelled(Exception):
+    pass
+
+
+class SyS_MissingCodec(ValueError):
+    pass
+
+
+def _read_full(infile, buf):
+    # Module : Fill buf unless the stream ends first, returns the byte count
+    pos = 0
+    while pos < len(buf):
+        n = infile.readinto(buf[pos:])
+        if not n: break
+        pos += n
+    return pos
+
+
+def _chunk_nonce(index, last):
+    # STREAM nonce : chunk index | last chunk flag, a cut or reordered file fails authentication
+    return index.to_bytes(11, "big") + (b"\x01" if last else b"\x00")
+
+
+def _codec():
+    # Module : Codec new files are compressed with, zstd only when asked for and installed
+    if COMPRESSION in ("off", "none", "0", ""): return 0
+    if COMPRESSION == "zstd":
+        try:
+            import zstandard
+            return CODEC_ZSTD
+        except ImportError:pass
+    return CODEC_ZLIB
+
+
+def _entropy(data):
+    # Shannon entropy of a sample from the middle of data in bits per byte (8 : random, nothing to gain)
+    start = max(0, (len(data) - COMPRESS_SAMPLE) // 2)
+    sample = bytes(data[start:start + COMPRESS_SAMPLE])
+    if not sample: return 8.0
+    return -sum(count*math.log2(count/len(sample)) for count in collections.Counter(sample).values()) / len(sample)
+
+
+def _pack_chunk(codec, data):
+    # Module : (stored bytes, compressed) of one chunk, media and other random looking data skip the compressor
+    if _entropy(data) < COMPRESS_ENTROPY:
+        with TRACE.span("compress") as span:
+            if codec == CODEC_ZSTD:
+                import zstandard
+                packed = zstandard.ZstdCompressor(level=3).compress(data)
+            else:
+                import zlib
+                packed = zlib.compress(data, 1)
+            span.bytes = len(data)
+        if len(packed) < len(data)*COMPRESS_GAIN: return packed, True
+    return data, False
+
+
+def _unpack_chunk(codec, data, size):
+    # Module : Plaintext of one compressed chunk
+    if codec == CODEC_ZSTD:
+        try:import zstandard
+        except ImportError:raise SyS_MissingCodec("Compressed with zstd, needs the zstandard package")
+        return zstandard.ZstdDecompressor().decompress(data, max_output_size=size)
+    if codec == CODEC_ZLIB:
+        import zlib
+        return zlib.decompress(data, bufsize=size)
+    raise ValueError("Unknown compression")
+
+
+def encrypt_stream(infile, output_file, keyring, progress=None, chunk_size=CHUNK_SIZE, codec=None):
+    # Module : Write a VAULTv3 file (a path, or a writable stream for a segment object) from a readable binary stream
+    # AES-GCM per chunk, two input buffers for lookahead
+    # Compressed when the first chunk gains from it (codec in the header), each chunk behind a prefix sealed with it
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+    from cryptography.hazmat.backends import default_backend
+    bufs = [memoryview(bytearray(chunk_size)), memoryview(bytearray(chunk_size))]
+    outbuf = memoryview(bytearray(chunk_size + 15))
+    n = _read_full(infile, bufs[0])
+    codec = _codec() if codec is None else codec
+    packed = _pack_chunk(codec, bufs[0][:n]) if codec else (None, False)
+    if not packed[1]: codec = 0
+    salt = os.urandom(16)
+    header = VAULT_FILE_MAGIC + salt + chunk_size.to_bytes(4, "big") + bytes([keyring.current, codec]) + bytes(10)
+    key = algorithms.AES(keyring.file_key(salt))
+    if isinstance(output_file, str): TRACE.count("files_opened")
+    with open(output_file, 'wb') if isinstance(output_file, str) else contextlib.nullcontext(output_file) as outfile, TRACE.span("encrypt") as span:
+        outfile.write(header)
+        index = 0
+        while True:
+            # A short chunk is the last one, a full one needs a look at what follows
+            following = _read_full(infile, bufs[(index + 1) % 2]) if n == chunk_size else 0
+            encryptor = Cipher(key, modes.GCM(_chunk_nonce(index, following == 0)), backend=default_backend()).encryptor()
+            if codec:
+                data, compressed = packed if index == 0 else _pack_chunk(codec, bufs[index % 2][:n])
+                prefix = (len(data) | (0x80000000 if compressed else 0)).to_bytes(4, "big") + n.to_bytes(4, "big")
+                encryptor.authenticate_additional_data(header + prefix)
+                outfile.write(prefix)
+            else:
+                data = bufs[index % 2][:n]
+                encryptor.authenticate_additional_data(header)
+            outfile.write(outbuf[:encryptor.update_into(data, outbuf)])
+            encryptor.finalize()
+            outfile.write(encryptor.tag)
+            if progress: progress(n)
+            if following == 0: break
+            index, n = index + 1, following
+        span.bytes = index*chunk_size + n
+
+
+def _chunk_table(infile, start, length):
+    # Module : [(position, prefix, plaintext length)] of the chunks of a compressed file (they vary in length), one small read each
+    table, pos = [], VAULT_HEADER_SIZE
+    while pos < length:
+        infile.seek(start + pos)
+        prefix = infile.read(CHUNK_PREFIX)
+        if len(prefix) < CHUNK_PREFIX: raise ValueError("Truncated vault file")
+        table.append((pos, prefix, int.from_bytes(prefix[4:], "big")))
+        pos += CHUNK_PREFIX + (int.from_bytes(prefix[:4], "big") & 0x7fffffff) + 16
+    if pos != length or not table: raise ValueError("Truncated vault file")
+    return table
+
+
+def _open_source(source):
+    # Module : (file, start, length) of a vault file path or of a segment extent
+    TRACE.count("files_opened")
+    if isinstance(source, SyS_Extent):
+        f = open(source.path, 'rb', buffering=0)
+        f.seek(source.offset)
+        return f, source.offset, source.length
+    f = open(source, 'rb', buffering=0)
+    return f, 0, os.fstat(f.fileno()).st_size
+
+
+class SyS_VaultReader:
+    """ Random access to the plaintext of one vault file (a path or a segment extent), VAULTv3 chunks or older CFB streams """
+    def __init__(self, source, keyring):
+        from cryptography.hazmat.primitives.ciphers import algorithms
+        self.file, self.start, length = _open_source(source)
+        try:
+            self.header = self.file.read(VAULT_HEADER_SIZE)
+            if self.header[:8] == VAULT_FILE_MAGIC and len(self.header) == VAULT_HEADER_SIZE:
+                self.version = 3
+                self.chunk_size = int.from_bytes(self.header[24:28], "big")
+                self.key = algorithms.AES(keyring.file_key(self.header[8:24], self.header[28]))
+                self.codec = self.header[29]
+                stride = self.chunk_size + 16
+                self.body = length - VAULT_HEADER_SIZE
+                if self.codec:
+                    self.table = _chunk_table(self.file, self.start, length)
+                    self.chunks = len(self.table)
+                    self.size = sum(plain for pos, prefix, plain in self.table)
+                else:
+                    self.chunks = -(-self.body // stride)
+                    if not self.chunk_size or self.body <= 0 or 0 < self.body % stride < 16: raise ValueError("Truncated vault file")
+                    self.size = self.body - 16*self.chunks
+            elif self.header[:8] == VAULT_V2_MAGIC:
+                # VAULTv2 : magic | salt | IV | CFB data (older versions, never in a segment)
+                self.version, self.offset = 2, 40
+                self.key, self.iv = algorithms.AES(keyring.file_key(self.header[8:24], 0)), self.header[24:40]
+                self.size = max(0, length - 40)
+            else:
+                # Legacy file : salt | IV | CFB data
+                self.version, self.offset = 1, 32
+                self.key, self.iv = algorithms.AES(keyring.legacy_key(self.header[:16])), self.header[16:32]
+                self.size = max(0, length - 32)
+        except:
+            self.file.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.file.close()
+
+    def _open_chunk(self, index, sealed, out, prefix=b""):
+        # Decrypt one chunk into out, the tag is checked before the caller sees it
+        from cryptography.hazmat.primitives.ciphers import Cipher, modes
+        from cryptography.hazmat.backends import default_backend
+        if len(sealed) < 16: raise ValueError("Truncated vault file")
+        decryptor = Cipher(self.key, modes.GCM(_chunk_nonce(index, index == self.chunks - 1), bytes(sealed[-16:])), backend=default_backend()).decryptor()
+        decryptor.authenticate_additional_data(self.header + prefix)
+        n = decryptor.update_into(sealed[:-16], out)
+        decryptor.finalize()
+        return n
+
+    def _read_packed(self, index):
+        # Plaintext of one chunk of a compressed file, authenticated with its prefix before it is inflated
+        pos, prefix, plain = self.table[index]
+        stored = int.from_bytes(prefix[:4], "big")
+        self.file.seek(self.start + pos + CHUNK_PREFIX)
+        sealed = self.file.read((stored & 0x7fffffff) + 16)
+        out = bytearray(len(sealed) + 15)
+        data = memoryview(out)[:self._open_chunk(index, sealed, out, prefix)]
+        if stored & 0x80000000:
+            with TRACE.span("decompress", plain):
+                data = _unpack_chunk(self.codec, data, plain)
+        # Every chunk but the last is full, offsets are counted in chunks
+        if len(data) != plain or plain > self.chunk_size or (index < self.chunks - 1 and plain != self.chunk_size): raise ValueError("Corrupt vault file")
+        return data
+
+    def chunks_at(self, offset=0, length=None, progress=None, buffer_size=IO_BUFFER_SIZE):
+        # Plaintext of [offset, offset + length) as views of one reused buffer (valid until the next one)
+        end = self.size if length is None else min(self.size, offset + length)
+        if self.version == 3 and self.codec:
+            if offset >= end and self.size: return
+            first, last = offset // self.chunk_size, self.chunks - 1 if end == self.size else (end - 1) // self.chunk_size
+            for index in range(first, last + 1):
+                data, base = self._read_packed(index), index*self.chunk_size
+                yield memoryview(data)[max(0, offset - base):min(len(data), end - base)]
+                if progress: progress(len(data))
+        elif self.version == 3:
+            if offset >= end and self.size: return
+            # A read up to the end always opens the last chunk, its flag proves nothing was cut off
+            stride = self.chunk_size + 16
+            first, last = offset // self.chunk_size, self.chunks - 1 if end == self.size else (end - 1) // self.chunk_size
+            batch = max(1, buffer_size // stride)
+            inbuf = memoryview(bytearray(min(batch, last - first + 1) * stride))
+            outbuf = memoryview(bytearray(len(inbuf) // stride * self.chunk_size + 15))
+            index = first
+            while index <= last:
+                count = min(len(inbuf) // stride, last - index + 1)
+                self.file.seek(self.start + VAULT_HEADER_SIZE + index*stride)
+                # Never past the object, a segment holds others after it
+                n = _read_full(self.file, inbuf[:min(count*stride, self.body - index*stride)])
+                pos = 0
+                for k in range(count):
+                    pos += self._open_chunk(index + k, inbuf[k*stride:min(n, (k + 1)*stride)], outbuf[pos:])
+                base = index*self.chunk_size
+                yield outbuf[max(0, offset - base):min(pos, end - base)]
+                if progress: progress(n)
+                index += count
+        else:
+            # CFB : the IV of a block is the ciphertext block before it
+            from cryptography.hazmat.primitives.ciphers import Cipher, modes
+            from cryptography.hazmat.backends import default_backend
+            if offset >= end: return
+            start = offset - offset % 16
+            self.file.seek(self.offset + start - (16 if start else 0))
+            iv = self.file.read(16) if start else self.iv
+            decryptor = Cipher(self.key, modes.CFB(iv), backend=default_backend()).decryptor()
+            inbuf = memoryview(bytearray(min(buffer_size, end - start)))
+            outbuf = memoryview(bytearray(len(inbuf) + 15))
+            skip, remaining = offset - start, end - start
+            while remaining > 0:
+                n = self.file.readinto(inbuf[:min(len(inbuf), remaining)])
+                if not n: break
+                m = decryptor.update_into(inbuf[:n], outbuf)
+                yield outbuf[skip:m]
+                if progress: progress(n)
+                skip, remaining = 0, remaining - n
+
+    def read(self, offset, length):
+        # Module : Plaintext bytes of one range
+        return b"".join(bytes(chunk) for chunk in self.chunks_at(offset, length))
+
+    def read_all(self, progress=None, buffer_size=IO_BUFFER_SIZE):
+        # Module : Whole plaintext, decrypted straight into one presized buffer
+        with TRACE.span("decrypt", self.size):
+            return self._read_all(progress, buffer_size)
+
+    def _read_all(self, progress, buffer_size):
+        data = bytearray(self.size + 15)
+        out = memoryview(data)
+        pos = 0
+        if self.version == 3 and self.codec:
+            for chunk in self.chunks_at(0, None, progress):
+                out[pos:pos + len(chunk)] = chunk
+                pos += len(chunk)
+        elif self.version == 3:
+            stride = self.chunk_size + 16
+            batch = max(1, min(self.chunks, buffer_size // stride))
+            inbuf = memoryview(bytearray(batch*stride))
+            self.file.seek(self.start + VAULT_HEADER_SIZE)
+            for index in range(0, self.chunks, batch):
+                n = _read_full(self.file, inbuf[:min(len(inbuf), self.body - index*stride)])
+                for k in range(min(batch, self.chunks - index)):
+                    pos += self._open_chunk(index + k, inbuf[k*stride:min(n, (k + 1)*stride)], out[pos:])
+                if progress: progress(n)
+        else:
+            from cryptography.hazmat.primitives.ciphers import Cipher, modes
+            from cryptography.hazmat.backends import default_backend
+            self.file.seek(self.offset)
+            decryptor = Cipher(self.key, modes.CFB(self.iv), backend=default_backend()).decryptor()
+            inbuf = memoryview(bytearray(min(buffer_size, max(1, self.size))))
+            while True:
+                n = self.file.readinto(inbuf)
+                if not n: break
+                pos += decryptor.update_into(inbuf[:n], out[pos:])
+                if progress: progress(n)
+        out.release()
+        del data[pos:]
+        return data
+
+
+def decrypt_chunks(input_file, keyring, progress=None, buffer_size=IO_BUFFER_SIZE, offset=0, length=None):
+    # Module : Plaintext chunks of a vault file (or of one range of it), each chunk is a view of a reused buffer
+    with SyS_VaultReader(input_file, keyring) as reader:
+        yield from reader.chunks_at(offset, length, progress, buffer_size)
+
+
+def decrypt_bytes(input_file, keyring, progress=None, buffer_size=IO_BUFFER_SIZE):
+    # Module : Whole plaintext of a vault file
+    with SyS_VaultReader(input_file, keyring) as reader:
+        return reader.read_all(progress, buffer_size)
+
+
+def key_number(input_file):
+    # Data key a vault file is encrypted under, 0 for files of older versions (key derived from the password)
+    infile, start, length = _open_source(input_file)
+    with infile:
+        header = infile.read(VAULT_HEADER_SIZE)
+    return header[28] if header[:8] == VAULT_FILE_MAGIC and len(header) == VAULT_HEADER_SIZE else 0
+
+
+def plain_size(input_file):
+    # Module : Plaintext size of a vault file (path or segment extent) from its header and length
+    infile, start, length = _open_source(input_file)
+    with infile:
+        header = infile.read(VAULT_HEADER_SIZE)
+        if header[:8] == VAULT_FILE_MAGIC and len(header) == VAULT_HEADER_SIZE and header[29]:
+            return sum(plain for pos, prefix, plain in _chunk_table(infile, start, length))
+    if header[:8] == VAULT_FILE_MAGIC and len(header) == VAULT_HEADER_SIZE:
+        stride = int.from_bytes(header[24:28], "big") + 16
+        return max(0, length - VAULT_HEADER_SIZE - 16*-(-(length - VAULT_HEADER_SIZE) // stride))
+    return max(0, length - (40 if header[:8] == VAULT_V2_MAGIC else 32))
+
+
+class SyS_ChunkReader(io.RawIOBase):
+    """ File object over an iterable of chunks, feeds streaming writers (tarfile) """
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.pending = b""
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self.pending:
+            self.pending = next(self.chunks, None)
+            if self.pending is None:
+                self.pending = b""
+                return 0
+        n = min(len(b), len(self.pending))
+        b[:n] = self.pending[:n]
+        self.pending = self.pending[n:]
+        return n
+
+
+class SyS_DigestReader(io.RawIOBase):
+    """ Reads through to a file, feeding a keyed hash on the way (digest and encryption in one pass) """
+    def __init__(self, infile, digest):
+        self.infile = infile
+        self.digest = digest
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        n = self.infile.readinto(b)
+        if n: self.digest.update(memoryview(b)[:n])
+        return n
+
+
+def content_digest(keyring):
+    # Module : Keyed BLAKE2b of file contents, equal digests mean equal content without revealing it
+    import hashlib
+    return hashlib.blake2b(key=keyring.subkey(DIGEST_KEY_INFO), digest_size=32)
+
+
+class SyS_VaultStream(io.BufferedIOBase):
+    """ Seekable plaintext of a vault file, decrypted one read-ahead window at a time (video playback) """
+    def __init__(self, path, keyring, window=STREAM_WINDOW):
+        self.reader = SyS_VaultReader(path, keyring)
+        self.window = window
+        self.pos = 0
+        self.start, self.buffer = 0, b""
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR: offset += self.pos
+        elif whence == io.SEEK_END: offset += self.reader.size
+        self.pos = max(0, offset)
+        return self.pos
+
+    def read(self, size=-1):
+        if size is None or size < 0: size = self.reader.size - self.pos
+        end = min(self.pos + size, self.reader.size)
+        if self.pos >= end: return b""
+        if not self.start <= self.pos or end > self.start + len(self.buffer):
+            # Refill from the chunk holding pos, running a window ahead of the request
+            self.start = self.pos - self.pos % getattr(self.reader, "chunk_size", 16)
+            self.buffer = self.reader.read(self.start, max(self.window, end - self.start))
+        data = self.buffer[self.pos - self.start:end - self.start]
+        self.pos = end
+        return data
+
+    def close(self):
+        if not self.closed:
+            self.reader.close()
+            self.buffer = b""
+        super(SyS_VaultStream, self).close()
+
+
+def image_size(data):
+    # Module : (width, height) from a JPEG / PNG / BMP header without decoding pixels, None if unknown
+    if data[:8] == b"\x89PNG\r\n\x1a\n" and len(data) >= 24:
+        return int.from_bytes(data[16:20], "big"), int.from_bytes(data[20:24], "big")
+    if data[:2] == b"BM" and len(data) >= 26:
+        return int.from_bytes(data[18:22], "little", signed=True), abs(int.from_bytes(data[22:26], "little", signed=True))
+    if data[:2] == b"\xff\xd8":
+        # Walk the segments up to the frame header (SOF0 - SOF15, not DHT / JPG / DAC)
+        pos = 2
+        while pos + 9 <= len(data):
+            if data[pos] != 0xFF: return None
+            marker = data[pos + 1]
+            if marker == 0xFF:
+                pos += 1
+                continue
+            if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+                return int.from_bytes(data[pos + 7:pos + 9], "big"), int.from_bytes(data[pos + 5:pos + 7], "big")
+            pos += 2 + int.from_bytes(data[pos + 2:pos + 4], "big")
+    return None
+
+
+def decode_flag(size, target):
+    # Module : Strongest IMREAD_REDUCED_COLOR_* step that still decodes target px on the longer side (JPEG : DCT scaling)
+    import cv2
+    if size is None: return cv2.IMREAD_COLOR
+    for factor, flag in ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2)):
+        if max(size) // factor >= target: return flag
+    return cv2.IMREAD_COLOR
+
+
+def fit_frame(frame, target):
+    # Module : Scale a decoded frame so its longer side is target px
+    import cv2
+    h, w = frame.shape[:2]
+    ratio = w/h
+    if w > h: size = (target, max(1, int(target/ratio)))
+    else: size = (max(1, int(target*ratio)), target)
+    return cv2.resize(frame, size, interpolation=cv2.INTER_AREA if max(w, h) > target else cv2.INTER_LINEAR)
+
+
+def make_thumbnail(file, file_type, data=None):
+    # Module : JPEG thumbnail of an image (400 px) or of a video frame, None if not a media file
+    # OpenCV is loaded on first use, a headless vault without it only goes without thumbnails
+    import cv2
+    import numpy as np
+    if file_type == "image":
+        # Decode at about the thumbnail size, a 100 MP photo is never decoded in full
+        if data is not None:
+            frame = cv2.imdecode(np.frombuffer(data, np.uint8), decode_flag(image_size(data), 400))
+        else:
+            with open(file, 'rb') as infile:
+                frame = cv2.imread(file, decode_flag(image_size(infile.read(1024*1024)), 400))
+        frame = fit_frame(frame, 400)
+    elif file_type == "video":
+        cap = cv2.VideoCapture(file)
+        cap.set(cv2.CAP_PROP_POS_FRAMES, int(cap.get(cv2.CAP_PROP_FRAME_COUNT)/4))
+        ret, frame = cap.read()
+        cap.release()
+        if not ret: raise ValueError("No video frame")
+    else:
+        return None
+    return cv2.imencode('.jpg', frame)[1].tobytes()
+
+
+def read_thumbnails(pack, keyring, items):
+    # Module : {file: JPEG bytes or None} for [(file, path, location)], packed ones in one batch, legacy .dat files one by one
+    result = pack.read([(file, location) for file, path, location in items if isinstance(location, list)])
+    for file, path, location in items:
+        if isinstance(location, list): continue
+        try:result[file] = bytes(decrypt_bytes(path + ".dat", keyring)) if location else None
+        except Exception:result[file] = None
+    return result
+
+
+def _pool_init(keyring, counter, cancel, trace_origin=None):
+    # Worker process state, tracing follows the parent (same clock origin, merged by _pool_call)
+    global _pool_keyring, _pool_counter, _pool_cancel
+    _pool_keyring, _pool_counter, _pool_cancel = keyring, counter, cancel
+    if trace_origin is not None:
+        TRACE.enabled, TRACE.origin = True, trace_origin
+    # Ctrl-C goes to the parent, which cancels through the shared event
+    import signal
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _pool_progress(n):
+    if _pool_cancel.is_set(): raise SyS_Cancelled()
+    with _pool_counter.get_lock():
+        _pool_counter.value += n
+
+
+def _pool_call(worker, *args):
+    # Worker : result plus the trace recorded while making it
+    return worker(*args), TRACE.take() if TRACE.enabled else None
+
+
+def _import_one(source, target, file_type, file, known=()):
+    # Worker : keyed digest + read + encrypt in one pass, thumbnail + seal, returns ((sealed thumbnail or False, object or None, digest), error)
+    # target None : the VAULTv3 object is returned for the task thread to append to a segment, else it is written there (blob)
+    # known : digests of vaulted files of the same size, content matching one is not encrypted again (no object, no thumbnail)
+    digest = content_digest(_pool_keyring)
+    outfile = io.BytesIO() if target is None else target
+    def f_output():
+        # The blob folder is made once a blob is written, content already in the vault writes none
+        if target is not None: os.makedirs(os.path.dirname(target), exist_ok=True)
+        return outfile
+    try:
+        data = None
+        if file_type == "image" and os.path.getsize(source) <= IMPORT_READ_LIMIT:
+            # Read once, the same bytes feed the digest, the cipher and the thumbnail decoder
+            with open(source, 'rb') as infile, TRACE.span("import.read") as span:
+                data = infile.read()
+                span.bytes = len(data)
+            digest.update(data)
+            if digest.hexdigest() in known:
+                _pool_progress(len(data))
+                return (False, None, digest.hexdigest()), ""
+            encrypt_stream(io.BytesIO(data), f_output(), _pool_keyring, _pool_progress)
+        elif known:
+            # Same size as a vaulted file : hash pass first, a re-import costs no encryption and no disk space
+            with open(source, 'rb', buffering=0) as infile, TRACE.span("import.digest") as span:
+                buf = memoryview(bytearray(IO_BUFFER_SIZE))
+                while True:
+                    n = infile.readinto(buf)
+                    if not n: break
+                    digest.update(buf[:n])
+                    _pool_progress(n)
+                    span.bytes += n
+            if digest.hexdigest() in known: return (False, None, digest.hexdigest()), ""
+            # Different content after all, already counted in the progress
+            with open(source, 'rb', buffering=0) as infile:
+                encrypt_stream(infile, f_output(), _pool_keyring, lambda n: _pool_progress(0))
+        else:
+            with open(source, 'rb', buffering=0) as infile:
+                encrypt_stream(SyS_DigestReader(infile, digest), f_output(), _pool_keyring, _pool_progress)
+    except Exception as e:
+        # Exception : Encryption failed or cancelled, drop the partial file (and its folder once empty)
+        if target is not None:
+            try:os.remove(target)
+            except:pass
+            try:os.rmdir(os.path.dirname(target))
+            except OSError:pass
+        return False, "cancelled" if isinstance(e, SyS_Cancelled) else str(e) or type(e).__name__
+    packed = outfile.getvalue() if target is None else None
+    try:
+        with TRACE.span("import.thumbnail"):
+            thumbnail = make_thumbnail(source, file_type, data)
+        if thumbnail is None: return (False, packed, digest.hexdigest()), ""
+        # Appended to a pack by the task thread
+        return (SyS_ThumbPack.seal(_pool_keyring.subkey(THUMB_KEY_INFO), file, thumbnail), packed, digest.hexdigest()), ""
+    except Exception:
+        # Exception : Encrypted, but no thumbnail
+        return (False, packed, digest.hexdigest()), ""
+
+
+def _export_part(source, target, offset, length):
+    # Worker : decrypt one range into <target>.part at the same offset (the task renames it once every range is in), returns (ok, error)
+    try:
+        with os.fdopen(os.open(target + ".part", os.O_WRONLY | os.O_CREAT | getattr(os, "O_BINARY", 0), 0o666), 'wb') as outfile, TRACE.span("export.decrypt") as span:
+            outfile.seek(offset)
+            for chunk in decrypt_chunks(source, _pool_keyring, _pool_progress, offset=offset, length=length):
+                outfile.write(chunk)
+                span.bytes += len(chunk)
+        return True, ""
+    except Exception as e:
+        return False, "cancelled" if isinstance(e, SyS_Cancelled) else str(e) or type(e).__name__
+
+
+def _rekey_one(path):
+    # Worker : re-encrypt one file under the current key and swap it in, returns (ok, error)
+    try:
+        encrypt_stream(SyS_ChunkReader(decrypt_chunks(path, _pool_keyring, _pool_progress)), path + ".tmp", _pool_keyring)
+        # A file deleted meanwhile stays deleted
+        if not os.path.exists(path): raise FileNotFoundError("Deleted")
+        os.replace(path + ".tmp", path)
+        return True, ""
+    except Exception as e:
+        try:os.remove(path + ".tmp")
+        except OSError:pass
+        return False, "cancelled" if isinstance(e, SyS_Cancelled) else str(e) or type(e).__name__
+
+
+def _scrub_one(source, digest, rate):
+    # Worker : read and authenticate every chunk of one object (nothing is written), compare its content digest, returns (ok, error)
+    # rate : bytes per second for this worker, 0 unthrottled
+    try:
+        check = content_digest(_pool_keyring) if digest else None
+        with SyS_VaultReader(source, _pool_keyring) as reader, TRACE.span("scrub.verify") as span:
+            if reader.version < 3:
+                # Older format without authentication : nothing to verify, the upgrade offered at unlock rewrites it
+                _pool_progress(reader.size)
+                return True, ""
+            # Progress in plaintext bytes, as the total and the rate are counted
+            start, done = time.perf_counter(), 0
+            for chunk in reader.chunks_at(0, None):
+                if check is not None: check.update(chunk)
+                done += len(chunk)
+                _pool_progress(len(chunk))
+                # Throttle : sleep off the lead over this worker's share of the rate, in slices so a cancel is seen
+                while rate and done / rate > time.perf_counter() - start:
+                    _pool_progress(0)
+                    time.sleep(min(0.1, done / rate - (time.perf_counter() - start)))
+            span.bytes = done
+        if check is not None and check.hexdigest() != digest: return False, "content does not match the index"
+        return True, ""
+    except FileNotFoundError:
+        return False, "missing : no file for this entry"
+    except Exception as e:
+        if isinstance(e, SyS_Cancelled): return False, "cancelled"
+        if isinstance(e, SyS_MissingCodec): return False, "unreadable here : " + str(e)
+        # A failed tag means changed or cut off data
+        return False, "damaged : " + (str(e) or "authentication failed")
+
+
+def read_manifest(path):
+    # Module : Encrypted names already exported by an earlier run (resume)
+    if not os.path.exists(path): return {}
+    done = {}
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            parts = line.split()
+            if parts: done[parts[0]] = int(parts[1]) if len(parts) > 1 else 0
+    return done
+
+
+def run_pool(worker, jobs, keyring, total=0, workers=WORKERS, progress=None, cancel=None, manifest=None, finish=None):
+    # Module : Feed jobs [(key, args), ...] to a process pool, a bounded number in flight at a time, returns {key: (value, error)}
+    # Several jobs may share one key, finish(key, result) -> result is called once every job of a key returned
+    # progress(done, total) : bytes, cancel : threading.Event, manifest : keys of finished jobs are appended here
+    results = {}
+    if not jobs: return results
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+    workers = max(1, workers)
+    context = multiprocessing.get_context("spawn")
+    cancel_event = context.Event()
+    counter = context.Value('q', 0)
+    pending_jobs = iter(jobs)
+    remaining = {}
+    for key, args in jobs: remaining[key] = remaining.get(key, 0) + 1
+    manifest = open(manifest, 'a', encoding='utf-8') if manifest else None
+
+    def f_finish(key):
+        if finish:
+            try:results[key] = finish(key, results[key])
+            except Exception as e:results[key] = (False, str(e) or "finish failed")
+        if manifest and not results[key][1]:
+            manifest.write(key + "\n")
+            manifest.flush()
+
+    trace_origin = TRACE.origin if TRACE.enabled else None
+    with ProcessPoolExecutor(min(workers, len(jobs)), mp_context=context, initializer=_pool_init, initargs=(keyring, counter, cancel_event, trace_origin)) as pool:
+        pending = {}
+        while True:
+            if cancel is not None and cancel.is_set(): cancel_event.set()
+            # Backpressure : keep at most two jobs per worker queued
+            while len(pending) < 2*workers and not cancel_event.is_set():
+                job = next(pending_jobs, None)
+                if job is None: break
+                key, args = job
+                try:pending[pool.submit(_pool_call, worker, *args)] = key
+                except Exception as e:
+                    # Exception : Broken pool, stop feeding it
+                    results[key] = (False, str(e) or "worker failed")
+                    cancel_event.set()
+            if not pending: break
+            done, _ = wait(pending, timeout=0.1, return_when=FIRST_COMPLETED)
+            for future in done:
+                key = pending.pop(future)
+                try:
+                    result, trace = future.result()
+                    if trace: TRACE.merge(trace)
+                except Exception as e:result = (False, str(e) or "worker failed")
+                # The first error of a key sticks
+                if not results.get(key, (True, ""))[1]: results[key] = result
+                remaining[key] -= 1
+                if not remaining[key]: f_finish(key)
+            if progress: progress(counter.value, total)
+    # Keys cut short by a cancel
+    for key, left in remaining.items():
+        if left and key in results:
+            if not results[key][1]: results[key] = (False, "cancelled")
+            f_finish(key)
+    if manifest: manifest.close()
+    return results
+
+
+# Vault engine
+
+class Vault:
+    """ One vault folder : key file, index and journal, thumbnail packs, segments and blobs of the encrypted files, no UI """
+    def __init__(self, directory):
+        self.directory = directory
+        self.data = os.path.join(directory, "data")
+        self.config_path = os.path.join(self.data, "config.bin")
+        self.key_path = os.path.join(self.data, "vault.key")
+        self.journal_path = os.path.join(self.data, "journal.bin")
+        self.scrub_path = os.path.join(self.data, "scrub.bin")
+        # Held across reading the journal, appending to it and saving a snapshot, other processes may use the vault too
+        self.index_lock = SyS_FileLock(os.path.join(self.data, "index.lock"))
+        self.password = None
+        self.keyring = None
+        self.index = None
+        self.journal = None
+        self.thumbnails = None
+        self.segments = None
+        self.loose = set()          # .enc files in the data folder itself (older versions), found at unlock and by sync()
+        self.external = False       # Changes of another process picked up by commit(), reported by the next sync()
+        self.loaded = 0             # When the vault was unlocked, pack files written since may hold objects of an import not committed yet
+        self.created = False
+
+    def exists(self):
+        return os.path.exists(self.config_path)
+
+    def path(self, file):
+        # Where the VAULTv3 object of a file is : a segment extent, a blob or a file in the data folder (older versions and vault files)
+        record = self.index.get(file) if self.index is not None else None
+        location = record.location if record is not None else 0
+        if isinstance(location, list): return self.segments.extent(location)
+        if location == 1 or isinstance(location, str): return self.blob_path(record.blob())
+        return os.path.join(self.data, file)
+
+    def blob_path(self, file):
+        return os.path.join(self.data, BLOB_DIRECTORY, file[:2].lower(), file)
+
+    def open(self, password):
+        # Unlock : unwrap the data keys once for the session and load the index, ValueError on a wrong password
+        if not os.path.exists(self.data): os.makedirs(self.data)
+        notice = os.path.join(self.data, "! DO NOT modify or delete these files !")
+        if not os.path.exists(notice):
+            with open(notice, "w") as f:f.write("! DO NOT modify or delete these files !\n")
+        self.created = not self.exists()
+        self.password = password
+        self.loaded = time.time()
+        try:
+            with TRACE.span("unlock"):
+                self.keyring = SyS_KeyRing.open(password, self.key_path, legacy_files=not self.created)
+            self.load()
+            # The only scan of the data folder, listings come from the index
+            self.loose = {f for f in os.listdir(self.data) if f.lower().endswith('.enc')}
+        except Exception as e:
+            # Exception : Unable to unwrap the keys or to read config file
+            # A wrong password fails authentication or leaves no readable config, any other error is passed on as it is
+            self.close()
+            from cryptography.exceptions import InvalidTag
+            if isinstance(e, (InvalidTag, UnicodeDecodeError)): raise ValueError("Incorrect password")
+            if isinstance(e, ValueError): raise
+            raise ValueError("Unable to open the vault : " + (str(e) or type(e).__name__))
+        if self.keyring.version < 2:
+            # Key file of an older version (files under the password-derived key) : wrap a new random data key
+            # New files use it at once, migrate() moves the others, a password change no longer touches the files
+            self.keyring.add_key()
+            self.keyring.rewrap(password)
+            self.keyring.save(self.key_path)
+            self.save()
+            self.thumbnails = self.thumb_pack()
+        return self
+
+    def close(self):
+        # Lock : drop keys and metadata
+        self.password = self.keyring = self.index = self.journal = self.thumbnails = self.segments = None
+        self.loose = set()
+
+    def load(self):
+        # Decrypt the index snapshot and replay the journal, converts the config of older versions
+        with self.index_lock, TRACE.span("index.load"):
+            return self._load()
+
+    def reload(self):
+        # Read a newer snapshot another process saved, names reserved by an import of this one stay reserved
+        reserved = [record for record in self.index.records.values() if record.location is None]
+        self.load()
+        for record in reserved:
+            if record.file not in self.index: self.index.add(record)
+
+    def _load(self):
+        if not os.path.exists(self.config_path):
+            # New vault : the key file goes first, the index is encrypted under its key
+            self.save_new_key()
+            self.save(SyS_Index())
+        config_data = decrypt_bytes(self.config_path, self.keyring)
+        self.thumbnails = self.thumb_pack()
+        self.segments = SyS_Segments(self.data)
+        if config_data.startswith(INDEX_MAGIC):
+            self.index = SyS_Index.loads(config_data)
+            # Replay changes made since the snapshot
+            # The journal follows the key of its snapshot
+            self.journal = SyS_Journal(self.journal_path, self.keyring.subkey(b"vaultapp journal", key_number(self.config_path)), self.index.journal_id)
+            self.journal.replay(self.index)
+            # Snapshot of what was replayed, a damaged record is not read again
+            if self.journal.damaged or self.journal.size > max(JOURNAL_COMPACT_BYTES, os.path.getsize(self.config_path)): self.save(self.index)
+            return self.index
+
+        # Older config : password<?n?>enc name<?/?>orginal name<?n?>...
+        config_data = config_data.decode().split("<?n?>")
+        if config_data[0] != self.password: raise ValueError("Incorrect password")
+        # Password checked, the converted index below is written under the new key
+        self.save_new_key()
+        index = SyS_Index()
+        for entry in config_data[1:]:
+            try:
+                _file, _orfilename = entry.split("<?/?>")[:2]
+                _file_path = self.path(_file)
+                _file_ext = _orfilename.split(".")[-1]
+                size, imported = 0, 0
+                if os.path.exists(_file_path):
+                    size, imported = plain_size(_file_path), int(os.path.getctime(_file_path))
+                index.add(SyS_Record(_file, _orfilename, _file_ext, self.filetype(_file_ext), size, imported, os.path.exists(_file_path + ".dat")))
+            except:pass
+        self.index = index
+        self.save(index)
+        return self.index
+
+    def save_new_key(self):
+        # Key file of a new vault or of one from before the key file (see SyS_KeyRing.open)
+        if not os.path.exists(self.key_path): self.keyring.save(self.key_path)
+
+    def save(self, index=None):
+        # Encrypt a snapshot of the index to the config file (replaced atomically), then start an empty journal
+        with self.index_lock:
+            if index is None:
+                # Records another process appended meanwhile go into the snapshot too
+                if self.journal is not None and self.journal.follow(self.index) is None: self.reload()
+                index = self.index
+            index.journal_id = os.urandom(8).hex()
+            with TRACE.span("index.save"):
+                # Never an optional codec, the index must open wherever the vault does
+                encrypt_stream(io.BytesIO(index.dumps()), self.config_path + ".tmp", self.keyring, codec=CODEC_ZLIB)
+                os.replace(self.config_path + ".tmp", self.config_path)
+            self.journal = SyS_Journal(self.journal_path, self.keyring.subkey(b"vaultapp journal"), index.journal_id)
+            self.journal.reset(index.journal_id)
+
+    def commit(self, ops):
+        # Append one batch to the journal and apply it, compact once the journal outgrows the snapshot
+        if not ops: return
+        with self.index_lock:
+            with TRACE.span("index.commit"):
+                # Records of another process first, this one follows them
+                applied = self.journal.follow(self.index)
+                # A newer snapshot : the batch goes onto its journal
+                if applied is None: self.reload()
+                if applied != 0: self.external = True
+                self.journal.append(ops)
+                self.index.apply(ops)
+            if self.journal.size > max(JOURNAL_COMPACT_BYTES, os.path.getsize(self.config_path)): self.save()
+
+    @staticmethod
+    def filetype(ext=""):
+        # Common file types
+        if ext.lower() in ("jpg,png,bmp,jpeg"): return "image"
+        elif ext.lower() in ("mp4,avi,mkv"): return "video"
+        elif ext.lower() in ("exe,dll,py"): return "application"
+        elif ext.lower() in ("rar,zip,7zip"): return "compressed"
+        elif ext.lower() in ("mp3,ogg,wav"): return "audio"
+        elif ext.lower() in ("doc,docx,pdf,txt,ppt,xls,ppt,csv"): return "document"
+        elif ext.lower() in ("html,mhtml,css"): return "webpage"
+        else: return "other"
+
+    def unique_name(self, orginal_file_name, file_ext):
+        # Generate secure file names
+        import secrets
+        while True:
+            # Fix same name
+            encrypted_file_name = secrets.token_urlsafe(16) + ".enc"
+            if encrypted_file_name not in self.index:break
+        i = 0
+        tmp = "".join(orginal_file_name.split(".")[:-1])
+        while True:
+            if self.index.has_name(orginal_file_name):
+                i += 1
+                orginal_file_name = tmp + "_" + str(i) + "." + file_ext
+            else: break
+        return orginal_file_name, encrypted_file_name
+
+    def name(self, file):
+        # Original name of an encrypted file
+        record = self.index.get(file)
+        # Exception : Encrypted file that isn't in the database
+        return record.name if record is not None else "file.extension"
+
+    def sync(self, folder=False):
+        # Pick up changes of another process (cli.py, a second window) : its journal records, a snapshot it saved, and with folder
+        # files put into or taken out of the data folder. Not while a task of this one runs, returns True if the listing may differ
+        changed, self.external = self.external, False
+        applied = self.journal.follow(self.index)
+        if applied is None:
+            # A newer snapshot : read it as at unlock
+            self.reload()
+            changed = True
+        elif applied:
+            changed = True
+        if changed:
+            # Segments and thumbnail packs may have grown meanwhile, appends continue at their real ends
+            self.segments = SyS_Segments(self.data)
+            self.thumbnails = self.thumb_pack()
+        if folder:
+            loose = {f for f in os.listdir(self.data) if f.lower().endswith('.enc')}
+            if loose != self.loose: self.loose, changed = loose, True
+        return changed
+
+    def files(self):
+        # Encrypted files in import order, then loose files of older versions missing from the database
+        files = [f for f, record in self.index.records.items() if record.location is not None and (record.location or f in self.loose)]
+        return files + [f for f in self.loose if f not in self.index]
+
+    def list(self, category="all"):
+        # Encrypted files of one category, files missing from the database count as "other"
+        if category == "all": return self.files()
+        return [f for f in self.files() if (self.index.get(f).category if f in self.index else "other") == category]
+
+    def search(self, keyword, within=None):
+        # Names reserved by an import in progress are left out, as in files()
+        return [f for f in self.index.search(keyword, within) if self.index.get(f).location is not None]
+
+    def resolve(self, names):
+        # Encrypted names for encrypted or original names, KeyError on an unknown one
+        files = []
+        for name in names:
+            if name in self.index or name in self.loose: files.append(name)
+            elif self.index.has_name(name): files += list(self.index.by_name[name])
+            else: raise KeyError(name)
+        return files
+
+    # Import
+
+    def prepare_import(self, paths):
+        # Reserve encrypted and original names in the index, [(source, target, record, known), ...], committed by finish_import
+        # target : blob path of a large file, None for a small one (packed into a segment)
+        # known : {digest: location} of vaulted files of the same size, a worker checks the content against them first
+        by_size = {}
+        for record in self.index.records.values():
+            if record.digest and record.location is not None: by_size.setdefault(record.size, {})[record.digest] = record.blob() or record.location
+        jobs = []
+        for file in paths:
+            file_ext = file.split(".")[-1]
+            orginal_file_name, encrypted_file_name = self.unique_name(os.path.basename(file), file_ext)
+            record = SyS_Record(encrypted_file_name, orginal_file_name, file_ext, self.filetype(file_ext), os.path.getsize(file), int(time.time()), location=None)
+            self.index.add(record)
+            target = None
+            if record.size > PACK_OBJECT_LIMIT: target = self.blob_path(encrypted_file_name)
+            jobs.append((file, target, record, by_size.get(record.size, {})))
+        return jobs
+
+    def run_import(self, jobs, progress=None, cancel=None, workers=WORKERS):
+        # Encrypt files and thumbnails across the worker pool, leaves the index alone (safe off the owner's thread)
+        targets = {record.file: (target, known) for file, target, record, known in jobs}
+        stored = {}
+        def f_finish(file, result):
+            # Sealed thumbnails and small files go into their packs as files complete -> ((thumbnail, location, digest), error)
+            if result[1]: return result
+            thumbnail, packed, digest = result[0]
+            target, known = targets[file]
+            if isinstance(thumbnail, bytes): thumbnail = self.thumbnails.append([thumbnail])[0]
+            location = known.get(digest) or stored.get(digest)
+            if location is not None:
+                # Same content already stored : point at it, a copy made in this batch goes again (with its folder once empty)
+                if target is not None and os.path.exists(target):
+                    os.remove(target)
+                    try:os.rmdir(os.path.dirname(target))
+                    except OSError:pass
+                return (thumbnail, location, digest), ""
+            location = stored[digest] = self.segments.append([packed])[0] if packed is not None else file
+            return (thumbnail, location, digest), ""
+        total = sum(record.size for file, target, record, known in jobs)
+        with TRACE.span("import", total):
+            return run_pool(_import_one, [(record.file, (file, target, record.category, record.file, list(known))) for file, target, record, known in jobs], self.keyring,
+                            total, workers, progress, cancel, finish=f_finish)
+
+    def finish_import(self, jobs, results):
+        # Commit the completed files as one journal record, release the names of the rest
+        # Returns (imported records, [(name, error)] of failed files, names of media files without a thumbnail)
+        ops, imported, failed, no_thumbnail = [], [], [], []
+        for file, target, record, known in jobs:
+            result = results.get(record.file, (False, "cancelled"))
+            if result[1]:
+                # Not imported (failed or cancelled), a packed object left behind is dead space
+                self.index.remove(record.file)
+                if result[1] != "cancelled": failed.append((record.name, result[1]))
+                continue
+            record.thumbnail, record.location, record.digest = result[0]
+            if known.get(record.digest) == record.location:
+                # A copy already in the vault, unless its files were deleted during the import
+                sharing = self.index.sharing(record)
+                if not sharing:
+                    self.index.remove(record.file)
+                    failed.append((record.name, "deleted from the vault meanwhile, import it again"))
+                    continue
+                # Share the thumbnail record too, it stays sealed for the name it was made under
+                owner = self.index.get(sharing[0]).thumbnail
+                if not record.thumbnail and isinstance(owner, list): record.thumbnail = owner[:3] + [owner[3] if len(owner) > 3 else sharing[0]]
+            ops.append(["add", record.to_list()])
+            imported.append(record)
+        no_thumbnail = [record.name for record in imported if record.category in ("image", "video") and not record.thumbnail]
+        # Packed files reach the disk before the journal points at them
+        self.segments.sync()
+        self.commit(ops)
+        return imported, failed, no_thumbnail
+
+    def import_files(self, paths, progress=None, cancel=None, workers=WORKERS):
+        jobs = self.prepare_import(paths)
+        return self.finish_import(jobs, self.run_import(jobs, progress, cancel, workers))
+
+    # Export
+
+    def export_files(self, files, directory, progress=None, cancel=None, workers=WORKERS):
+        # Decrypt files into a folder, skipping the ones a previous run to the same folder finished
+        # Returns (exported files, errors), the manifest is kept until every file is out
+        manifest = os.path.join(directory, ".vault_export")
+        done = read_manifest(manifest)
+        jobs, targets = [], {}
+        for _file in files:
+            if _file in done: continue
+            source = self.path(_file)
+            target, size = os.path.join(directory, self.name(_file)), plain_size(source)
+            targets[_file] = (target, size)
+            # Large files are split into ranges, decrypted by several workers at once
+            jobs += [(_file, (source, target, offset, SPLIT_SIZE)) for offset in range(0, max(1, size), SPLIT_SIZE)]
+        def f_finish(_file, result):
+            target, size = targets[_file]
+            if not result[1]:
+                os.truncate(target + ".part", size)
+                os.replace(target + ".part", target)
+            else:
+                try:os.remove(target + ".part")
+                except:pass
+            return result
+        total = sum(size for target, size in targets.values())
+        with TRACE.span("export", total):
+            results = run_pool(_export_part, jobs, self.keyring, total, workers, progress, cancel, manifest, f_finish)
+        return self._export_result(files, manifest, results)
+
+    def export_archive(self, files, archive, progress=None, cancel=None):
+        # Stream decrypted files straight into one ZIP or TAR archive, no plaintext is staged on disk
+        # Checked for cancel between members, a member is never left half written
+        import zipfile, tarfile
+        manifest = archive + ".vault_export"
+        done = read_manifest(manifest)
+        entries = [(file, self.path(file), self.name(file)) for file in files]
+        total = sum(plain_size(source) for file, source, name in entries if file not in done)
+        results = {}
+        state = [0]
+        def f_progress(n):
+            state[0] += n
+            if progress: progress(state[0], total)
+
+        try:
+            if archive.lower().endswith(".tar"):
+                # Resume : cut the archive after the last member recorded in the manifest
+                if not done or not os.path.exists(archive): done = {}
+                mode = 'r+b' if done else 'wb'
+                with open(archive, mode) as f, open(manifest, 'a' if done else 'w', encoding='utf-8') as manifest_file:
+                    if done:
+                        f.truncate(max(done.values()))
+                        f.seek(max(done.values()))
+                    with tarfile.open(fileobj=f, mode='w', format=tarfile.PAX_FORMAT) as tar:
+                        for file, source, name in entries:
+                            if file in done: continue
+                            if cancel is not None and cancel.is_set(): break
+                            info = tarfile.TarInfo(name)
+                            info.size = plain_size(source)
+                            info.mtime = int(time.time())
+                            with TRACE.span("export.archive", info.size):
+                                tar.addfile(info, io.BufferedReader(SyS_ChunkReader(decrypt_chunks(source, self.keyring, f_progress))))
+                            manifest_file.write(file + " " + str(tar.offset) + "\n")
+                            manifest_file.flush()
+            else:
+                # Resume : a cleanly closed ZIP is appended to, otherwise start over
+                if not done or not zipfile.is_zipfile(archive): done = {}
+                with zipfile.ZipFile(archive, 'a' if done else 'w', zipfile.ZIP_STORED, allowZip64=True) as zip_file, open(manifest, 'a' if done else 'w', encoding='utf-8') as manifest_file:
+                    for file, source, name in entries:
+                        if file in done: continue
+                        if cancel is not None and cancel.is_set(): break
+                        with zip_file.open(name, 'w', force_zip64=True) as dest, TRACE.span("export.archive") as span:
+                            for chunk in decrypt_chunks(source, self.keyring, f_progress):
+                                dest.write(chunk)
+                                span.bytes += len(chunk)
+                        manifest_file.write(file + "\n")
+                        manifest_file.flush()
+        except Exception as e:
+            # Exception : Unreadable member or full disk, what is in the manifest stays exported
+            results[None] = (False, str(e) or type(e).__name__)
+        return self._export_result(files, manifest, results)
+
+    def _export_result(self, files, manifest, results):
+        done = read_manifest(manifest)
+        exported = [_file for _file in files if _file in done]
+        errors = [error for ok, error in results.values() if error and error != "cancelled"]
+        if len(exported) == len(files) and os.path.exists(manifest): os.remove(manifest)
+        return exported, errors
+
+    # Manage
+
+    def delete(self, files, compact=True):
+        # Remove encrypted files and their legacy thumbnails, one journal record for the batch, returns the deleted files
+        # Packed files become dead segment space, reclaimed by compact(), content shared with other files stays until the last of them goes
+        ops, gone = [], set()
+        with TRACE.span("delete.files"):
+            for _file in files:
+                record = self.index.get(_file)
+                source = self.path(_file)
+                try:
+                    if not isinstance(source, SyS_Extent) and not (record is not None and self.index.sharing(record, gone)): os.remove(source)
+                # Already gone (the entry is dropped all the same), or in use : kept, the other files go on
+                except FileNotFoundError:pass
+                except OSError:continue
+                try:os.remove(self.path(_file + ".dat"))
+                except:pass
+                self.loose.discard(_file)
+                gone.add(_file)
+                ops.append(["delete", _file])
+        self.commit(ops)
+        if compact:
+            with TRACE.span("delete.compact"):self.compact_thumbnails()
+        return [op[1] for op in ops]
+
+    def compact_thumbnails(self):
+        # Reclaim pack space of deleted thumbnails once it outweighs the live ones (not while an import appends)
+        # The tail pack stays, another process may be appending to it
+        live = [(record.file, record.thumbnail) for record in self.index.records.values() if isinstance(record.thumbnail, list)]
+        used = sum(-(-location[2] // THUMB_SLOT) for location in {tuple(location[:3]): location for file, location in live}.values()) * THUMB_SLOT
+        if self.thumbnails.size() - used < max(THUMB_COMPACT_BYTES, used): return
+        packs = self.closed_packs(self.thumbnails.packs())
+        if not packs: return
+        moved = self.thumbnails.compact([(file, location) for file, location in live if location[0] in packs])
+        with self.index_lock:
+            # The new locations are saved before the old packs go, packs something points into again are kept
+            self.commit([["thumb", file, location] for file, location in moved.items()])
+            self.save()
+            used = {record.thumbnail[0] for record in self.index.records.values() if isinstance(record.thumbnail, list)}
+            self.thumbnails.remove([pack for pack in self.closed_packs(packs) if pack not in used])
+
+    def closed_packs(self, packs):
+        # Thumbnail packs of the list nothing appends to any more (see closed_segments)
+        on_disk = self.thumbnails.packs()
+        return [pack for pack in packs if on_disk and pack < on_disk[-1] and self.settled(self.thumbnails.path(pack))]
+
+    def settled(self, path):
+        # Pack file last written before the unlock : its objects were committed by then or are dead
+        # Newer ones may hold objects of an import (of this process or another one) not committed yet
+        try:return os.path.getmtime(path) < self.loaded - MTIME_SLACK
+        except OSError:return False
+
+    def closed_segments(self, segments):
+        # Segments of the list nothing appends to any more, the newest on disk is left alone whatever this process thinks its tail is
+        on_disk = self.segments.segments()
+        return [segment for segment in segments if on_disk and segment < on_disk[-1] and segment != self.segments.tail and segment not in self.segments.dirty
+                and self.settled(self.segments.path(segment))]
+
+    def prepare_compaction(self):
+        # Closed segments that are mostly dead space and the live files in them -> ([(file, location)], segments)
+        # Not while an import appends : its objects are not in the index yet
+        live = {}
+        for record in self.index.records.values():
+            if isinstance(record.location, list): live.setdefault(record.location[0], []).append((record.file, record.location))
+        segments = []
+        for segment in self.closed_segments(self.segments.segments()):
+            try:size = os.path.getsize(self.segments.path(segment))
+            except OSError:continue
+            # Shared objects count once
+            used = sum(length for offset, length in {(location[1], location[2]) for file, location in live.get(segment, ())})
+            if size - used >= size*SEGMENT_COMPACT_RATIO: segments.append(segment)
+        return [item for segment in segments for item in live.get(segment, ())], segments
+
+    def run_compaction(self, jobs, progress=None, cancel=None):
+        # Copy the live objects out, leaves the index alone (safe off the owner's thread) -> ({file: new location}, segments)
+        items, segments = jobs
+        total = sum(location[2] for file, location in items)
+        state = [0]
+        def f_progress(n):
+            state[0] += n
+            if progress: progress(state[0], total)
+        with TRACE.span("compact.segments", total):
+            return self.segments.compact(items, f_progress, cancel), segments
+
+    def finish_compaction(self, result):
+        # Commit the new locations, then remove the segments nothing points into any more
+        # Checked again under the index lock : another process may have appended to a segment or committed objects in it meanwhile
+        moved, segments = result
+        with self.index_lock:
+            segments = self.closed_segments(segments)
+            ops = []
+            for file, location in moved.items():
+                record = self.index.get(file)
+                if record is not None and isinstance(record.location, list) and record.location[0] in segments: ops.append(["place", file, location])
+            self.commit(ops)
+            used = {record.location[0] for record in self.index.records.values() if isinstance(record.location, list)}
+            self.segments.remove([segment for segment in segments if segment not in used])
+
+    def compact(self, progress=None, cancel=None):
+        # Module : Reclaim dead segment space on the calling thread
+        self.finish_compaction(self.run_compaction(self.prepare_compaction(), progress, cancel))
+
+    def pack_thumbnails(self, items):
+        # Move legacy thumbnail files [(file, JPEG bytes)] into a pack, one journal record for the batch
+        items = [(file, data) for file, data in items if self.index.get(file) is not None and self.index.get(file).thumbnail is True]
+        if not items: return
+        locations = self.thumbnails.append(SyS_ThumbPack.seal(self.thumbnails.key, file, data) for file, data in items)
+        self.commit([["thumb", file, location] for (file, data), location in zip(items, locations)])
+        for file, data in items:
+            try:os.remove(self.path(file + ".dat"))
+            except:pass
+
+    def thumb_pack(self):
+        return SyS_ThumbPack(self.data, self.keyring.subkey(THUMB_KEY_INFO), [self.keyring.subkey(THUMB_KEY_INFO, slot) for slot in self.keyring.retired()])
+
+    def change_password(self, password, new_password):
+        # Rewrap the data keys under a key derived from the new password, no file is rewritten
+        if self.keyring.legacy_files or self.keyring.version < 2: raise ValueError("Upgrade the vault before changing its password")
+        if not self.keyring.check(password): raise ValueError("Incorrect password")
+        self.keyring.rewrap(new_password)
+        self.keyring.save(self.key_path)
+        self.password = new_password
+
+    def needs_migration(self):
+        # Files of older formats, or under a key from before the current one
+        return self.keyring.legacy_files or bool(self.keyring.retired())
+
+    def stale_files(self):
+        # Files not under the current key : formats before the key hierarchy, or VAULTv3 under a retired key
+        # Segments are left out, they are only ever written under the current key
+        stale = []
+        # A blob shared by several files is listed once
+        blobs = {record.blob(): f for f, record in self.index.records.items() if record.blob()}
+        for f in list(blobs.values()) + os.listdir(self.data):
+            if f.endswith(('.enc', '.enc.dat')) or f == "config.bin":
+                try:
+                    with open(self.path(f), 'rb') as infile:
+                        header = infile.read(VAULT_HEADER_SIZE)
+                except OSError:continue
+                if header[:8] != VAULT_FILE_MAGIC or len(header) != VAULT_HEADER_SIZE or header[28] != self.keyring.current: stale.append(f)
+        return stale
+
+    def prepare_migration(self):
+        # Files to re-encrypt [(name, path, stored size)] and thumbnails to seal again [(file, location)], read on the owner's thread
+        stale = [(f, self.path(f), os.path.getsize(self.path(f))) for f in self.stale_files() if f != "config.bin"]
+        items = [(record.file, record.thumbnail) for record in self.index.records.values() if isinstance(record.thumbnail, list)]
+        return stale, items
+
+    def run_migration(self, jobs, progress=None, cancel=None, workers=WORKERS):
+        # Re-encrypt files not under the current key across the worker pool, then seal old thumbnails again
+        # Leaves the index alone (safe off the owner's thread), resumable : the next run skips what is done
+        # Returns ({file: new thumbnail location}, errors, complete) for finish_migration()
+        stale, items = jobs
+        results = run_pool(_rekey_one, [(f, (path,)) for f, path, size in stale], self.keyring, sum(size for f, path, size in stale), workers, progress, cancel)
+        errors = [f + " : " + error for f, (ok, error) in results.items() if error and error != "cancelled"]
+        complete = all(results.get(f, (False, ""))[0] for f, path, size in stale) and not (cancel is not None and cancel.is_set())
+        moved = {}
+        if complete and self.keyring.retired():
+            for i in range(0, len(items), THUMB_RESEAL_BATCH):
+                if cancel is not None and cancel.is_set():
+                    complete = False
+                    break
+                moved.update(self.thumbnails.reseal(items[i:i + THUMB_RESEAL_BATCH]))
+        return moved, errors, complete
+
+    def finish_migration(self, result):
+        # Commit the resealed thumbnails and snapshot the index under the current key
+        # Older keys are dropped once no file needs them any more, returns the errors
+        moved, errors, complete = result
+        self.commit([["thumb", file, location] for file, location in moved.items() if file in self.index])
+        self.save()
+        if complete and not self.stale_files():
+            # Done, skip this check on next unlock (the scrub state moves to the current key first)
+            if os.path.exists(self.scrub_path): self.save_scrub_state(self.scrub_state())
+            self.keyring.retire()
+            self.keyring.legacy_files = False
+            self.keyring.save(self.key_path)
+            self.thumbnails = self.thumb_pack()
+            self.compact_thumbnails()
+        return errors
+
+    def migrate(self, progress=None, cancel=None, workers=WORKERS):
+        # Module : Whole migration on the calling thread, progress(done, total) in bytes
+        return self.finish_migration(self.run_migration(self.prepare_migration(), progress, cancel, workers))
+
+    # Integrity
+
+    def scrub_state(self):
+        # Current pass (start time, files verified, problems so far) and the report of the last complete one
+        # Kept encrypted in the data folder, an unreadable state starts over
+        try:return json.loads(bytes(decrypt_bytes(self.scrub_path, self.keyring)))
+        except Exception:return {"pass": 0, "verified": [], "problems": [], "completed": 0, "report": []}
+
+    def save_scrub_state(self, state):
+        encrypt_stream(io.BytesIO(json.dumps(state, separators=(',', ':')).encode('utf-8')), self.scrub_path + ".tmp", self.keyring, codec=CODEC_ZLIB)
+        os.replace(self.scrub_path + ".tmp", self.scrub_path)
+
+    def needs_scrub(self):
+        # A pass was cut short, or the last complete one is older than SCRUB_INTERVAL
+        state = self.scrub_state()
+        return bool(state["pass"]) or time.time() - state["completed"] > SCRUB_INTERVAL
+
+    def scrub_report(self):
+        # Problems found by the last complete pass [(file or path in the data folder, problem)]
+        return [tuple(entry) for entry in self.scrub_state()["report"]]
+
+    def prepare_scrub(self):
+        # Files of the current pass not verified yet (all of them for a new pass), one job per stored object (shared content is read once)
+        # Returns ([(file, source, digest, object key, size, files sharing it)], [(file, thumbnail location)])
+        state = self.scrub_state()
+        done = set(state["verified"]) if state["pass"] else set()
+        objects, by_key, thumbnails, sealed = [], {}, [], set()
+        for file, record in self.index.records.items():
+            if record.location is None or file in done: continue
+            key = record.object_key()
+            if key in by_key: by_key[key][5].append(file)
+            else:
+                by_key[key] = (file, self.path(file), record.digest, key, record.size, [file])
+                objects.append(by_key[key])
+            if isinstance(record.thumbnail, list) and tuple(record.thumbnail[:2]) not in sealed:
+                sealed.add(tuple(record.thumbnail[:2]))
+                thumbnails.append((file, record.thumbnail))
+        return objects, thumbnails
+
+    def run_scrub(self, jobs, progress=None, cancel=None, workers=WORKERS, rate=SCRUB_RATE):
+        # Read and authenticate thumbnails, then every object across the worker pool, nothing is written (safe off the owner's thread)
+        # rate : bytes per second over all workers, 0 unthrottled. Returns ({file: (ok, error)}, {file: error}) for finish_scrub()
+        objects, thumbnails = jobs
+        damaged = {}
+        with TRACE.span("scrub.thumbnails"):
+            start, done = time.perf_counter(), 0
+            for i in range(0, len(thumbnails), THUMB_RESEAL_BATCH):
+                if cancel is not None and cancel.is_set(): break
+                batch = thumbnails[i:i + THUMB_RESEAL_BATCH]
+                for file, data in self.thumbnails.read(batch).items():
+                    if data is None: damaged[file] = "damaged thumbnail"
+                # Throttle : sealed bytes read count against the rate as object bytes do
+                done += sum(location[2] for file, location in batch)
+                while rate and done / rate > time.perf_counter() - start and not (cancel is not None and cancel.is_set()):
+                    time.sleep(min(0.1, done / rate - (time.perf_counter() - start)))
+        workers = max(1, min(workers, len(objects)))
+        with TRACE.span("scrub", sum(job[4] for job in objects)):
+            results = run_pool(_scrub_one, [(job[0], (job[1], job[2], rate / workers)) for job in objects], self.keyring,
+                               sum(job[4] for job in objects), workers, progress, cancel)
+        return results, damaged
+
+    def finish_scrub(self, jobs, result):
+        # Record what was verified, files moved (compaction, upgrade) or deleted meanwhile are checked again by a later run
+        # Returns the report [(file, problem)] once the pass is complete (orphans of the data folder added), else None
+        objects, thumbnails = jobs
+        results, damaged = result
+        state = self.scrub_state()
+        if not state["pass"]: state.update({"pass": int(time.time()), "verified": [], "problems": []})
+        verified, problems = set(state["verified"]), dict(state["problems"])
+        for first, source, digest, key, size, files in objects:
+            ok, error = results.get(first, (False, "cancelled"))
+            if error == "cancelled": continue
+            for file in files:
+                record = self.index.get(file)
+                if record is None or record.object_key() != key: continue
+                verified.add(file)
+                if error: problems[file] = error
+                else: problems.pop(file, None)
+        # A thumbnail moved (compaction, upgrade) or deleted meanwhile was read where it no longer is
+        locations = dict(thumbnails)
+        for file, error in damaged.items():
+            record = self.index.get(file)
+            if record is not None and record.thumbnail == locations.get(file): problems.setdefault(file, error)
+        live = [file for file, record in self.index.records.items() if record.location is not None]
+        if any(file not in verified for file in live):
+            state.update({"verified": sorted(verified), "problems": sorted(problems.items())})
+            self.save_scrub_state(state)
+            return None
+        report = sorted((file, error) for file, error in problems.items() if file in self.index) + self.scrub_orphans()
+        self.save_scrub_state({"pass": 0, "verified": [], "problems": [], "completed": int(time.time()), "report": report})
+        return report
+
+    def scrub_orphans(self):
+        # Entries of the data folder no record points at -> [(path in the data folder, problem)]
+        orphans = []
+        # Blobs of files still being imported are not orphans
+        blobs = {record.blob() or file for file, record in self.index.records.items() if record.location is None or record.blob()}
+        for f in sorted(os.listdir(self.data)):
+            if f.endswith('.enc') and f not in self.index: orphans.append((f, "orphan : not in the index"))
+            elif f.endswith('.enc.dat') and f[:-4] not in self.index: orphans.append((f, "orphan : thumbnail of a file not in the index"))
+        directory = os.path.join(self.data, BLOB_DIRECTORY)
+        for shard in sorted(os.listdir(directory)) if os.path.isdir(directory) else []:
+            for f in sorted(os.listdir(os.path.join(directory, shard))):
+                if f.endswith('.enc') and f not in blobs: orphans.append((BLOB_DIRECTORY + "/" + shard + "/" + f, "orphan : blob not in the index"))
+        return orphans
+
+    def scrub(self, progress=None, cancel=None, workers=WORKERS, rate=0):
+        # Module : Whole pass (or the rest of one) on the calling thread, returns the report, None if cut short
+        jobs = self.prepare_scrub()
+        return self.finish_scrub(jobs, self.run_scrub(jobs, progress, cancel, workers, rate))
+
+    # Read
+
+    def stream(self, file, window=STREAM_WINDOW):
+        # Seekable read-only file object over the plaintext, decrypted on demand
+        return SyS_VaultStream(self.path(file), self.keyring, window)
+
+    def read(self, file, offset=0, length=None, progress=None):
+        # Plaintext of a file, or of one range (only the chunks it covers are read)
+        if offset or length is not None:
+            with SyS_VaultReader(self.path(file), self.keyring) as reader:
+                return reader.read(offset, length)
+        return decrypt_bytes(self.path(file), self.keyring, progress)
+
+    def thumbnail(self, file):
+        # Thumbnail JPEG bytes, None if there is none
+        record = self.index.get(file)
+        return read_thumbnails(self.thumbnails, self.keyring, [(file, self.path(file), record.thumbnail if record is not None else False)])[file]